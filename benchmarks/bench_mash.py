@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+'''
+Benchmark suite for mash against a local stand-in mPCC (see fakempcc.py).
+
+Measures:
+  connect     connect time with a cold and a warm schema cache
+  crud        creates and retrieves one at a time, with pforeach, as
+              background jobs and as one retrieve of a list of ids
+  retrieve    time and peak memory of one large retrieve, decoded whole
+              and streamed to a file
+  foreach     per line cost of a templated foreach (no mPCC involved)
+  bmc         bmc power fan-out at different --parallel settings
+  compression bytes on the wire and time of a large retrieve and of
+              creates with large bodies, with and without gzip
+
+The results are printed and saved as JSON, pass an earlier results file to
+--compare to see the change.
+
+Usage: python benchmarks/bench_mash.py [--latency S] [--quick] [--out FILE]
+                                       [--compare FILE] [--only NAME ...]
+'''
+import os, sys, json, time, statistics, tempfile, tracemalloc, argparse, platform
+from io import StringIO
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(benchDir), "src"))
+sys.path.insert(0, benchDir)
+
+from fakempcc import FakeMPCC
+from mash.app import MprovShell
+
+
+def newShell():
+  'A shell with its own session, as if mash had just started.'
+  if MprovShell._session is not None:
+    MprovShell._session.close()
+  MprovShell._session = None
+  MprovShell.jobManager = None
+  MprovShell.responseCache = None
+  MprovShell.compression = None
+  MprovShell.models = {}
+  shell = MprovShell(stdout=StringIO())
+  shell.stderr = StringIO()
+  shell.quiet = True
+  shell.variables = {}
+  return shell
+
+
+def connected(url):
+  shell = newShell()
+  shell.onecmd(f"connect {url} apikey bench")
+  if not shell.models:
+    raise RuntimeError(f"Unable to connect to the fake mPCC at {url}: {shell.stderr.getvalue()}")
+  return shell
+
+
+def timed(func):
+  startTime = time.perf_counter()
+  func()
+  return time.perf_counter() - startTime
+
+
+def run(shell, script):
+  'Run a script in the shell, fail the benchmark if any command in it failed.'
+  errors = shell.errorCount
+  shell.runScript(script, useCache=False)
+  shell._finishJobs()
+  if shell.errorCount > errors:
+    raise RuntimeError(f"benchmark script failed: {shell.stderr.getvalue()[-500:]}")
+
+
+def benchConnect(server, options):
+  from mash.cache import SchemaCache
+  cold = []
+  warm = []
+  for _ in range(options.repeat):
+    SchemaCache(server.url).clear()
+    cold.append(timed(lambda: connected(server.url)))
+    warm.append(timed(lambda: connected(server.url)))
+  return {
+    'coldSeconds': statistics.median(cold),
+    'warmSeconds': statistics.median(warm),
+  }
+
+
+def benchCrud(server, options):
+  count = options.ops
+  shell = connected(server.url)
+  results = {'operations': count}
+
+  def rate(seconds):
+    return {'seconds': seconds, 'opsPerSecond': count / seconds}
+
+  results['createSerial'] = rate(timed(lambda: run(shell, f"""
+seq ids 1 {count} 1
+foreach i in ids
+create node hostname=serial{{{{i}}}}
+endforeach
+""")))
+  results['createParallel'] = rate(timed(lambda: run(shell, f"""
+seq ids 1 {count} 1
+pforeach i in ids -j {options.parallel}
+create node hostname=parallel{{{{i}}}}
+endforeach
+""")))
+  results['createJobs'] = rate(timed(lambda: run(shell, f"""
+jobs max {options.parallel}
+seq ids 1 {count} 1
+foreach i in ids
+create node hostname=job{{{{i}}}} &
+endforeach
+wait
+""")))
+  results['retrieveSerial'] = rate(timed(lambda: run(shell, f"""
+seq ids 1 {count} 1
+foreach i in ids
+retrieve node id={{{{i}}}}
+endforeach
+""")))
+  results['retrieveParallel'] = rate(timed(lambda: run(shell, f"""
+seq ids 1 {count} 1
+pforeach i in ids -j {options.parallel}
+retrieve node id={{{{i}}}}
+endforeach
+""")))
+  results['retrieveIdList'] = rate(timed(lambda: run(shell, f"retrieve node id=[1-{count}]")))
+  results['parallel'] = options.parallel
+  return results
+
+
+def benchRetrieve(server, options):
+  results = {'records': options.records}
+  outFile = os.path.join(options.tmpDir, "records.jsonl")
+  for name, command in (
+      ('decoded', "retrieve node"),
+      ('streamed', f"retrieve node --stream --page-size 1000 --file {outFile}")):
+    shell = connected(server.url)
+    tracemalloc.start()
+    seconds = timed(lambda: run(shell, command))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # drop the result before the next one so they don't add up.
+    shell.variables.clear()
+    results[name] = {'seconds': seconds, 'peakBytes': peak}
+  return results
+
+
+def benchForeach(server, options):
+  items = options.items
+  script = f"""
+seq items 1 {items} 5
+foreach item in items
+let name=node{{{{ item }}}}
+let plain=no template here
+print {{{{ name }}}} is item {{{{ item }}}}
+endforeach
+"""
+  shell = newShell()
+  # import jinja2 first, that's startup not per line cost.
+  shell.renderString("{{ 1 }}")
+  seconds = timed(lambda: run(shell, script))
+  lines = items * 3
+  return {'items': items, 'lines': lines, 'seconds': seconds, 'microsecondsPerLine': seconds / lines * 1e6}
+
+
+def benchBmc(server, options):
+  shell = connected(server.url)
+  nodes = f"n[0001-{options.nodes:04d}]"
+  results = {'nodes': options.nodes, 'latency': options.latency}
+  for parallel in (1, 8, 32):
+    seconds = timed(lambda: run(shell, f"bmc power --parallel {parallel} status {nodes}"))
+    results[f"parallel{parallel}"] = {'seconds': seconds, 'nodesPerSecond': options.nodes / seconds}
+  return results
+
+
+def benchCompression(server, options):
+  results = {'records': options.records // 10}
+  body = "x" * 4096
+  for name, encoding, compress in (('gzip', "gzip", "on"), ('identity', "identity", "off")):
+    shell = connected(server.url)
+    run(shell, f"connection encoding {encoding}")
+    run(shell, f"connection compress {compress}")
+    # only the original records, not the ones created below.
+    seconds = timed(lambda: run(shell, "retrieve node state=up"))
+    received = shell.compression.toDict()['received']
+    shell.variables.clear()
+    creates = timed(lambda: run(shell, f"""
+seq ids 1 {options.ops} 1
+foreach i in ids
+create node hostname={body}{{{{i}}}}
+endforeach
+"""))
+    sent = shell.compression.toDict()['sent']
+    results[name] = {
+      'retrieveSeconds': seconds,
+      'retrieveBytes': received['raw'],
+      'retrieveBytesOnWire': received['wire'],
+      'createSeconds': creates,
+      'createBytes': sent['raw'],
+      'createBytesOnWire': sent['wire'],
+    }
+  return results
+
+
+benchmarks = {
+  'connect': (benchConnect, "latency"),
+  'crud': (benchCrud, "latency"),
+  'retrieve': (benchRetrieve, "big"),
+  'foreach': (benchForeach, None),
+  'bmc': (benchBmc, "latency"),
+  'compression': (benchCompression, "gzip"),
+}
+
+
+def flatten(results, prefix=""):
+  for key, value in results.items():
+    if isinstance(value, dict):
+      yield from flatten(value, f"{prefix}{key}.")
+    else:
+      yield f"{prefix}{key}", value
+
+
+def compare(old, new):
+  oldValues = dict(flatten(old['results']))
+  for key, value in flatten(new['results']):
+    if key in oldValues and isinstance(value, (int, float)) and oldValues[key]:
+      change = (value - oldValues[key]) / oldValues[key]
+      print(f"  {key:<40} {oldValues[key]:>14.6g} -> {value:<14.6g} {change:+.1%}")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark mash against a local fake mPCC.")
+  parser.add_argument("--latency", type=float, default=0.002, help="seconds the fake mPCC adds to every request")
+  parser.add_argument("--quick", action="store_true", help="smaller runs, for a quick check")
+  parser.add_argument("--only", nargs="+", choices=sorted(benchmarks), help="run only these benchmarks")
+  parser.add_argument("--out", help="where to save the results (default mash-bench-<time>.json)")
+  parser.add_argument("--compare", help="an earlier results file to compare with")
+  options = parser.parse_args()
+  options.repeat = 3 if options.quick else 5
+  options.ops = 100 if options.quick else 500
+  options.parallel = 8
+  options.records = 20000 if options.quick else 100000
+  options.items = 2000 if options.quick else 10000
+  options.nodes = 64 if options.quick else 256
+
+  results = {}
+  with tempfile.TemporaryDirectory() as tmpDir:
+    options.tmpDir = tmpDir
+    # keep the schema cache away from the user's own.
+    os.environ["XDG_CACHE_HOME"] = tmpDir
+    with FakeMPCC(latency=options.latency, records=max(options.nodes, options.ops)) as server, \
+        FakeMPCC(latency=0.0, records=options.records) as bigServer, \
+        FakeMPCC(latency=0.0, records=options.records // 10, gzip=True) as gzipServer:
+      servers = {"latency": server, "big": bigServer, "gzip": gzipServer, None: None}
+      for name in options.only or benchmarks:
+        func, serverName = benchmarks[name]
+        print(f"running {name}...", file=sys.stderr)
+        results[name] = func(servers[serverName], options)
+
+  output = {
+    'timestamp': time.time(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'options': {key: getattr(options, key) for key in ("latency", "quick", "repeat", "ops", "parallel", "records", "items", "nodes")},
+    'results': results,
+  }
+  for key, value in flatten(results):
+    print(f"{key:<40} {value:.6g}" if isinstance(value, float) else f"{key:<40} {value}")
+  outFile = options.out or f"mash-bench-{time.strftime('%Y%m%d-%H%M%S')}.json"
+  with open(outFile, "w") as out:
+    json.dump(output, out, indent=2)
+  print(f"saved {outFile}")
+  if options.compare:
+    with open(options.compare) as old:
+      print(f"compared with {options.compare}:")
+      compare(json.load(old), output)
+
+
+if __name__ == "__main__":
+  main()
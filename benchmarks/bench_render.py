@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+'''
+Micro-benchmark for the per-line template overhead of a large foreach.
+
+Runs the same loop with the old renderString (a new jinja Environment and
+a fresh compile for every line) and the current one, and prints the time
+per line for each.
+
+Usage: python benchmarks/bench_render.py [items]
+'''
+import sys, time
+from io import StringIO
+from jinja2 import Environment, BaseLoader
+from mash.app import MprovShell
+
+SCRIPT = """seq items 1 {items} 5
+foreach item in items
+let name=node{{{{ item }}}}
+let plain=no template here
+print {{{{ name }}}} is item {{{{ item }}}}
+print a static line
+endforeach
+"""
+LINES_PER_ITEM = 4
+
+
+def legacyRenderString(self, tempStr):
+  'renderString as it was before the template cache.'
+  jinjaEnv = Environment(
+    loader=BaseLoader,
+    autoescape=False
+  )
+  try:
+    templateStr=jinjaEnv.from_string(tempStr)
+    return templateStr.render(**self.variables)
+  except Exception as e:
+    self.print(f"Error trying to template, {e}")
+  return tempStr
+
+
+def runLoop(items, render=None):
+  shell = MprovShell(stdout=StringIO())
+  if render is not None:
+    shell.renderString = render.__get__(shell)
+  shell.setFile(StringIO(SCRIPT.format(items=items)))
+  startTime = time.perf_counter()
+  shell.cmdloop()
+  return time.perf_counter() - startTime
+
+
+def main():
+  items = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  lines = items * LINES_PER_ITEM
+  before = runLoop(items, legacyRenderString)
+  after = runLoop(items)
+  print(f"foreach over {items} items, {lines} lines rendered")
+  print(f"  before: {before:8.3f}s  {before / lines * 1e6:8.1f}us/line")
+  print(f"  after:  {after:8.3f}s  {after / lines * 1e6:8.1f}us/line")
+  print(f"  speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+'''
+Startup benchmark for the mash entry point.
+
+Measures the cumulative `python -X importtime` cost of importing mash.main,
+checks that the heavy dependencies are not imported at startup, and fails
+(exit code 1) if the median import time is over the budget.
+
+The budget is documented in the README, keep the two in step.
+
+Usage: python benchmarks/bench_startup.py [--runs N] [--budget MS]
+'''
+import os, sys, re, subprocess, statistics, time, compileall, argparse
+
+# the cold start budget for `import mash.main`, in milliseconds.
+BUDGET_MS = 25
+# modules that must only be imported when they are first used.
+LAZY_MODULES = ["requests", "urllib3", "jinja2", "yaml", "csv", "shlex", "base64", "gzip", "concurrent.futures"]
+
+srcDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+importRE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+def pythonEnv():
+  env = dict(os.environ)
+  env["PYTHONPATH"] = srcDir + os.pathsep + env.get("PYTHONPATH", "")
+  # measure the startup users get, with the bytecode already cached.
+  env.pop("PYTHONDONTWRITEBYTECODE", None)
+  return env
+
+
+def importTimes():
+  '''
+  Import mash.main once in a new interpreter, returns {module: (self us, cumulative us)}
+  for mash.main and everything it imported (not the interpreter's own startup).
+  '''
+  result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import mash.main"],
+    env=pythonEnv(), capture_output=True, text=True, check=True)
+  entries = []
+  for line in result.stderr.splitlines():
+    match = importRE.match(line)
+    if match:
+      entries.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3))))
+  # importtime prints children before their parent, mash.main's subtree is
+  # everything nested above it back to the previous top level import.
+  times = {}
+  for module, selfTime, cumulativeTime, depth in reversed(entries):
+    if times and depth == 0:
+      break
+    if times or module == "mash.main":
+      times[module] = (selfTime, cumulativeTime)
+  return times
+
+
+def wallTime(code):
+  startTime = time.perf_counter()
+  subprocess.run([sys.executable, "-c", code], env=pythonEnv(), check=True)
+  return time.perf_counter() - startTime
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Measure the cold start cost of mash.")
+  parser.add_argument("--runs", type=int, default=10)
+  parser.add_argument("--budget", type=float, default=BUDGET_MS, help="budget for import mash.main in ms")
+  options = parser.parse_args()
+
+  compileall.compile_dir(os.path.join(srcDir, "mash"), quiet=1)
+  runs = [importTimes() for _ in range(options.runs)]
+  cumulative = [times["mash.main"][1] / 1000 for times in runs]
+  median = statistics.median(cumulative)
+
+  loaded = subprocess.run([sys.executable, "-c",
+    "import sys, mash.main; print(' '.join(sorted(sys.modules)))"],
+    env=pythonEnv(), capture_output=True, text=True, check=True).stdout.split()
+  eager = [module for module in LAZY_MODULES if module in loaded]
+
+  baseline = statistics.median(wallTime("pass") for _ in range(options.runs))
+  withMash = statistics.median(wallTime("import mash.main") for _ in range(options.runs))
+
+  print(f"import mash.main: median {median:.1f}ms, min {min(cumulative):.1f}ms, max {max(cumulative):.1f}ms (budget {options.budget:.0f}ms)")
+  print(f"interpreter wall time: {baseline * 1000:.1f}ms bare, {withMash * 1000:.1f}ms with mash.main")
+  print("slowest imports (cumulative):")
+  last = runs[-1]
+  for module, (selfTime, cumulativeTime) in sorted(last.items(), key=lambda item: -item[1][1])[:10]:
+    print(f"  {cumulativeTime / 1000:8.2f}ms {module}")
+
+  failed = False
+  if eager:
+    print(f"FAIL: imported at startup: {', '.join(eager)}")
+    failed = True
+  if median > options.budget:
+    print(f"FAIL: over the {options.budget:.0f}ms startup budget")
+    failed = True
+  sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,305 @@
+#!/usr/bin/python3
+'''
+A stand-in mPCC for the benchmarks.  It serves /datamodel/ (with an ETag),
+a list/detail/create/update/delete endpoint for every model (lists can be
+filtered by field=value, field__in=a,b and field__gt=value) and the
+power/<action>/ endpoint the bmc plugin uses, all from memory, with a
+configurable latency added to every request.  Model GETs and model
+definitions carry an ETag and answer a matching If-None-Match with 304.  Nodes powered on (or cycled)
+report "off" for --boot-time seconds before they are "on".  With --gzip it
+gzips responses for clients that accept it, takes gzipped request bodies
+and says so in an Accept-Encoding header, without it a gzipped request
+body gets a 415.
+
+Run it on its own, or from a benchmark with FakeMPCC, which starts it in a
+separate process so it doesn't skew the benchmark's own timings or memory.
+
+Usage: python benchmarks/fakempcc.py [--port N] [--latency S] [--records N]
+                                     [--boot-time S] [--gzip]
+'''
+import sys, json, gzip, time, hashlib, threading, argparse, subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+MODELS = ["node", "systemimage", "networkinterface", "jobmodule"]
+FIELDS = {
+  "id": {"required": False},
+  "hostname": {"required": True},
+  "state": {"required": False},
+  "mac": {"required": False},
+  "ipaddress": {"required": False},
+  "systemimage": {"required": False},
+}
+SCHEMA_ETAG = '"fake-1"'
+
+
+def makeRecord(i):
+  return {
+    "id": i,
+    "hostname": f"n{i:04d}",
+    "state": "up",
+    "mac": f"52:54:00:{(i >> 16) & 0xff:02x}:{(i >> 8) & 0xff:02x}:{i & 0xff:02x}",
+    "ipaddress": f"10.{(i >> 16) & 0xff}.{(i >> 8) & 0xff}.{i & 0xff}",
+    "systemimage": "rocky9-compute",
+  }
+
+
+class Store():
+  def __init__(self, records):
+    self.lock = threading.Lock()
+    self.data = {model: {i: makeRecord(i) for i in range(1, records + 1)} for model in MODELS}
+    self.nextId = {model: records + 1 for model in MODELS}
+    self.hostnames = {record["hostname"] for record in self.data["node"].values()}
+    self.power = {}
+    self.requests = 0
+
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  # send the headers and the body in one write, or keep-alive clients wait on delayed ACKs.
+  wbufsize = 65536
+  store = None
+  latency = 0.0
+  bulk = False
+  bootTime = 0.0
+  gzip = False
+
+  def log_message(self, *args):
+    pass
+
+  def sendJSON(self, code, obj, headers=None, conditional=False):
+    body = json.dumps(obj).encode() if obj is not None else b""
+    if conditional:
+      etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+      if self.headers.get("If-None-Match") == etag:
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+      headers = dict(headers or {}, ETag=etag)
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    if self.gzip:
+      self.send_header("Accept-Encoding", "gzip")
+      if body and "gzip" in self.headers.get("Accept-Encoding", ""):
+        body = gzip.compress(body, compresslevel=6)
+        self.send_header("Content-Encoding", "gzip")
+    self.send_header("Content-Length", str(len(body)))
+    for key, value in (headers or {}).items():
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def readBody(self):
+    length = int(self.headers.get("Content-Length", 0))
+    body = self.rfile.read(length) if length else b""
+    if self.headers.get("Content-Encoding") == "gzip":
+      if not self.gzip:
+        return None
+      body = gzip.decompress(body)
+    return json.loads(body) if body else {}
+
+  def route(self):
+    'Returns (model, record id or None, query) for a model URL, or None.'
+    parts = urlsplit(self.path)
+    path = parts.path.replace("//", "/").strip("/").split("/")
+    query = dict(parse_qsl(parts.query))
+    if len(path) >= 1 and path[0].endswith("s") and path[0][:-1] in MODELS:
+      recordId = path[1] if len(path) > 1 and path[1] != "" else None
+      return path[0][:-1], recordId, query
+    return None, None, query
+
+  def begin(self):
+    with self.store.lock:
+      self.store.requests += 1
+    if self.latency:
+      time.sleep(self.latency)
+
+  def do_GET(self):
+    self.begin()
+    parts = urlsplit(self.path)
+    path = parts.path.replace("//", "/")
+    query = dict(parse_qsl(parts.query))
+    if path in ("", "/"):
+      return self.sendJSON(200, {"mprov": "fake"})
+    if path == "/stats/":
+      return self.sendJSON(200, {"requests": self.store.requests})
+    if path == "/datamodel/":
+      if "model" in query:
+        if query["model"] not in MODELS:
+          return self.sendJSON(404, {"detail": "Not found."})
+        return self.sendJSON(200, {"endpoint": f"/{query['model']}s/", "fields": FIELDS, "bulk": self.bulk}, conditional=True)
+      if self.headers.get("If-None-Match") == SCHEMA_ETAG:
+        self.send_response(304)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+      return self.sendJSON(200, {"datamodels": MODELS}, {"ETag": SCHEMA_ETAG})
+    if path.startswith("/power/"):
+      return self.power(path.strip("/").split("/")[1:], query)
+    model, recordId, query = self.route()
+    if model is None:
+      return self.sendJSON(404, {"detail": "Not found."})
+    records = self.store.data[model]
+    if recordId is not None:
+      record = records.get(int(recordId)) if recordId.isdigit() else None
+      if record is None:
+        return self.sendJSON(404, {"detail": "Not found."})
+      return self.sendJSON(200, record, conditional=True)
+    results = self.filter(records, query)
+    if "limit" in query:
+      limit = int(query["limit"])
+      offset = int(query.get("offset", 0))
+      nextUrl = None
+      if offset + limit < len(results):
+        nextUrl = f"http://{self.headers['Host']}/{model}s/?limit={limit}&offset={offset + limit}"
+      return self.sendJSON(200, {"count": len(results), "next": nextUrl, "previous": None,
+        "results": results[offset:offset + limit]}, conditional=True)
+    return self.sendJSON(200, results, conditional=True)
+
+  def filter(self, records, query):
+    with self.store.lock:
+      results = list(records.values())
+    for key, value in query.items():
+      if key in ("limit", "offset", "fields"):
+        continue
+      if key.endswith("__in"):
+        field = key[:-4]
+        values = set(value.split(","))
+        results = [record for record in results if str(record.get(field)) in values]
+      elif key.endswith("__gt"):
+        field = key[:-4]
+        results = [record for record in results if record.get(field) is not None and record[field] > type(record[field])(value)]
+      else:
+        results = [record for record in results if str(record.get(key)) == value]
+    return results
+
+  def power(self, args, query):
+    hostname = query.get("hostname")
+    if not args or hostname is None:
+      return self.sendJSON(400, {"detail": "Need an action and a hostname."})
+    action = args[0]
+    with self.store.lock:
+      if hostname not in self.store.hostnames:
+        state = None
+      elif action in ("on", "cycle"):
+        self.store.power[hostname] = ("on", time.time() + self.bootTime)
+        state = "on" if self.bootTime <= 0 else "off"
+      elif action == "off":
+        self.store.power[hostname] = ("off", 0.0)
+        state = "off"
+      else:
+        state, readyTime = self.store.power.get(hostname, ("on", 0.0))
+        if time.time() < readyTime:
+          state = "off"
+    if state is None:
+      return self.sendJSON(404, {"detail": f"Unknown node {hostname}"})
+    return self.sendJSON(200, {"hostname": hostname, "state": state})
+
+  def do_POST(self):
+    self.begin()
+    model, recordId, _ = self.route()
+    if model is None:
+      return self.sendJSON(404, {"detail": "Not found."})
+    record = self.readBody()
+    if record is None:
+      return self.sendJSON(415, {"detail": "Unsupported Content-Encoding."})
+    with self.store.lock:
+      record["id"] = self.store.nextId[model]
+      self.store.nextId[model] += 1
+      self.store.data[model][record["id"]] = record
+      if model == "node" and "hostname" in record:
+        self.store.hostnames.add(record["hostname"])
+    self.sendJSON(201, record)
+
+  def do_PATCH(self):
+    self.begin()
+    model, recordId, _ = self.route()
+    changes = self.readBody()
+    if changes is None:
+      return self.sendJSON(415, {"detail": "Unsupported Content-Encoding."})
+    if model is None or recordId is None or not recordId.isdigit():
+      return self.sendJSON(404, {"detail": "Not found."})
+    with self.store.lock:
+      record = self.store.data[model].get(int(recordId))
+      if record is not None:
+        record.update(changes)
+        record["id"] = int(recordId)
+    if record is None:
+      return self.sendJSON(404, {"detail": "Not found."})
+    self.sendJSON(200, record)
+
+  def do_DELETE(self):
+    self.begin()
+    model, recordId, _ = self.route()
+    if model is None or recordId is None or not recordId.isdigit():
+      return self.sendJSON(404, {"detail": "Not found."})
+    with self.store.lock:
+      record = self.store.data[model].pop(int(recordId), None)
+    if record is None:
+      return self.sendJSON(404, {"detail": "Not found."})
+    self.sendJSON(204, None)
+
+
+def serve(port=0, latency=0.0, records=1000, ready=None, bulk=False, bootTime=0.0, gzip=False):
+  handler = type("FakeHandler", (Handler,), {"store": Store(records), "latency": latency, "bulk": bulk,
+    "bootTime": bootTime, "gzip": gzip})
+  server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+  server.daemon_threads = True
+  if ready is not None:
+    ready(server.server_address[1])
+  server.serve_forever()
+
+
+class FakeMPCC():
+  '''
+  Run the fake mPCC in its own process for the length of a with block,
+  url is its base URL (with the trailing slash mash expects).
+  '''
+  def __init__(self, latency=0.0, records=1000, bulk=False, bootTime=0.0, gzip=False):
+    self.latency = latency
+    self.records = records
+    self.bulk = bulk
+    self.bootTime = bootTime
+    self.gzip = gzip
+    self.process = None
+    self.url = None
+
+  def __enter__(self):
+    self.process = subprocess.Popen([sys.executable, __file__, "--port", "0",
+      "--latency", str(self.latency), "--records", str(self.records), "--boot-time", str(self.bootTime)]
+      + (["--bulk"] if self.bulk else []) + (["--gzip"] if self.gzip else []),
+      stdout=subprocess.PIPE, text=True)
+    line = self.process.stdout.readline()
+    if not line.startswith("listening "):
+      self.process.kill()
+      raise RuntimeError("The fake mPCC didn't start")
+    self.url = f"http://127.0.0.1:{int(line.split()[1])}/"
+    return self
+
+  def __exit__(self, *exc):
+    self.process.terminate()
+    self.process.wait()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="A stand-in mPCC for benchmarking mash.")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+  parser.add_argument("--records", type=int, default=1000, help="records of every model")
+  parser.add_argument("--bulk", action="store_true", help="advertise id__in bulk retrieves in the schema")
+  parser.add_argument("--boot-time", type=float, default=0.0, help="seconds a node powered on reports off")
+  parser.add_argument("--gzip", action="store_true", help="take gzipped request bodies and gzip responses")
+  options = parser.parse_args()
+
+  def ready(port):
+    print(f"listening {port}", flush=True)
+  try:
+    serve(options.port, options.latency, options.records, ready, options.bulk, options.boot_time, options.gzip)
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == "__main__":
+  main()
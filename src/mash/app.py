@@ -1,15 +1,36 @@
 import cmd, sys, json
-import os
-from os import fork
-from jinja2 import Environment, BaseLoader
+import os, stat
 from io import StringIO
-import csv, base64
-import requests
-import shlex
-import yaml
-import importlib
-from pathlib import Path
-
+import time, threading
+from functools import lru_cache
+from mash.utils import popOptions
+from mash.hostlist import HostList
+from mash.metrics import Metrics
+
+# requests, jinja2, yaml and the rest of mash are imported where they are
+# first needed, so a mash run that never talks to an mPCC or renders a
+# template doesn't pay for them at startup.  See benchmarks/bench_startup.py.
+
+
+# one jinja environment for the whole process, templates compiled from it
+# are cached by their source string.
+jinjaEnv = None
+
+def hasTemplateMarkers(tempStr):
+  'True if the string has anything in it jinja would have to render.'
+  return "{{" in tempStr or "{%" in tempStr or "{#" in tempStr
+
+@lru_cache(maxsize=1024)
+def compileTemplate(tempStr):
+  'Compile a template string, or get it from the cache if we have seen it before.'
+  global jinjaEnv
+  if jinjaEnv is None:
+    from jinja2 import Environment, BaseLoader
+    jinjaEnv = Environment(
+      loader=BaseLoader,
+      autoescape=False
+    )
+  return jinjaEnv.from_string(tempStr)
 
 def exception_handler(exc_type, exc_value, exc_traceback):
   print(f"There was an internal exception. {exc_value}", file=sys.stderr)
@@ -23,18 +44,61 @@ class MprovShell(cmd.Cmd):
   prompt = '<mProv> # '
   file = None
   variables = {}
-  session = requests.Session()
+  _session = None
   mprovURL = ""
   apikey = ""
   models={}
-  processes = []
+  jobManager = None
   quiet = False
   config_data={}
   inForLoop = False
   forLoopCmds = []
   forLoopItemName = ""
   forLoopList = [] # the list we will iterate on
+  maxConcurrency = 8
+  parallelLoop = None # options of the pforeach we are in, None for a plain foreach
+  errorCount = 0
+  stderr = None
+  keepAlive = True
+  pluginRegistry = None
+  adapterPoolSize = None
+  connStats = None
+  responseCache = None
+  compression = None
+  metrics = Metrics()
+  statsFile = None
+  phases = None
+  profileName = None # the config profile this shell's connection is for, None for the global one
+  profiles = {} # profile name -> a shell connected to it
+
+  # what a shell needs to talk to its mPCC, a shell with a profile keeps its own.
+  connectionAttrs = ("_session", "mprovURL", "apikey", "models", "connStats", "adapterPoolSize",
+    "responseCache", "compression", "keepAlive", "config_data", "profileName")
+
+
+  @property
+  def session(self):
+    'The requests session to the mPCC, shared by the shells of this process unless one sets its own.'
+    if self._session is None:
+      import requests
+      self._setShared('_session', requests.Session())
+    return self._session
+
+  @session.setter
+  def session(self, value):
+    self._session = value
+
+  def _setShared(self, name, value):
+    '''
+    Set part of the connection state, for every shell sharing the global
+    connection, or just this one if it is connected to a profile.
+    '''
+    setattr(self if self.profileName is not None else MprovShell, name, value)
 
+  def _copyConnection(self, target):
+    'Point another shell at the connection of this one (and its profile).'
+    for name in self.connectionAttrs:
+      setattr(target, name, getattr(self, name))
 
   def setFile(self, file):
     self.file = file
@@ -44,7 +108,30 @@ class MprovShell(cmd.Cmd):
     print(*args, file=self.stdout)
   
   def err(self, *args):
-    print(*args, file=sys.stderr)
+    'Use self.err to report errors, it counts them so loops can tell a command failed.'
+    self.errorCount += 1
+    print(*args, file=self.stderr if self.stderr is not None else sys.stderr)
+
+  def onecmd(self, line):
+    'Run a command, timing it for the stats.'
+    command = line.split(" ", 1)[0].strip()
+    if command == "":
+      return super().onecmd(line)
+    errorCount = self.errorCount
+    startTime = time.perf_counter()
+    try:
+      return super().onecmd(line)
+    finally:
+      self.metrics.observeCommand(self._commandLabel(line, command), time.perf_counter() - startTime, self.errorCount > errorCount)
+
+  def _commandLabel(self, line, command):
+    'The name a command is counted under, plugin commands include their sub command.'
+    if hasattr(self, f"do_{command}"):
+      return command
+    if not self._plugins().has(command):
+      return "unknown"
+    args = line.split()
+    return f"{command} {args[1]}" if len(args) > 1 else command
 
   def emptyline(self):
     return 
@@ -56,6 +143,7 @@ class MprovShell(cmd.Cmd):
   def load_config(self):
     # load the config yaml
     # print(self.configfile)
+    import yaml
     yaml.add_constructor("!include", self.yaml_include)
 
     if not os.path.isfile(self.configfile) or not os.access(self.configfile,os.R_OK):
@@ -77,6 +165,19 @@ class MprovShell(cmd.Cmd):
     self.config_data = result
     return True
 
+  def _maxConcurrency(self):
+    'How many requests mash may have in flight at once, maxConcurrency in the config.'
+    try:
+      return max(1, int(self._configValue('maxConcurrency', self.maxConcurrency)))
+    except (TypeError, ValueError):
+      return self.maxConcurrency
+
+  def _configValue(self, key, default=None):
+    'Get a value from the global block of the config, or default if it is not set.'
+    if 'global' not in self.config_data or self.config_data['global'] is None:
+      return default
+    return self.config_data['global'].get(key, default)
+
   def default(self,args):
     '''
     Default command to run when the command is not recognized.
@@ -87,48 +188,48 @@ class MprovShell(cmd.Cmd):
     '''
     if " " not in args:
       pluginName = args
+      args = ""
     else:
       pluginName, args = args.split(" ", 1)
-    args = args.replace(pluginName, "")
-    pluginMod = importlib.util.find_spec(f"mash.plugins.{pluginName}")
-    if pluginMod is not None:
+    # Look in the plugin registry for a plugin with the name of the first arg.
+    if self._plugins().has(pluginName):
       try:
-        plugin = importlib.import_module(f"mash.plugins.{pluginName}")
-        pluginCmd = getattr(plugin, "PluginCMD")
-        if pluginCmd is not None:
-          pluginInstance = pluginCmd(self)
-          if pluginInstance is None:
-            self.err(f"Error: Unable to instantiate plugin {pluginName}")
-            return
-          # send the line off to the plugin
-          # print(f"Plugin: {pluginName}")
+        pluginInstance = self._plugins().get(pluginName)
+        if pluginInstance is None:
+          self.err(f"Error: Unable to instantiate plugin {pluginName}")
+          return
+        # the instance is reused, don't let an empty line repeat its last command.
+        pluginInstance.lastcmd = ""
+        # send the line off to the plugin
+        if self.phases is None:
           pluginInstance.onecmd(args)
         else:
-          self.err(f"Error: 'PluginCMD' class not found on plugin {pluginName}")
-          return
+          startTime = time.perf_counter()
+          try:
+            pluginInstance.onecmd(args)
+          finally:
+            self.phases.add("plugin", time.perf_counter() - startTime)
       except Exception as e:
         self.err(f"Error: Exception in plugin {pluginName}. {e}")
         return
       return
-      # Look in mash.plugins for mash.plugins.<first arg> for a matching plugin.
     self.err(f"Error: Unrecognized command {pluginName}")
 
+  def _plugins(self):
+    'The plugin registry of this shell, created on first use.'
+    if self.pluginRegistry is None:
+      from mash.registry import PluginRegistry
+      self.pluginRegistry = PluginRegistry(self)
+    return self.pluginRegistry
+
   def do_help(self, arg: str) :
     result = False
     result = super().do_help(arg)
     if arg == "":
       # empty arg, list our plugins
       print("\nLoaded Plugins:\n===============")
-      plugins = importlib.util.find_spec('mash.plugins')
-      if plugins is not None:
-        submodulePath = Path(plugins.origin).parent
-        with os.scandir(submodulePath) as entries:
-          for plugin in entries:
-            if plugin.name.startswith('__'):
-              continue
-            pluginName, _ = plugin.name.split('.', 1)
-            if plugin.is_file():
-              print(pluginName)
+      for pluginName in self._plugins().names():
+        print(pluginName)
 
       print("\n")
     else:
@@ -138,21 +239,14 @@ class MprovShell(cmd.Cmd):
         arg=""
       else:
         pluginName, arg = arg.split(" ", 1)
-      pluginMod = importlib.util.find_spec(f"mash.plugins.{pluginName}")
-      if pluginMod is not None:
+      if self._plugins().has(pluginName):
         try:
-          plugin = importlib.import_module(f"mash.plugins.{pluginName}")
-          pluginCmd = getattr(plugin, "PluginCMD")
-          if pluginCmd is not None:
-            pluginInstance = pluginCmd(self)
-            if pluginInstance is None:
-              self.err(f"Error: Unable to instantiate plugin {pluginName}")
-              return
-            # send the line off to the plugin
-            pluginInstance.onecmd("help " + arg)
-          else:
-            self.err(f"Error: 'PluginCMD' class not found on plugin {pluginName}")
+          pluginInstance = self._plugins().get(pluginName)
+          if pluginInstance is None:
+            self.err(f"Error: Unable to instantiate plugin {pluginName}")
             return
+          # send the line off to the plugin
+          pluginInstance.onecmd("help " + arg)
         except Exception as e:
           self.err(f"Error: Exception in plugin {pluginName}. {e}")
           return
@@ -173,8 +267,14 @@ Usage:
     connect - With no arguments, mash will try to read the .mprov-mash.yaml file in the user's 
     home directory (~/.mprov-mash.yaml) and then try to read /etc/mprov/mprov-mash.yaml
 
+    connect --all - Connect to every profile in the profiles block of the config file at
+    once, see 'help use' and 'help on'.
+
     '''
     authHeader = ""
+    if arg.strip() == "--all":
+      self._connectAllProfiles()
+      return
     if " " not in arg:
       # we are reading from a yaml file.
       if not self.load_config():
@@ -198,27 +298,296 @@ Usage:
           
         if 'user' == args[2]:
           # We are using plain text auth
+          import base64
           rawAuthStr=f"{args[2]}:{args[4]}"
           encAuthStr=base64.b64encode(rawAuthStr)
           authHeader = f"Basic {encAuthStr}"
     self._connectToMPCC(authHeader)
 
 
+  def _profileConfig(self, name):
+    'The config of a profile, its settings over the global ones, or None if there is no such profile.'
+    profiles = self.config_data.get('profiles') or {}
+    if name not in profiles:
+      return None
+    settings = dict(self.config_data.get('global') or {})
+    settings.update(profiles[name] or {})
+    config = dict(self.config_data)
+    config['global'] = settings
+    return config
+
+  def _connectProfile(self, name):
+    '''
+    Connect a new shell to a profile, with its own session, connection pool
+    and schema cache.  Returns the shell, or None if it didn't connect.
+    '''
+    config = self._profileConfig(name)
+    if config is None:
+      self.err(f"Error: No profile {name} in {self.configfile}")
+      return None
+    out = StringIO()
+    shell = self.__class__(stdout=out)
+    shell.stderr = out
+    shell.quiet = True
+    shell.variables = {}
+    shell.profileName = name
+    shell._session = None
+    shell.models = {}
+    shell.connStats = None
+    shell.adapterPoolSize = None
+    shell.responseCache = None
+    shell.compression = None
+    shell.keepAlive = True
+    shell.config_data = config
+    shell.mprovURL = config['global'].get('mprovURL', "")
+    authHeader = ""
+    if config['global'].get('apikey'):
+      authHeader = f"Api-Key {config['global']['apikey']}"
+    shell._connectToMPCC(authHeader)
+    if not shell.models:
+      for line in out.getvalue().splitlines():
+        self.err(f"[{name}] {line}")
+      self.err(f"Error: Unable to connect to profile {name} at {shell.mprovURL}")
+      return None
+    shell.stdout = self.stdout
+    shell.stderr = self.stderr
+    MprovShell.profiles[name] = shell
+    return shell
+
+  def _connectAllProfiles(self):
+    if not self.load_config():
+      self.err("Unable to find working config file.")
+      return
+    names = list(self.config_data.get('profiles') or {})
+    if not names:
+      self.err(f"Error: No profiles in {self.configfile}")
+      return
+    from mash.jobs import fanOut
+    connected = [name for name, shell, error in fanOut(self._connectProfile, names, len(names)) if shell is not None]
+    self.variables['MPROV_RESULT'] = connected
+    if not self.quiet:
+      self.print(f"Connected to {len(connected)} of {len(names)} profiles: {' '.join(connected)}")
+
+  def _profileNames(self, arg):
+    '''
+    Parse a comma separated list of profiles, or all, connecting any that
+    are not yet.  Returns the profiles asked for and the ones that are
+    connected, or None on errors.
+    '''
+    if arg == "all":
+      if not self.config_data.get('profiles') and not self.load_config():
+        self.err("Unable to find working config file.")
+        return None
+      names = list(self.config_data.get('profiles') or {})
+    else:
+      names = [name for name in arg.split(",") if name != ""]
+    if not names:
+      self.err("Error: No profiles given.")
+      return None
+    missing = [name for name in names if name not in self.profiles]
+    if missing:
+      if not self.config_data.get('profiles') and not self.load_config():
+        self.err("Unable to find working config file.")
+        return None
+      from mash.jobs import fanOut
+      for name, shell, error in fanOut(self._connectProfile, missing, len(missing)):
+        pass
+    return names, [name for name in names if name in self.profiles]
+
+  def do_use(self, arg):
+    '''
+Switch this shell to one of the mPCCs in the profiles block of the config,
+connecting to it if it isn't already.  Every profile has its own session,
+connection pool and schema cache.
+
+Usage:
+    use - List the connected profiles, * marks the one in use.
+    use <profile> - Send the commands that follow to this profile's mPCC.
+    use default - Go back to the mPCC connected with plain connect.
+
+The profiles block maps a name to settings that override the global ones:
+
+- profiles:
+    site-a:
+      mprovURL: https://mpcc-a.example.com/
+      apikey: ...
+    site-b:
+      mprovURL: https://mpcc-b.example.com/
+      apikey: ...
+'''
+    name = arg.strip()
+    if name == "":
+      for profile in sorted(self.profiles):
+        marker = "*" if profile == self.profileName else " "
+        self.print(f"{marker} {profile:<20} {self.profiles[profile].mprovURL}")
+      return
+    if name == "default":
+      # drop the profile's connection, the shared one shows through again.
+      for attr in self.connectionAttrs:
+        self.__dict__.pop(attr, None)
+      return
+    profiles = self._profileNames(name)
+    if profiles is None:
+      return
+    names = profiles[1]
+    if len(profiles[0]) != 1:
+      self.err("Error: use takes one profile, see 'help on' to run a command on several.")
+      return
+    if not names:
+      return
+    self.profiles[names[0]]._copyConnection(self)
+    if not self.quiet:
+      self.print(f"Using {names[0]} at {self.mprovURL}")
+
+  def do_on(self, arg):
+    '''
+Run a command on several mPCCs at once.
+
+Usage:
+    on <profile>[,<profile>...] <command>
+    on all <command>
+
+Every profile runs the command at the same time, over its own connections,
+with its own copy of the variables.  Output is printed per profile, prefixed
+with [profile].  Sets MPROV_RESULT to a dict of profile -> MPROV_RESULT and
+MPROV_FAILED to the profiles the command failed on (or that could not be
+connected to).
+
+Example: on site-a,site-b retrieve node hostname=compute0001
+'''
+    if " " not in arg.strip():
+      self.err("Error: Syntax error")
+      return
+    profiles, command = arg.strip().split(" ", 1)
+    profiles = self._profileNames(profiles)
+    if profiles is None:
+      return
+    requested, names = profiles
+    from mash.jobs import fanOut
+
+    def runOn(name):
+      out = StringIO()
+      errout = StringIO()
+      child = self._childShell(out, errout)
+      self.profiles[name]._copyConnection(child)
+      child.onecmd(command)
+      child._finishJobs()
+      return (child.errorCount > 0, out.getvalue(), errout.getvalue(), child.variables.get('MPROV_RESULT'))
+
+    results = {}
+    # the profiles we couldn't connect to have failed already.
+    failed = [name for name in requested if name not in names]
+    for name, result, error in fanOut(runOn, names, len(names)):
+      if error is not None:
+        result = (True, "", f"Error: {error}\n", None)
+      commandFailed, output, errors, profileResult = result
+      results[name] = profileResult
+      if commandFailed:
+        failed.append(name)
+      for line in output.splitlines():
+        self.print(f"[{name}] {line}")
+      for line in errors.splitlines():
+        self.err(f"[{name}] {line}")
+    self.variables['MPROV_RESULT'] = results
+    self.variables['MPROV_FAILED'] = failed
+
   def do_disconnect(self, arg):
-    if(self.processes):
-      self.print("Waiting for background processes")
-      while self.processes:
-        pid, _ = os.wait()
-        if pid != 0:
-          if not self.quiet:
-            print(f"PID {pid} finished.")
-          self.processes.remove(pid)
+    'Wait for the background jobs to finish and close the connection to the mPCC.'
+    self._finishJobs()
     self.session.close()
 
+  def do_jobs(self, arg):
+    '''
+List the background jobs.  End a create/retrieve/update/delete with & to
+run it as a background job.
+
+Usage:
+    jobs - List the jobs with their state and run time.
+
+    jobs max <n> - Run at most n jobs at once, the rest are queued.
+
+    jobs clear - Forget the finished jobs and their results.
+'''
+    args = arg.split()
+    if len(args) == 0:
+      for job in self._jobManager().list():
+        self.print(f"[{job.id}] {job.state:8} {job.elapsed():8.3f}s {job.command}")
+      return
+    if args[0] == "max" and len(args) == 2:
+      try:
+        maxJobs = int(args[1])
+      except ValueError:
+        maxJobs = 0
+      if maxJobs < 1:
+        self.err(f"Error: Invalid job count {args[1]}")
+        return
+      self._jobManager().setMaxWorkers(maxJobs)
+      self._ensurePoolSize(maxJobs)
+      return
+    if args[0] == "clear" and len(args) == 1:
+      self._jobManager().clear()
+      return
+    self.err("Error: Syntax error")
+
+  def do_wait(self, arg):
+    '''
+Wait for background jobs to finish.
+
+Usage:
+    wait - Wait for all the jobs.
+
+    wait <id> - Wait for a single job.
+'''
+    if arg.strip() == "":
+      for job in self._jobManager().pending():
+        self._jobManager().wait(job)
+        self._reportJob(job)
+      return
+    job = self._jobManager().get(arg.strip())
+    if job is None:
+      self.err(f"Error: Unknown job {arg}")
+      return
+    self._jobManager().wait(job)
+    self._reportJob(job)
+
+  def do_result(self, arg):
+    '''
+Get the result of a background job.
+
+Usage:
+    result <id>
+
+Return:
+  Sets MPROV_RESULT to the python object the job got back from the mPCC, or sets
+  MPROV_RESULT to None if the job failed or was killed.  Waits for the job if it
+  is still running.
+'''
+    job = self._jobManager().get(arg.strip())
+    if job is None:
+      self.err(f"Error: Unknown job {arg}")
+      return
+    self._jobManager().wait(job)
+    self.variables['MPROV_RESULT'] = job.result
+    if job.state == "failed":
+      self.err(f"Error: Job {job.id} failed. {job.error}")
+    elif job.state == "killed":
+      self.err(f"Error: Job {job.id} was killed.")
+    elif not self.quiet:
+      self.print("OK")
+
+  def do_kill(self, arg):
+    'Kill a background job.  Args kill <id>'
+    job = self._jobManager().get(arg.strip())
+    if job is None:
+      self.err(f"Error: Unknown job {arg}")
+      return
+    if not self._jobManager().kill(job):
+      self.err(f"Error: Job {job.id} already finished.")
+
   def do_create(self,arg):
     'Issue a create command to the mPCC. Args create <model> <model args>'
     if arg is None or arg == "": 
-      self.print("No argument specified.")
+      self.err("Error: No argument specified.")
       return
     self._sendHttpRequest("post", arg, True)
 
@@ -227,37 +596,404 @@ Usage:
 Issue a retrieve command to the mPCC. 
   
 Args:
-  retrieve <model> [model_args]
+  retrieve <model> [model_args] [--fields <path>[,<path>...]] [--output <format>]
+           [--stream [--page-size <n>]] [--file <path>]
+
+  --fields <paths>    Only keep these fields (or paths, see 'help select') of the
+                      records.  If fieldsParam is set in the config, the top level
+                      fields are also sent to the mPCC in that query parameter so
+                      the rest isn't sent at all.
+  --stream            Don't decode the whole response at once, page through the
+                      endpoint and decode the records as they arrive.
+  --page-size <n>     Ask the mPCC for pages of n records (limit/offset).
+  --file <path>       With --stream, write the records to path as JSON lines (or
+                      the --output format) instead of setting MPROV_RESULT.  Memory
+                      use stays flat however many there are.  With --output, write
+                      the output to path instead of the screen.
+  --output <format>   Print the records as a table, csv, jsonl or yaml, a record at
+                      a time (see 'help show').  With --stream they are printed as
+                      they arrive and MPROV_RESULT is set to how many there were.
+
+Several ids:
+  id (or pk) can be a list, id=[1,2,5-9] (ranges like a host list) or id=@var where
+  var holds a list of ids (or of records with an id).  The ids are retrieved at once,
+  up to maxConcurrency at a time over the shared connections, or with id__in queries
+  if the model's schema says it supports them ("bulk": true).  MPROV_RESULT is the
+  list of records in the order of the ids and MPROV_FAILED the ids that failed, each
+  failure is reported.
 
 Return: 
   Sets MPROV_RESULT to the python object representing the returned object, or sets
-  MPROV_RESULT to None if there was an error.
+  MPROV_RESULT to None if there was an error.  With --stream MPROV_RESULT is a lazy
+  iterator over the records that foreach can loop on, the requests are only sent
+  when it is iterated.
 '''
     if arg is None or arg == "": 
-      self.print("No argument specified.")
+      self.err("Error: No argument specified.")
+      return
+    try:
+      arg, options = popOptions(arg, {'--stream': bool, '--page-size': int, '--file': str, '--fields': str,
+        '--output': str})
+    except ValueError as e:
+      self.err(f"Error: {e}")
+      return
+    fmt = options.get('--output')
+    if fmt is not None:
+      from mash.output import formats as outputFormats
+      if fmt not in outputFormats:
+        self.err(f"Error: Unknown output format {fmt}, use one of {', '.join(outputFormats)}")
+        return
+      if arg.endswith("&"):
+        self.err("Error: --output can not be used with a background retrieve")
+        return
+    fields = None
+    if '--fields' in options:
+      from mash.paths import splitPaths, compilePath, PathError
+      fields = splitPaths(options['--fields'])
+      try:
+        for field in fields:
+          compilePath(field)
+      except PathError as e:
+        self.err(f"Error: {e}")
+        return
+      if arg.endswith("&"):
+        self.err("Error: --fields can not be used with a background retrieve")
+        return
+      arg = self._pushFields(arg, fields)
+    if '--stream' in options:
+      self._streamRetrieve(arg, options.get('--page-size', self._configValue('pageSize')), options.get('--file'), fields, fmt)
+      return
+    if '--page-size' in options or ('--file' in options and fmt is None):
+      self.err("Error: --page-size needs --stream, and --file needs --stream or --output")
       return
-    self._sendHttpRequest("get", arg)
+    quiet = self.quiet
+    if fmt is not None:
+      # the output is the records, not OK.
+      self.quiet = True
+    try:
+      ok = self._sendHttpRequest("get", arg)
+    finally:
+      self.quiet = quiet
+    if ok and fields is not None:
+      from mash.paths import project
+      self.variables['MPROV_RESULT'] = project(self.variables['MPROV_RESULT'], fields)
+    if ok and fmt is not None:
+      self._writeOutput(self.variables['MPROV_RESULT'], fmt, options.get('--file'))
+
+  def _pushFields(self, arg, fields):
+    'Add a fields projection to the query, if the mPCC supports one.'
+    fieldsParam = self._configValue('fieldsParam')
+    if not fieldsParam:
+      return arg
+    topLevel = []
+    for field in fields:
+      name = field.split(".", 1)[0].split("[", 1)[0]
+      if name in ("", "*") or name.isdigit():
+        # the path doesn't start with a field, we need the whole record.
+        return arg
+      if name not in topLevel:
+        topLevel.append(name)
+    return f"{arg} {fieldsParam}={','.join(topLevel)}"
+
+  def _streamRetrieve(self, arg, pageSize=None, fileName=None, fields=None, fmt=None):
+    from mash.stream import RecordStream
+    request = self._buildHttpRequest("get", arg)
+    if request is None:
+      self.variables['MPROV_RESULT'] = None
+      return
+    url, _ = request
+    records = RecordStream(self.session, url, pageSize=pageSize)
+    if fields is not None:
+      from mash.paths import Projection
+      records = Projection(records, fields)
+    if fileName is None and fmt is None:
+      self.variables['MPROV_RESULT'] = records
+      if not self.quiet:
+        self.print("OK")
+      return
+    count = self._writeOutput(records, fmt or "jsonl", fileName, failure="Streaming retrieve failed")
+    self.variables['MPROV_RESULT'] = count
+    if count is not None and fileName is not None and not self.quiet:
+      self.print(f"Wrote {count} records to {fileName}")
+
+  def _writeOutput(self, records, fmt, fileName=None, limit=None, failure="Output failed"):
+    '''
+    Write records (a result, see mash.output.iterRecords) in fmt a record at
+    a time, to fileName or our stdout, so execInternal captures it.  Returns
+    how many were written, or None after reporting an error.
+    '''
+    from itertools import islice
+    from mash.output import newWriter, iterRecords, formats
+    if fmt not in formats:
+      self.err(f"Error: Unknown output format {fmt}, use one of {', '.join(formats)}")
+      return None
+    writer = None
+    outFile = None
+    try:
+      outFile = open(fileName, "w") if fileName is not None else self.stdout
+      writer = newWriter(outFile, fmt, int(self._configValue('outputSample', 100)))
+      for record in islice(iterRecords(records), limit):
+        writer.write(record)
+      writer.close()
+    except Exception as e:
+      self.err(f"Error: {failure} after {writer.count if writer is not None else 0} records. {e}")
+      return None
+    finally:
+      if fileName is not None and outFile is not None:
+        outFile.close()
+    return writer.count
     
+  def do_import(self, arg):
+    '''
+Bulk create (or update) records of a model from a file.
+
+Usage:
+    import <model> <file> [--format csv|jsonl|yaml] [--upsert] [-j <n>] [--reject <file>]
+
+  --format      The format of file, guessed from its extension if not given.
+                csv needs a header row with the field names.
+  --upsert      Update records that have an id/pk (creating them if the mPCC
+                doesn't have them yet) instead of creating all of them.
+  -j <n>        Send up to n requests at once (default: maxConcurrency)
+  --reject      Where to write the records that failed, in the same format so
+                they can be fixed and imported again (default: <file>.reject)
+
+The file is read a record at a time, a file ending in .gz is decompressed
+as it is read.  Every record is checked against the model's fields before
+it is sent.  CSV rejects keep the columns of the file.
+
+Return:
+  Sets MPROV_RESULT to a dict with the created, updated and failed counts.
+'''
+    try:
+      arg, options = popOptions(arg, {'--format': str, '--upsert': bool, '-j': int, '--reject': str})
+    except ValueError as e:
+      self.err(f"Error: {e}")
+      return
+    args = arg.split()
+    if len(args) != 2:
+      self.err("Error: Syntax error, see 'help import'")
+      return
+    model, fileName = args
+    from mash.jobs import fanOut
+    from mash.records import readRecords, RecordWriter, guessFormat, formats as recordFormats
+    if model not in self.models or 'endpoint' not in self.models[model]:
+      self.err(f"Error: Unknown Model {model}.")
+      return
+    fmt = options.get('--format', guessFormat(fileName))
+    if fmt not in recordFormats:
+      self.err(f"Error: Unknown format for {fileName}, use --format csv|jsonl|yaml")
+      return
+    rejectName = options.get('--reject', f"{fileName}.reject")
+    upsert = options.get('--upsert', False)
+    jobs = options.get('-j', self._maxConcurrency())
+    fields = self.models[model]['fields']
+    endpoint = f"{self.mprovURL}{self.models[model]['endpoint']}"
+    # the same columns come up over and over, check each set of them once.
+    checkedFields = {}
+
+    def checkRecord(record):
+      fieldSet = frozenset(record)
+      if fieldSet not in checkedFields:
+        problems = [f"unknown field {key}" for key in record if key not in fields]
+        if not upsert or ('id' not in record and 'pk' not in record):
+          problems += [f"missing required field {field}" for field in fields if field not in record and fields[field].get('required')]
+        checkedFields[fieldSet] = ", ".join(problems)
+      return checkedFields[fieldSet]
+
+    def sendRecord(record):
+      if not isinstance(record, dict):
+        return ("failed", "record is not a mapping")
+      problem = checkRecord(record)
+      if problem:
+        return ("failed", problem)
+      recordId = record.get('id', record.get('pk'))
+      if upsert and recordId is not None:
+        response = self._doHttpRequest("patch", f"{endpoint}{recordId}/", record)
+        response.content
+        if 200 <= response.status_code <= 299:
+          return ("updated", None)
+        if response.status_code != 404:
+          return ("failed", f"code: {response.status_code} {response.text}")
+      response = self._doHttpRequest("post", endpoint, record)
+      response.content
+      if 200 <= response.status_code <= 299:
+        return ("created", None)
+      return ("failed", f"code: {response.status_code} {response.text}")
+
+    def openFile():
+      if fileName.endswith(".gz"):
+        import gzip
+        return gzip.open(fileName, "rt", newline="")
+      return open(fileName, "r", newline="")
+
+    counts = {'created': 0, 'updated': 0, 'failed': 0}
+    rejectFile = None
+    rejects = None
+    columns = None
+    startTime = time.time()
+    self._ensurePoolSize(jobs)
+    try:
+      if fmt == "csv":
+        # write the rejects with the file's columns, not just the first reject's.
+        import csv
+        with openFile() as inFile:
+          columns = next(csv.reader(inFile), None)
+      with openFile() as inFile:
+        records = enumerate(readRecords(inFile, fmt), 1)
+        for (line, record), result, error in fanOut(lambda item: sendRecord(item[1]), records, jobs):
+          if error is not None:
+            result = ("failed", str(error))
+          state, message = result
+          counts[state] += 1
+          if state != "failed":
+            continue
+          if counts['failed'] <= 10:
+            self.err(f"Error: Record {line} of {fileName} failed, {message}")
+          if rejects is None:
+            rejectFile = open(rejectName, "w", newline="")
+            rejects = RecordWriter(rejectFile, fmt, columns=columns)
+          rejects.write(record)
+    except Exception as e:
+      self.err(f"Error: Unable to import {fileName}. {e}")
+      if sum(counts.values()) == 0:
+        return
+    finally:
+      if rejectFile is not None:
+        rejectFile.close()
+
+    elapsed = time.time() - startTime
+    total = sum(counts.values())
+    self.variables['MPROV_RESULT'] = counts
+    if not self.quiet:
+      rate = total / elapsed if elapsed > 0 else 0
+      self.print(f"Imported {total} records in {elapsed:.3f}s ({rate:.1f} records/s): {counts['created']} created, {counts['updated']} updated, {counts['failed']} failed")
+    if counts['failed']:
+      self.err(f"Error: {counts['failed']} records failed, written to {rejectName}")
+
+  def do_export(self, arg):
+    '''
+Export the records of a model to a file, a page at a time.
+
+Usage:
+    export <model> [filters] <file> [--format jsonl|csv|yaml] [--gzip] [--resume] [--page-size <n>]
+
+  filters       Query arguments, the same as for retrieve, ie. hostname=compute01
+  --format      The format to write, guessed from the file's extension if not given.
+  --gzip        Compress the output (implied by a file name ending in .gz).
+  --resume      Carry on from the last record a previous export of the same
+                file wrote, only asking the mPCC for records with a larger id.
+  --page-size   Ask the mPCC for pages of n records (default: pageSize in the config)
+
+Records are written as they arrive so memory use stays flat.  The largest id
+written is kept in <file>.state for --resume, which expects the mPCC to return
+the records in id order.
+
+Return:
+  Sets MPROV_RESULT to the number of records written.
+'''
+    try:
+      arg, options = popOptions(arg, {'--format': str, '--gzip': bool, '--resume': bool, '--page-size': int})
+    except ValueError as e:
+      self.err(f"Error: {e}")
+      return
+    args = arg.split()
+    if len(args) < 2:
+      self.err("Error: Syntax error, see 'help export'")
+      return
+    model = args[0]
+    fileName = args[-1]
+    filters = args[1:-1]
+    import csv, gzip
+    from mash.stream import RecordStream
+    from mash.records import RecordWriter, guessFormat, formats as recordFormats
+    fmt = options.get('--format', guessFormat(fileName))
+    if fmt not in recordFormats:
+      self.err(f"Error: Unknown format for {fileName}, use --format jsonl|csv|yaml")
+      return
+    compress = options.get('--gzip', False) or fileName.endswith(".gz")
+    stateName = f"{fileName}.state"
+
+    lastId = None
+    columns = None
+    if options.get('--resume', False) and os.path.exists(fileName):
+      try:
+        with open(stateName, "r") as stateFile:
+          lastId = json.load(stateFile).get('lastId')
+      except (OSError, ValueError):
+        self.err(f"Error: No usable {stateName} to resume from.")
+        return
+      if fmt == "csv":
+        # keep writing the columns the file already has.
+        with (gzip.open(fileName, "rt", newline="") if compress else open(fileName, "r", newline="")) as inFile:
+          columns = next(csv.reader(inFile), None)
+    if lastId is not None:
+      filters.append(f"id__gt={lastId}")
+
+    request = self._buildHttpRequest("get", " ".join([model] + filters))
+    if request is None:
+      return
+    url, _ = request
+    records = RecordStream(self.session, url, pageSize=options.get('--page-size', self._configValue('pageSize')))
+
+    mode = "a" if lastId is not None else "w"
+    count = 0
+    maxId = lastId
+    startTime = time.time()
+    try:
+      with (gzip.open(fileName, mode + "t", newline="") if compress else open(fileName, mode, newline="")) as outFile:
+        writer = RecordWriter(outFile, fmt, columns=columns, header=columns is None)
+        try:
+          for record in records:
+            recordId = record.get('id', record.get('pk')) if isinstance(record, dict) else None
+            if lastId is not None and recordId is not None and recordId <= lastId:
+              # the mPCC ignored id__gt, don't write it twice.
+              continue
+            writer.write(record)
+            count += 1
+            if recordId is not None and (maxId is None or recordId > maxId):
+              maxId = recordId
+        finally:
+          # save how far we got, even if the export died part way.
+          if maxId is not None:
+            with open(stateName, "w") as stateFile:
+              json.dump({'lastId': maxId, 'url': url}, stateFile)
+    except Exception as e:
+      self.err(f"Error: Export failed after {count} records. {e}")
+      self.variables['MPROV_RESULT'] = count
+      return
+    self.variables['MPROV_RESULT'] = count
+    if not self.quiet:
+      self.print(f"Exported {count} records to {fileName} in {time.time() - startTime:.3f}s")
+
   def do_update(self,arg):
     'Issue a update command to the mPCC. Args update <model> <model args>'
     if arg is None or arg == "": 
-      self.print("No argument specified.")
+      self.err("Error: No argument specified.")
       return
     self._sendHttpRequest("patch",arg)
     
 
   def do_delete(self,arg):
-    'Issue a delete command to the mPCC. Args delete <model> <model args>'
+    '''
+Issue a delete command to the mPCC. Args delete <model> <model args>
+
+id (or pk) can be a list of ids, id=[1,2,5-9] or id=@var for a list in a
+variable, to delete them all at once (see help retrieve).
+'''
     self._sendHttpRequest("delete", arg)
 
   def do_exit(self, arg):
     'Quit the Shell.'
+    self._finishJobs()
     sys.exit(0)
   def do_quit(self, arg):
     'Quit the Shell.'
+    self._finishJobs()
     sys.exit(0)
   def do_EOF(self, arg):
     'Quit the Shell.'
+    self._finishJobs()
     sys.exit(0)
     
   # alias the http methods to their CRUD equivs.
@@ -293,7 +1029,7 @@ Examples: let foo=bar
     key = key.strip()
     value = value.strip()
     if value=="":
-      self.print("Error: Empty value in Assignment")
+      self.err("Error: Empty value in Assignment")
       return
     #  a backtick at the beginning of a let statement means, run this internal command.
     if value[0] == '`':
@@ -307,14 +1043,31 @@ Examples: let foo=bar
         self.variables[key] = self.variables[intVar]
         return
       else:
-        self.print(f"Error: Undefined variable ${intVar}")
+        self.err(f"Error: Undefined variable ${intVar}")
         return
     
     # otherwise, assign the given value.
     self.variables[key]=value
 
   def do_models(self,arg):
-    'Display a list of supported data models'
+    '''
+Display a list of supported data models.
+
+Usage:
+    models - List the data models, from the schema cache if it is still valid.
+
+    models --refresh - Drop the schema cache and reload the data models from the mPCC.
+'''
+    if arg.strip() == "--refresh":
+      if self.mprovURL is None or self.mprovURL == "":
+        self.err("Error: You probably aren't connected.")
+        return
+      self._getMPCCModels(refresh=True)
+      if not self.quiet:
+        self.print(f"Loaded {len(self.models)} models in {self.variables.get('MPROV_SCHEMA_TIME')}s")
+    elif arg.strip() != "":
+      self.err(f"Error: Unknown option {arg}")
+      return
     for model in self.models:
       self.print(model)
 
@@ -326,7 +1079,7 @@ Examples: let foo=bar
       self.print(self.models[model])
       
       return
-    self.print(f"Error: Unknown model {model}")
+    self.err(f"Error: Unknown model {model}")
 
   def do_pvar(self,arg):
     'Display the contents of a variable, or a comma separated list of variables'
@@ -336,58 +1089,367 @@ Examples: let foo=bar
       if arg in self.variables:
         self.print(f"{arg}={self.variables[arg]}")
       else:
-        self.print(f"Error: Unknown variable {arg}")
+        self.err(f"Error: Unknown variable {arg}")
       return
-    csvparser = csv.reader(arg)
+    import csv
+    csvparser = csv.reader([arg])
     for vars in csvparser:
       for varName in vars:
+        varName = varName.strip()
         if varName in self.variables:
           self.print(f"{varName}={self.variables[varName]}")
+        elif varName != "":
+          self.err(f"Error: Unknown variable {varName}")
   def do_p(self,arg):
     'Alias to pvar'
     self.do_pvar(arg)
 
+  def do_show(self, arg):
+    '''
+Show the records in a variable, a record at a time.
+
+Usage:
+    show <var> [--output table|csv|jsonl|yaml] [--fields <path>[,<path>...]]
+               [--limit <n>] [--file <path>]
+
+  --output  The format (default: outputFormat in the config, or table).  A
+            table's columns and their widths come from the first outputSample
+            records (default 100), wider cells are cut short.
+  --fields  Only show these fields (or paths, see 'help select').
+  --limit   Only show the first n records.
+  --file    Write to path instead of the screen.
+
+A variable holding a list (or a streamed retrieve) shows a row per item,
+anything else a single row.
+'''
+    try:
+      arg, options = popOptions(arg, {'--output': str, '--fields': str, '--limit': int, '--file': str})
+    except ValueError as e:
+      self.err(f"Error: {e}")
+      return
+    name = arg.strip()
+    if name == "" or " " in name:
+      self.err("Error: Syntax error, see 'help show'")
+      return
+    if name not in self.variables:
+      self.err(f"Error: Unknown variable {name}")
+      return
+    records = self.variables[name]
+    if '--fields' in options:
+      from mash.paths import splitPaths, Projection, PathError
+      from mash.output import iterRecords
+      try:
+        records = Projection(iterRecords(records), splitPaths(options['--fields']))
+      except PathError as e:
+        self.err(f"Error: {e}")
+        return
+    self._writeOutput(records, options.get('--output', self._configValue('outputFormat', "table")),
+      options.get('--file'), options.get('--limit'))
+
+  def do_watch(self, arg):
+    '''
+Repeat a retrieve every interval seconds and show the records that changed.
+
+Usage:
+    watch [--count <n>] [--until <condition>] [--output <format>] <interval> retrieve <model> [model_args]
+
+  --count <n>          Stop after n polls.
+  --until <condition>  Stop once the jinja2 condition (without the {{ }}, quoted
+                       if it has spaces) is true after a poll, ie.
+                       --until "MPROV_RESULT.state == 'up'"
+  --output <format>    How to show the changed records, see 'help show'
+                       (default: outputFormat in the config, or table).
+
+Every poll after the first asks the mPCC to only send the result if it
+changed (If-None-Match/If-Modified-Since, from the ETag and Last-Modified
+of the last response).  A 304 Not Modified is not decoded or shown.  The
+first poll shows every record, later ones only the records that are new or
+changed, and the ids of the ones that are gone.  Stop it with Ctrl-C.
+
+Return:
+  Sets MPROV_RESULT to the last result, MPROV_CHANGED to the records that
+  changed in the last poll and MPROV_REMOVED to the ids of the records that
+  went away in it.
+'''
+    options = {'--count': int, '--until': str, '--output': str}
+    found = {}
+    rest = arg.strip()
+    # only the options before the interval are ours, a value can be quoted.
+    while rest.startswith("--"):
+      name, _, rest = rest.partition(" ")
+      rest = rest.lstrip()
+      if name not in options or rest == "":
+        self.err(f"Error: Syntax error at {name}, see 'help watch'")
+        return
+      if rest[0] in "'\"":
+        end = rest.find(rest[0], 1)
+        if end < 0:
+          self.err(f"Error: Missing closing quote for {name}")
+          return
+        value, rest = rest[1:end], rest[end+1:].lstrip()
+      else:
+        value, _, rest = rest.partition(" ")
+        rest = rest.lstrip()
+      try:
+        found[name] = options[name](value)
+      except ValueError:
+        self.err(f"Error: Invalid value for {name}: {value}")
+        return
+    try:
+      interval, command, rest = rest.split(" ", 2)
+      interval = float(interval)
+    except ValueError:
+      self.err("Error: Syntax error, see 'help watch'")
+      return
+    if command != "retrieve":
+      self.err("Error: watch can only repeat a retrieve")
+      return
+    until = None
+    if '--until' in found:
+      try:
+        until = compileTemplate(f"{{% if {found['--until']} %}}1{{% endif %}}")
+      except Exception as e:
+        self.err(f"Error: Invalid --until condition. {e}")
+        return
+    fmt = found.get('--output', self._configValue('outputFormat', "table"))
+    from mash.output import formats as outputFormats
+    if fmt not in outputFormats:
+      self.err(f"Error: Unknown output format {fmt}, use one of {', '.join(outputFormats)}")
+      return
+    request = self._buildHttpRequest("get", rest)
+    if request is None:
+      self.variables['MPROV_RESULT'] = None
+      return
+    url, _ = request
+    try:
+      self._watch(url, interval, found.get('--count'), until, fmt)
+    except KeyboardInterrupt:
+      self.print("")
+
+  def _watch(self, url, interval, count, until, fmt):
+    from mash.output import iterRecords
+    validators = {}
+    seen = None # record key -> its JSON, from the last result
+    polls = 0
+    notModified = 0
+    while count is None or polls < count:
+      startTime = time.time()
+      headers = {}
+      if 'ETag' in validators:
+        headers['If-None-Match'] = validators['ETag']
+      if 'Last-Modified' in validators:
+        headers['If-Modified-Since'] = validators['Last-Modified']
+      try:
+        response = self.session.get(url, headers=headers, stream=True)
+        content = response.content
+      except Exception as e:
+        self.err(f"Error: Unable to communicate with mPCC. {e}")
+        return
+      polls += 1
+      if response.status_code == 304:
+        # nothing changed, nothing to decode or show.
+        notModified += 1
+        self.variables['MPROV_CHANGED'] = []
+        self.variables['MPROV_REMOVED'] = []
+      elif response.status_code < 200 or response.status_code > 299:
+        self.err(f"Error: The mPCC returned {response.status_code} for {url}")
+        return
+      else:
+        validators = {key: response.headers[key] for key in ('ETag', 'Last-Modified') if key in response.headers}
+        try:
+          result = json.loads(content) if content else None
+        except ValueError as e:
+          self.err(f"Error: Unable to decode the response. {e}")
+          return
+        current = {}
+        changed = []
+        for record in iterRecords(result):
+          key = self._recordKey(record)
+          current[key] = json.dumps(record, sort_keys=True)
+          if seen is None or seen.get(key) != current[key]:
+            changed.append(record)
+        removed = [key for key in seen if key not in current] if seen is not None else []
+        seen = current
+        self.variables['MPROV_RESULT'] = result
+        self.variables['MPROV_CHANGED'] = changed
+        self.variables['MPROV_REMOVED'] = removed
+        if changed or removed:
+          if not self.quiet:
+            self.print(f"[{time.strftime('%H:%M:%S')}] {len(changed)} changed, {len(removed)} removed")
+          if changed:
+            self._writeOutput(changed, fmt)
+          if removed:
+            self.print(f"removed: {', '.join(str(key) for key in removed)}")
+      if until is not None:
+        try:
+          if until.render(**self.variables) == "1":
+            break
+        except Exception as e:
+          self.err(f"Error: Unable to evaluate --until. {e}")
+          return
+      if count is not None and polls >= count:
+        break
+      delay = interval - (time.time() - startTime)
+      if delay > 0:
+        time.sleep(delay)
+    if not self.quiet:
+      self.print(f"watch: {polls} polls, {notModified} not modified")
+
+  @staticmethod
+  def _recordKey(record):
+    'What identifies a record from one poll to the next, its id or else all of it.'
+    if isinstance(record, dict):
+      for key in ('id', 'pk'):
+        if key in record:
+          return record[key]
+    return json.dumps(record, sort_keys=True)
+
   def do_print(self,arg):
     'Print random text and use internal variables'
     self.print(arg)
 
+  def do_select(self, arg):
+    '''
+Pick values out of a variable, for every record in it at once.
+
+Usage:
+    select <var> <path>[,<path>...] [into <var>]
+
+Paths:
+    hostname                  the hostname field, of every record if var is a list
+    interfaces.0.mac          a number indexes a list
+    results.*.hostname        * is every item of a list (or value of a dict)
+    [state=up].hostname       [...] keeps the records that match, with =, !=, <,
+                              <=, >, >= or just [field] for a true value
+
+One path gives a list of its values (or a single value if the path never goes
+through a list), several paths give a record of path=value for every record.
+Puts the result into MPROV_RESULT, or the variable after into.
+
+Examples: select MPROV_RESULT hostname into hosts
+          select nodes [state=up].hostname,interfaces.*.mac
+'''
+    args = arg.split()
+    target = 'MPROV_RESULT'
+    if len(args) >= 4 and args[-2] == "into":
+      target = args[-1]
+      args = args[:-2]
+    if len(args) < 2:
+      self.err("Error: Syntax error")
+      return
+    varName = args[0]
+    if varName not in self.variables:
+      self.err(f"Error: Unknown variable {varName}")
+      return
+    from mash.paths import select, splitPaths, PathError
+    value = self.variables[varName]
+    if not isinstance(value, (dict, list, str, bytes)) and hasattr(value, '__iter__'):
+      # a streamed retrieve, select over all of it.
+      value = list(value)
+    try:
+      self.variables[target] = select(value, splitPaths(" ".join(args[1:])))
+    except PathError as e:
+      self.err(f"Error: {e}")
+      return
+    except Exception as e:
+      self.err(f"Error: Unable to select from {varName}. {e}")
+      return
+    if not self.quiet:
+      self.print("OK")
+
   def do_foreach(self, arg):
     ''' 
         Run a loop of commands.  Syntax: foreach item in list
         item is a single item from a list
-        list is an actual array or a white space separated string
+        list is an actual array, a white space separated string or a
+        host list in slurm notation (ie. node[001-128])
         MUST end your loop with endforeach.
     '''
+    loop = self._parseForeach(arg)
+    if loop is None:
+      return
+    self.forLoopItemName, self.forLoopList = loop
+    self.variables[self.forLoopItemName] = None
+    self.parallelLoop = None
+    
+    self.prompt = "<mProv> -for-> "
+    self.inForLoop = True
+
+  def do_pforeach(self, arg):
+    '''
+        Run a loop of commands with the iterations in parallel.
+        Syntax: pforeach item in list [-j N] [--stop-on-error] [--prefix]
+        item and list are the same as for foreach.  MUST end your loop with endforeach.
+
+        Every iteration runs with its own copy of the variables, so the
+        loop variable and MPROV_RESULT don't collide.  Output is printed in
+        list order when each iteration finishes.
+
+        -j N              Run up to N iterations at once (default: maxConcurrency)
+        --stop-on-error   Don't start any more iterations once one has failed
+        --prefix          Prefix every output line with [item]
 
+        Sets MPROV_LOOP_RESULTS to the MPROV_RESULT of every iteration, in list
+        order, and MPROV_FAILED to the list of items whose iteration failed.
+    '''
+    loop = self._parseParallelForeach(arg)
+    if loop is None:
+      return
+    self.forLoopItemName, self.forLoopList, self.parallelLoop = loop
+
+    self.prompt = "<mProv> -pfor-> "
+    self.inForLoop = True
+
+  def _parseParallelForeach(self, arg):
+    'Parse the pforeach arguments, returns (item name, list, options) or None on errors.'
+    try:
+      arg, options = popOptions(arg, {'-j': int, '--stop-on-error': bool, '--prefix': bool})
+    except ValueError as e:
+      self.err(f"Error: {e}")
+      return None
+    loop = self._parseForeach(arg)
+    if loop is None:
+      return None
+    options = {
+      'jobs': options.get('-j', self._maxConcurrency()),
+      'stopOnError': options.get('--stop-on-error', False),
+      'prefix': options.get('--prefix', False),
+    }
+    return loop[0], loop[1], options
+
+  def _parseForeach(self, arg):
+    'Parse "item in list" for the loops, returns (item name, list) or None on errors.'
     if " " not in arg:
       self.err("Error: Syntax error")
-      return
+      return None
+    import shlex
     args = shlex.split(arg, 2)
     if len(args) < 3 :
       self.err("Error: Syntax error")
-      return
+      return None
     if args[1] != "in":
       self.err("Error: Syntax error")
-      return
+      return None
     if " " in args[2]:
       # convert the string to a list
-      self.forLoopList = args[2].split(" ")
-    else:
-      # print(args)
-      if args[2] not in self.variables:
-        self.err(f"Error: {args[2]} is not defined")
-        return
-      if type(self.variables[args[2]]) is not list:
-        self.err(f"Error: {args[2]} must be type list")
-        return
-      # print(args[2])
-      self.forLoopList = self.variables[args[2]]
-    self.variables[args[0]] = None
-    self.forLoopItemName = args[0]
-    
-    self.prompt = "<mProv> -for-> "
-    self.inForLoop = True
-    
+      return (args[0], args[2].split(" "))
+    if "[" in args[2]:
+      # a host list, iterated without expanding it up front.
+      try:
+        return (args[0], HostList(args[2]))
+      except ValueError as e:
+        self.err(f"Error: {e}")
+        return None
+    # print(args)
+    if args[2] not in self.variables:
+      self.err(f"Error: {args[2]} is not defined")
+      return None
+    # lists, host lists and streamed retrieves, anything we can iterate but a string.
+    if isinstance(self.variables[args[2]], (str, bytes, dict)) or not hasattr(self.variables[args[2]], '__iter__'):
+      self.err(f"Error: {args[2]} must be type list")
+      return None
+    # print(args[2])
+    return (args[0], self.variables[args[2]])
 
   def do_endforeach(self,arg):
     ''' Ends a foreach loop, attempts to run the loop, 
@@ -396,21 +1458,146 @@ Examples: let foo=bar
     '''
     self.prompt = "<mProv> # "
     self.inForLoop = False
-    if len(self.forLoopCmds) > 0:
-      # Run our for loop cmds.
-      for i in self.forLoopList:
-        self.variables[self.forLoopItemName] = i
-        for command in self.forLoopCmds:
-          if self.onecmd(self.renderString(command)) == False:
-            self.err("Error running loop.")
-            self.forLoopCmds.clear()
-            self.forLoopList=[]
-            self.forLoopItemName = ""
-            return
-      self.forLoopCmds.clear()
-      self.forLoopList=[]
-      self.forLoopItemName = ""
-            
+    from mash.script import compileLines, ScriptError
+    try:
+      body = compileLines(self.forLoopCmds)
+    except ScriptError as e:
+      self.err(f"Error: {e}")
+      body = None
+    if body is not None:
+      if self.parallelLoop is not None:
+        self._runParallelLoop(self.forLoopItemName, self.forLoopList, self.parallelLoop, body)
+      elif len(body) > 0:
+        self._runForeach(self.forLoopItemName, self.forLoopList, body)
+    self.forLoopCmds.clear()
+    self.forLoopList=[]
+    self.forLoopItemName = ""
+    self.parallelLoop = None
+
+  def _runForeach(self, itemName, items, body):
+    'Run the body of a foreach for every item, returns False if the loop stopped on an error.'
+    for i in items:
+      self.variables[itemName] = i
+      if not self._runNodes(body):
+        self.err("Error running loop.")
+        return False
+    return True
+
+  def _runParallelLoop(self, itemName, items, options, body):
+    'Run the body of a pforeach, each iteration in its own child shell.'
+    stop = threading.Event()
+    from mash.jobs import fanOut
+
+    def runIteration(item):
+      if stop.is_set():
+        return None
+      out = StringIO()
+      errout = StringIO()
+      child = self._childShell(out, errout)
+      child.variables[itemName] = item
+      failed = False
+      for node in body:
+        errorCount = child.errorCount
+        if not child._runNode(node) or child.errorCount > errorCount:
+          failed = True
+          break
+      if failed and options['stopOnError']:
+        stop.set()
+      return (failed, out.getvalue(), errout.getvalue(), child.variables.get('MPROV_RESULT'))
+
+    results = []
+    failedItems = []
+    skipped = 0
+    self._ensurePoolSize(options['jobs'])
+    for item, result, error in fanOut(runIteration, items, options['jobs']):
+      if error is not None:
+        result = (True, "", f"Error: {error}\n", None)
+      if result is None:
+        skipped += 1
+        continue
+      failed, output, errors, iterResult = result
+      results.append(iterResult)
+      if failed:
+        failedItems.append(item)
+      prefix = f"[{item}] " if options['prefix'] else ""
+      for line in output.splitlines():
+        self.print(f"{prefix}{line}")
+      for line in errors.splitlines():
+        self.err(f"{prefix}{line}")
+
+    self.variables['MPROV_LOOP_RESULTS'] = results
+    self.variables['MPROV_FAILED'] = failedItems
+    if failedItems:
+      self.err(f"Error: {len(failedItems)} loop iterations failed: {' '.join(str(i) for i in failedItems)}")
+      if skipped:
+        self.err(f"Error: {skipped} loop iterations were not run.")
+
+  def _runNode(self, node):
+    'Run one node of a compiled script, returns False if the loop it is in should stop.'
+    line = node[1] if node[2] else self.renderString(node[1])
+    if node[0] == "cmd":
+      return self.onecmd(line) != False
+    command, _, arg = line.partition(" ")
+    if command == "pforeach":
+      loop = self._parseParallelForeach(arg)
+      if loop is None:
+        return False
+      self._runParallelLoop(*loop, node[3])
+      return True
+    loop = self._parseForeach(arg)
+    if loop is None:
+      return False
+    self.variables[loop[0]] = None
+    return self._runForeach(*loop, node[3])
+
+  def _runNodes(self, nodes):
+    for node in nodes:
+      if not self._runNode(node):
+        return False
+    return True
+
+  def runScript(self, text, useCache=True):
+    '''
+    Compile a whole script (or use the cached compiled copy) and run it.
+    Loops can nest, and lines without template markers skip jinja2.
+    '''
+    from mash.script import compileScript, ScriptError
+    try:
+      nodes = compileScript(text, useCache=useCache)
+    except ScriptError as e:
+      self.err(f"Error: {e}")
+      return
+    for node in nodes:
+      self._runNode(node)
+
+  def runCommands(self, commands):
+    'Run a -c string of commands, separated by ; or new lines.'
+    from mash.script import compileLines, splitCommands, ScriptError
+    try:
+      nodes = compileLines(splitCommands(commands))
+    except ScriptError as e:
+      self.err(f"Error: {e}")
+      return
+    self.quiet = True
+    for node in nodes:
+      self._runNode(node)
+    self._finishJobs()
+
+  def _childShell(self, stdout, stderr=None):
+    '''
+    A shell that shares this one's connection and models but has its own
+    copy of the variables, for running commands in parallel.
+    '''
+    child = self.__class__(stdout=stdout)
+    child.stderr = stderr
+    child.variables = dict(self.variables)
+    child.mprovURL = self.mprovURL
+    child.config_data = self.config_data
+    child.quiet = self.quiet
+    if self.profileName is not None:
+      self._copyConnection(child)
+    return child
+
   def do_seq(self, arg):
     '''
     Syntax: seq <var> <start> <end> <width>
@@ -428,6 +1615,61 @@ Examples: let foo=bar
       self.variables[args[0]].append(str(i).zfill(width))
 
     
+  def do_hostlist(self, arg):
+    '''
+Work with host lists in slurm notation, ie. rack[1-4]-node[001-128],login[1-2]
+
+Usage:
+    hostlist count <hostlist> - Print how many hosts are in the list.
+
+    hostlist expand <hostlist> - Set MPROV_RESULT to the list of host names.
+
+    hostlist compress <names|var> - Compress space separated host names, or a
+        list variable, into hostlist notation.
+
+    hostlist union|intersect|diff <hostlist> <hostlist> - Combine two host lists.
+
+  The compressed result of compress, union, intersect and diff is printed
+  and put in MPROV_RESULT.
+'''
+    args = arg.split()
+    if len(args) < 2:
+      self.err("Error: Syntax error")
+      return
+    op = args[0]
+    try:
+      if op == "compress":
+        if len(args) == 2 and type(self.variables.get(args[1])) is list:
+          names = self.variables[args[1]]
+        else:
+          names = args[1:]
+        result = str(HostList.fromNames(names))
+      elif op in ("count", "expand") and len(args) == 2:
+        hostList = HostList(args[1])
+        if op == "count":
+          self.variables['MPROV_RESULT'] = len(hostList)
+          self.print(len(hostList))
+        else:
+          self.variables['MPROV_RESULT'] = list(hostList)
+        return
+      elif op in ("union", "intersect", "diff") and len(args) == 3:
+        left = HostList(args[1])
+        right = HostList(args[2])
+        if op == "union":
+          result = str(left | right)
+        elif op == "intersect":
+          result = str(left & right)
+        else:
+          result = str(left - right)
+      else:
+        self.err("Error: Syntax error")
+        return
+    except ValueError as e:
+      self.err(f"Error: {e}")
+      return
+    self.variables['MPROV_RESULT'] = result
+    self.print(result)
+
   def execInternal(self, arg):
     'Executes the specified command, capturing the output, and returning it as a string. '
     old_stout = self.stdout
@@ -438,34 +1680,405 @@ Examples: let foo=bar
 
   def renderString(self, tempStr):
     'use the internal variables to render a string.'
-    jinjaEnv = Environment(
-      loader=BaseLoader,
-      autoescape=False
-    )
+    if not hasTemplateMarkers(tempStr):
+      # nothing for jinja to do, don't bother it.
+      return tempStr
+    startTime = time.perf_counter()
     try:    
-      templateStr=jinjaEnv.from_string(tempStr)
+      templateStr=compileTemplate(tempStr)
       return templateStr.render(**self.variables)
     except Exception as e:
-      self.print(f"Error trying to template, {e.message}")
+      self.err(f"Error trying to template, {e}")
+    finally:
+      elapsed = time.perf_counter() - startTime
+      self.metrics.observeRender(elapsed)
+      if self.phases is not None:
+        self.phases.add("template", elapsed)
     return tempStr
   
   def _connectToMPCC(self, authHeader):
     self.session.headers.update({
       'Content-Type': 'application/json',
       'Authorization': authHeader,
-      'Connection': 'close',
     })
+    self._setKeepAlive(self._configValue('keepAlive', True))
     try:
-      adapter = requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=100, max_retries=20, pool_block=True)
-      self.session.mount('https://', adapter)
-      self.session.mount('http://', adapter)
-      response = self.session.get(self.mprovURL, stream=True)
+      self._setCompression(self._configValue('compressRequests', "auto"), self._configValue('compressMinSize', 1024))
+      # a new mPCC may not take what the last one did.
+      self.compression.serverAccepts = None
+      self._setAcceptEncoding(self._configValue('acceptEncoding'))
+      poolSize = self._poolSize()
+    except ValueError as e:
+      self.err(f"Error: {e}")
+      return
+    try:
+      self._mountAdapter(poolSize)
+      response = self.session.get(self.mprovURL)
     except:
-      self.print(f"Error: Unable to communicate with mPCC {self.mprovURL}")
+      self.err(f"Error: Unable to communicate with mPCC {self.mprovURL}")
       return
     if response.status_code==200:
       # we connected, get the supported data models.
       self._getMPCCModels()
+      if self._configValue('responseCache', False):
+        self._enableResponseCache()
+      if self._configValue('statsFile') and self.statsFile is None:
+        self.writeStatsAtExit(self._configValue('statsFile'))
+  def _poolSize(self):
+    '''
+    Connections to keep per host, enough for everything mash may run at once.
+    Raises ValueError if poolSize or maxJobs in the config isn't a number.
+    '''
+    sizes = [self._maxConcurrency(), self.jobManager.maxWorkers if self.jobManager is not None else 0]
+    for key in ('poolSize', 'maxJobs'):
+      value = self._configValue(key, 0)
+      try:
+        sizes.append(int(value))
+      except (TypeError, ValueError):
+        raise ValueError(f"Invalid {key} in the config: {value}")
+    return max(sizes)
+
+  def _mountAdapter(self, poolSize):
+    from mash.connection import MashAdapter, ConnectionStats
+    if self.connStats is None:
+      self._setShared('connStats', ConnectionStats())
+    adapter = MashAdapter(stats=self.connStats, metrics=self.metrics, label=self._requestLabel, compression=self.compression,
+      pool_connections=100, pool_maxsize=poolSize, max_retries=20, pool_block=True)
+    previous = self.session.adapters.get('http://')
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+    self._setShared('adapterPoolSize', poolSize)
+    if isinstance(previous, MashAdapter):
+      # drop its idle keep-alive connections now, not whenever it is collected.
+      previous.close()
+
+  def _ensurePoolSize(self, poolSize):
+    '''
+    Grow the connection pool if we are about to run more requests at once
+    than it holds, otherwise the extra threads would just queue for a connection.
+    '''
+    if self.adapterPoolSize is not None and poolSize > self.adapterPoolSize:
+      self._mountAdapter(poolSize)
+
+  def _setCompression(self, mode, minSize=None):
+    '''
+    Set when request bodies are gzipped, mode is auto, on or off (or a yaml
+    boolean).  Raises ValueError for anything else.
+    '''
+    from mash.connection import Compression
+    if mode is True or mode is False:
+      mode = "on" if mode else "off"
+    if self.compression is None:
+      self._setShared('compression', Compression(str(mode), 1024 if minSize is None else minSize))
+    else:
+      if str(mode) not in Compression.modes:
+        raise ValueError(f"Unknown compression mode {mode}")
+      self.compression.mode = str(mode)
+      if minSize is not None:
+        self.compression.minSize = int(minSize)
+
+  def _setAcceptEncoding(self, encodings):
+    '''
+    Set the encodings we ask the mPCC to compress responses with, None for
+    everything urllib3 can decode (what requests asks for by default).
+    Raises ValueError for an encoding we couldn't decode.
+    '''
+    from urllib3.util.request import ACCEPT_ENCODING
+    if encodings is None:
+      encodings = ACCEPT_ENCODING
+    if isinstance(encodings, (list, tuple)):
+      encodings = ",".join(encodings)
+    names = [name.strip() for name in str(encodings).split(",") if name.strip() != ""]
+    supported = ACCEPT_ENCODING.split(",") + ["identity"]
+    for name in names:
+      if name.split(";")[0].strip() not in supported:
+        raise ValueError(f"Unsupported encoding {name}, mash can decode {', '.join(supported)}")
+    self.session.headers['Accept-Encoding'] = ", ".join(names) if names else "identity"
+
+  def _setKeepAlive(self, keepAlive):
+    self._setShared('keepAlive', bool(keepAlive))
+    if self.keepAlive:
+      self.session.headers.pop('Connection', None)
+    else:
+      self.session.headers['Connection'] = 'close'
+
+  def do_stats(self, arg):
+    '''
+Show how long commands, requests to the mPCC and templates have taken.
+
+Usage:
+    stats - Show the command and request latencies (mean, p50, p95, max),
+        the status codes and bytes of the requests by model and method,
+        and the time spent rendering templates.
+
+    stats json - Print them all as JSON, including the histograms.
+
+    stats write <file> [--format json|prometheus] - Write them to a file, as
+        JSON or in the Prometheus text format (the default for .prom files),
+        for the node exporter's textfile collector.
+
+    stats clear - Start counting again.
+
+Set statsFile in the config (or run mash --stats-file <file>) to write them
+when mash exits.
+'''
+    args = arg.split()
+    if len(args) == 0:
+      self._printStats(self.metrics.toDict())
+      return
+    if args[0] == "json" and len(args) == 1:
+      self.print(json.dumps(self.metrics.toDict(), indent=2))
+      return
+    if args[0] == "clear" and len(args) == 1:
+      self.metrics.clear()
+      return
+    if args[0] == "write":
+      try:
+        rest, options = popOptions(" ".join(args[1:]), {'--format': str})
+      except ValueError as e:
+        self.err(f"Error: {e}")
+        return
+      fmt = options.get('--format')
+      if rest == "" or " " in rest or fmt not in (None, "json", "prometheus"):
+        self.err("Error: Syntax error")
+        return
+      try:
+        self.metrics.write(rest, fmt)
+      except OSError as e:
+        self.err(f"Error: Unable to write {rest}. {e}")
+      return
+    self.err("Error: Syntax error")
+
+  def _printStats(self, stats):
+    def ms(seconds):
+      return f"{(seconds or 0) * 1000:.1f}"
+    self.print(f"{'command':<24} {'count':>7} {'errors':>6} {'total s':>9} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    for command, hist in stats['commands'].items():
+      self.print(f"{command:<24} {hist['count']:>7} {hist['errors']:>6} {hist['sum']:>9.3f} {ms(hist['mean']):>9} {ms(hist['p50']):>9} {ms(hist['p95']):>9} {ms(hist['max']):>9}")
+    if stats['requests']:
+      self.print("")
+      self.print(f"{'request':<24} {'count':>7} {'failed':>6} {'sent':>9} {'received':>9} {'mean ms':>9} {'p95 ms':>9}  status codes")
+      for hist in stats['requests']:
+        name = f"{hist['method']} {hist['model']}"
+        codes = ", ".join(f"{code}: {count}" for code, count in hist['statusCodes'].items())
+        self.print(f"{name:<24} {hist['count']:>7} {hist['failed']:>6} {hist['bytesSent']:>9} {hist['bytesReceived']:>9} {ms(hist['mean']):>9} {ms(hist['p95']):>9}  {codes}")
+    self.print("")
+    render = stats['render']
+    self.print(f"templates rendered: {render['count']}, total {render['sum']:.3f}s, mean {ms(render['mean'])}ms, p95 {ms(render['p95'])}ms")
+    if stats['schemaLoads']['count']:
+      self.print(f"data model loads: {stats['schemaLoads']['count']}, total {stats['schemaLoads']['sum']:.3f}s")
+
+  def do_profile(self, arg):
+    '''
+Run a command under the python profiler and show where the time went.
+
+Usage:
+    profile [--top <n>] [--sort <key>] [--out <file>] <command>
+
+    --top <n>      Show the n most expensive functions (default 25).
+    --sort <key>   Sort by cumulative (the default), tottime, ncalls or any
+                   other pstats sort key.
+    --out <file>   Also save the profile to file, for pstats or snakeviz.
+
+After the functions it shows how much of the time went to rendering
+templates, waiting on the mPCC, decoding JSON and running plugins.  Only
+the command's own thread is profiled, not pforeach iterations or jobs.
+
+Example: profile --top 10 retrieve node
+'''
+    options = {'--top': int, '--sort': str, '--out': str}
+    found = {}
+    args = arg.split(" ")
+    # only the options before the command are ours.
+    while len(args) >= 2 and args[0] in options:
+      try:
+        found[args[0]] = options[args[0]](args[1])
+      except ValueError:
+        self.err(f"Error: Invalid value for {args[0]}: {args[1]}")
+        return
+      args = args[2:]
+    command = " ".join(args).strip()
+    if command == "":
+      self.err("Error: No command to profile.")
+      return
+    self.profile(lambda: self.onecmd(command), outFile=found.get('--out'),
+      top=found.get('--top', 25), sort=found.get('--sort', "cumulative"))
+
+  def profile(self, func, outFile=None, top=25, sort="cumulative", stream=None):
+    'Run func under the profiler with the phase timers on, see do_profile.'
+    from mash.profiling import profileCall, PhaseTimer
+    MprovShell.phases = PhaseTimer()
+    try:
+      return profileCall(func, stream if stream is not None else self.stdout, top=top, sort=sort,
+        outFile=outFile, phases=self.phases)
+    except (ValueError, OSError) as e:
+      # a bad sort key or an --out we can't write.
+      self.err(f"Error: Unable to profile. {e}")
+    finally:
+      MprovShell.phases = None
+
+  def writeStatsAtExit(self, path):
+    'Write the stats to path when mash exits, see stats write.'
+    if MprovShell.statsFile is None:
+      import atexit
+      atexit.register(self._writeStatsFile)
+    MprovShell.statsFile = path
+
+  def _writeStatsFile(self):
+    try:
+      self.metrics.write(self.statsFile)
+    except OSError as e:
+      self.err(f"Error: Unable to write the stats to {self.statsFile}. {e}")
+
+  def do_connection(self, arg):
+    '''
+Show or change how mash uses its HTTP connections to the mPCC.
+
+Usage:
+    connection - Show the connection mode, pool size and how many requests
+        reused an open connection instead of opening a new one.
+
+    connection keepalive on|off - Keep connections open and reuse them (the
+        default, keepAlive in the config), or close them after every request.
+
+    connection pool <n> - Keep up to n connections open per host.
+
+    connection compress auto|on|off [<min bytes>] - gzip request bodies of at
+        least min bytes (default 1024): always, never, or (auto, the default)
+        once the mPCC lists gzip in an Accept-Encoding response header.
+        compressRequests and compressMinSize in the config.
+
+    connection encoding <encodings> - The comma separated encodings the mPCC
+        may compress responses with (acceptEncoding in the config), identity
+        for none.  By default every one mash can decode.
+'''
+    args = arg.split()
+    if len(args) == 0:
+      self.print(f"keepalive: {'on' if self.keepAlive else 'off'}")
+      self.print(f"pool size: {self.adapterPoolSize}")
+      if self.connStats is None:
+        self.print("Not connected.")
+        return
+      self.print(f"requests: {self.connStats.requests}")
+      self.print(f"connections opened: {self.connStats.connects}")
+      self.print(f"connections reused: {self.connStats.reused()}")
+      if self.compression is not None:
+        self._printCompression(self.compression.toDict())
+      return
+    if args[0] == "compress" and len(args) in (2, 3):
+      try:
+        self._setCompression(args[1], int(args[2]) if len(args) == 3 else None)
+      except ValueError as e:
+        self.err(f"Error: {e}")
+      return
+    if args[0] == "encoding" and len(args) >= 2:
+      try:
+        self._setAcceptEncoding(" ".join(args[1:]))
+      except ValueError as e:
+        self.err(f"Error: {e}")
+      return
+    if args[0] == "keepalive" and len(args) == 2 and args[1] in ("on", "off"):
+      self._setKeepAlive(args[1] == "on")
+      return
+    if args[0] == "pool" and len(args) == 2:
+      try:
+        poolSize = int(args[1])
+      except ValueError:
+        poolSize = 0
+      if poolSize < 1:
+        self.err(f"Error: Invalid pool size {args[1]}")
+        return
+      self._mountAdapter(poolSize)
+      return
+    self.err("Error: Syntax error")
+
+  def _printCompression(self, stats):
+    def ratio(sizes):
+      return f"{sizes['wire'] / sizes['raw']:.1%}" if sizes['raw'] else "-"
+    accepts = {None: "unknown", True: "yes", False: "no"}[stats['serverAccepts']]
+    self.print(f"accept encoding: {self.session.headers.get('Accept-Encoding')}")
+    self.print(f"compress requests: {stats['mode']} (at least {stats['minSize']} bytes, mPCC takes gzip: {accepts})")
+    self.print(f"request bodies: {stats['sent']['raw']} bytes, {stats['sent']['wire']} sent ({ratio(stats['sent'])}), {stats['compressedRequests']} compressed")
+    self.print(f"response bodies: {stats['received']['raw']} bytes, {stats['received']['wire']} received ({ratio(stats['received'])})")
+
+  def do_cache(self, arg):
+    '''
+Show or manage the cache of retrieve responses.  Repeated retrieves of the
+same model, id and query are answered from the cache until its TTL runs
+out, and a create, update or delete on a model drops its cached responses.
+
+Usage:
+    cache stats - Show the hits, misses and size of the cache, also sets
+        MPROV_RESULT to them.
+
+    cache clear - Drop everything in the cache.
+
+    cache on [ttl] - Start caching retrieves, for ttl seconds (default:
+        responseCacheTTL in the config, or 30).  Turned on at connect when
+        responseCache is true in the config.
+
+    cache off - Stop caching retrieves.
+'''
+    args = arg.split()
+    if len(args) == 0 or args[0] == "stats":
+      if self.responseCache is None:
+        self.print("The response cache is off.")
+        self.variables['MPROV_RESULT'] = None
+        return
+      stats = self.responseCache.stats()
+      self.variables['MPROV_RESULT'] = stats
+      self.print(f"entries: {stats['entries']}/{stats['maxEntries']}, ttl: {stats['ttl']}s")
+      self.print(f"hits: {stats['hits']}, misses: {stats['misses']}, hit rate: {stats['hitRate']:.1%}")
+      self.print(f"evictions: {stats['evictions']}, invalidations: {stats['invalidations']}")
+      return
+    if args[0] == "clear" and len(args) == 1:
+      if self.responseCache is not None:
+        self.responseCache.clear()
+      return
+    if args[0] == "on" and len(args) <= 2:
+      ttl = None
+      if len(args) == 2:
+        try:
+          ttl = float(args[1])
+        except ValueError:
+          self.err(f"Error: Invalid ttl {args[1]}")
+          return
+      self._enableResponseCache(ttl)
+      return
+    if args[0] == "off" and len(args) == 1:
+      self._setShared('responseCache', None)
+      return
+    self.err("Error: Syntax error")
+
+  def _enableResponseCache(self, ttl=None):
+    from mash.cache import ResponseCache
+    if ttl is None:
+      ttl = self._configValue('responseCacheTTL')
+    self._setShared('responseCache', ResponseCache(ttl=ttl, maxEntries=self._configValue('responseCacheSize')))
+
+  def _cacheGroup(self, url):
+    'The model endpoint a URL belongs to, cached responses are dropped per endpoint.'
+    model, endpoint = self._modelForUrl(url)
+    return endpoint if endpoint is not None else url.split("?", 1)[0]
+
+  def _modelForUrl(self, url):
+    'Returns the (model, endpoint URL) a URL is for, or (None, None).'
+    for name, model in list(self.models.items()):
+      endpoint = model.get('endpoint')
+      if endpoint and url.startswith(f"{self.mprovURL}{endpoint}"):
+        return name, f"{self.mprovURL}{endpoint}"
+    return None, None
+
+  def _requestLabel(self, url):
+    'Name the model a request is for in the stats, or the first part of the path for other endpoints.'
+    model, _ = self._modelForUrl(url)
+    if model is not None:
+      return model
+    if self.mprovURL is None or not url.startswith(self.mprovURL):
+      return "other"
+    path = url[len(self.mprovURL):].split("?", 1)[0].strip("/")
+    return path.split("/", 1)[0] if path else "root"
+
   def _parseArgType(self, arg):
     if arg == None or arg == "''" or arg == "\"\"" or arg=="":
       return None
@@ -473,25 +2086,214 @@ Examples: let foo=bar
     if arg[0] == "[" and arg[len(arg)-1] == "]":
       return arg[1:-1:].split(",")
     if arg[0] == "{" and arg[len(arg)-1] == "}":
-      self.print(f"Error: dict type not supported yet!")
+      self.err("Error: dict type not supported yet!")
       sys.exit(1)
     return arg
   def _sendHttpRequest(self, method, arg, checkargs=False, background=False):
     if arg is None or arg == "":
-      self.print("No argument specified.")
+      self.err("Error: No argument specified.")
       return
     if arg[-1] == '&':
-      # if the last character of the string is an &, fork and return as parent.
+      # if the last character of the string is an &, run the request as a background job.
       background = True
-      ret = fork()
-      if ret != 0:
-        # we are parent
-        # Process tracking, 
-        self.processes.append(ret)
-        # do nothing and return.
+      arg=arg[:-1].strip()
+
+    if method in ("get", "delete"):
+      multiId = self._parseMultiId(arg)
+      if multiId is False:
         return
-      arg=arg[:-1]
-        
+      if multiId is not None:
+        if background:
+          self.err("Error: A list of ids can not be used in a background job.")
+          return
+        return self._multiIdRequest(method, *multiId)
+
+    request = self._buildHttpRequest(method, arg, checkargs)
+    if request is None:
+      return
+    url, requestData = request
+
+    if background:
+      # the args are already checked, only the request itself runs in the job.
+      job = self._jobManager().submit(f"{method} {arg}", self._runHttpJob, method, url, requestData)
+      self.variables['MPROV_JOB'] = job.id
+      if not self.quiet:
+        self.print(f"[{job.id}] {method} {arg}")
+      return
+
+    cache = self.responseCache if method == "get" else None
+    if cache is not None:
+      content = cache.get(url)
+      if content is not None:
+        self.variables['MPROV_RESULT'] = json.loads(content)
+        if not self.quiet:
+          self.print("OK")
+        return True
+      group = self._cacheGroup(url)
+      generation = cache.generation(group)
+
+    if self.phases is not None:
+      startTime = time.perf_counter()
+    response = self._doHttpRequest(method, url, requestData)
+    if response is None:
+      return
+    if self.phases is not None:
+      # read the body here so the network time includes it, not the decode.
+      response.content
+      self.phases.add("network", time.perf_counter() - startTime)
+
+    if response.status_code < 200 or response.status_code > 299 :
+      self.err(f"Error: Communications error with mPCC, code: {response.status_code}")
+      self.err(f"{response.text}")
+      return
+
+    try:
+      if response.content == b"":
+        # a delete answers 204 with no body.
+        self.variables['MPROV_RESULT'] = None
+      elif self.phases is None:
+        self.variables['MPROV_RESULT'] = response.json()
+      else:
+        startTime = time.perf_counter()
+        self.variables['MPROV_RESULT'] = response.json()
+        self.phases.add("decode", time.perf_counter() - startTime)
+      if cache is not None:
+        cache.put(url, response.content, group, generation)
+    except: 
+      self.err("Error setting MPROV_RESULT, the mPCC's response is not valid JSON")
+      self.variables['MPROV_RESULT'] = None
+      return
+    if not self.quiet:
+      self.print("OK")
+    return True
+
+  def _parseMultiId(self, arg):
+    '''
+    Look for a list of ids (id=[1,2,3], id=[1-9] or id=@var) in a retrieve or
+    delete.  Returns None if there isn't one, (model, ids, the other args) if
+    there is, or False if the list was bad.
+    '''
+    args = arg.split(" ")
+    for i, marg in enumerate(args[1:], 1):
+      key, _, value = marg.partition("=")
+      if key not in ("id", "pk") or value[:1] not in ("[", "@"):
+        continue
+      if value[0] == "@":
+        if value[1:] not in self.variables:
+          self.err(f"Error: Unknown variable {value[1:]}")
+          return False
+        values = self.variables[value[1:]]
+        if isinstance(values, (str, bytes, dict)) or not hasattr(values, '__iter__'):
+          self.err(f"Error: {value[1:]} must be type list")
+          return False
+        # a list of ids, or of records from an earlier retrieve.
+        ids = []
+        for item in values:
+          if isinstance(item, dict):
+            recordId = item.get('id', item.get('pk'))
+            if recordId is None:
+              self.err(f"Error: {value[1:]} has a record without an id or pk: {item}")
+              return False
+            item = recordId
+          ids.append(str(item))
+      else:
+        if value[-1] != "]":
+          self.err(f"Error: Missing ] in {marg}")
+          return False
+        # keep the ids in the order given, expanding the ranges in place.
+        ids = []
+        try:
+          for part in value[1:-1].split(","):
+            if "-" in part:
+              ids.extend(HostList(f"[{part}]"))
+            elif part != "":
+              ids.append(part)
+        except ValueError as e:
+          self.err(f"Error: {e}")
+          return False
+      return (args[0], ids, " ".join(args[1:i] + args[i+1:]))
+    return None
+
+  def _multiIdRequest(self, method, model, ids, modelArgs):
+    'Retrieve or delete a list of ids at once, see do_retrieve.'
+    from mash.jobs import fanOut
+    request = self._buildHttpRequest(method, f"{model} {modelArgs}".strip())
+    if request is None:
+      self.variables['MPROV_RESULT'] = None
+      return
+    listUrl, _ = request
+    endpointUrl = f"{self.mprovURL}{self.models[model]['endpoint']}"
+    query = listUrl[len(endpointUrl):]
+
+    if method == "get" and self.models[model].get('bulk'):
+      outcomes = self._bulkRetrieve(listUrl, ids)
+    else:
+      cache = self.responseCache if method == "get" else None
+      if cache is not None:
+        generation = cache.generation(endpointUrl)
+
+      def one(recordId):
+        url = f"{endpointUrl}{recordId}/{query}"
+        if cache is not None:
+          content = cache.get(url)
+          if content is not None:
+            return json.loads(content)
+        response = self._doHttpRequest(method, url, {})
+        # read the body whatever the status, so the connection goes back to the pool.
+        content = response.content
+        if response.status_code < 200 or response.status_code > 299:
+          raise Exception(f"code: {response.status_code}")
+        if method == "delete":
+          return recordId
+        record = json.loads(content)
+        if cache is not None:
+          cache.put(url, content, endpointUrl, generation)
+        return record
+
+      parallel = self._maxConcurrency()
+      self._ensurePoolSize(parallel)
+      outcomes = [(recordId, result, error) for recordId, result, error in fanOut(one, ids, parallel)]
+
+    results = []
+    failed = []
+    for recordId, result, error in outcomes:
+      if error is not None:
+        failed.append(recordId)
+        self.err(f"Error: {model} {recordId}: {error}")
+      else:
+        results.append(result)
+    self.variables['MPROV_RESULT'] = results
+    self.variables['MPROV_FAILED'] = failed
+    if not self.quiet:
+      self.print(f"{len(results)} of {len(ids)} OK")
+    return len(results) > 0 or len(ids) == 0
+
+  def _bulkRetrieve(self, listUrl, ids, chunkSize=100):
+    'Retrieve ids with id__in queries, returns (id, record, error) in the order of ids.'
+    from mash.stream import setQuery
+    records = {}
+    errors = {}
+    for start in range(0, len(ids), chunkSize):
+      chunk = ids[start:start + chunkSize]
+      url = setQuery(listUrl, id__in=",".join(chunk), limit=len(chunk))
+      response = self._doHttpRequest("get", url, {})
+      # read the body whatever the status, so the connection goes back to the pool.
+      content = response.content
+      if response.status_code < 200 or response.status_code > 299:
+        for recordId in chunk:
+          errors[recordId] = Exception(f"code: {response.status_code}")
+        continue
+      page = json.loads(content)
+      for record in page['results'] if isinstance(page, dict) and 'results' in page else page:
+        records[str(record.get('id'))] = record
+    return [(recordId, records.get(recordId), errors.get(recordId) or (None if recordId in records else Exception("not found")))
+      for recordId in ids]
+
+  def _buildHttpRequest(self, method, arg, checkargs=False):
+    '''
+    Parse a CRUD command line into the URL and request data for it.
+    Returns a (url, requestData) tuple, or None if the arguments were bad.
+    '''
     # parse the model out, and the args, if any were passed.
     try:
       model, model_args = arg.split(' ', 1)
@@ -500,19 +2302,20 @@ Examples: let foo=bar
       model_args = ""
       
     if model not in self.models:
-      self.print(f"Error: Unknown Model {model}.")
-      return
+      self.err(f"Error: Unknown Model {model}.")
+      return None
     
     # get the endpoint
     if 'endpoint' in self.models[model]:
       mEndpoint = self.models[model]['endpoint']
     else:
-      self.print(f"Error: Model {model} does not seem to have a registered endpoint in the mPCC.")
-      return
+      self.err(f"Error: Model {model} does not seem to have a registered endpoint in the mPCC.")
+      return None
     requestData = {}
     idStr = ""
     queryString = ""
     if method  == "post" or method == "patch":
+      import shlex
       
       # check our args against the data structure.
       for marg in shlex.split(model_args):
@@ -524,18 +2327,18 @@ Examples: let foo=bar
           if key == 'id' or key == 'pk':
             idStr=f"{value}/"
         else:
-          self.print(f"Error: Model {model} does not have field {key}")
-          self.print(f"Check 'model {model}' and try again.")
+          self.err(f"Error: Model {model} does not have field {key}")
+          self.err(f"Check 'model {model}' and try again.")
           self.variables['MPROV_RESULT']=None
-          return
+          return None
       if checkargs:
         # make sure the required fields are present
         for field in self.models[model]['fields']:
           if field not in requestData and self.models[model]['fields'][field]['required']:
-            self.print(f"Error: Missing field required {field} for model {model}.")
-            self.print(f"Check 'model {model}' and try again.")
+            self.err(f"Error: Missing field required {field} for model {model}.")
+            self.err(f"Check 'model {model}' and try again.")
             self.variables['MPROV_RESULT']=None
-            return
+            return None
     elif method == "get" or method == "delete":
       # build query strings
       if model_args == "" :
@@ -552,55 +2355,167 @@ Examples: let foo=bar
           except:
             pass
           queryString += f"{marg}&"
-    
+    else:
+      self.err(f"Error: Unsupported method {method}.")
+      return None
+    return (f"{self.mprovURL}{mEndpoint}{idStr}{queryString}", requestData)
+
+  def _doHttpRequest(self, method, url, requestData):
+    'Send a request built by _buildHttpRequest, returns the response.'
     if method == "post":
-      response = self.session.post(f"{self.mprovURL}{mEndpoint}{idStr}{queryString}", data=json.dumps(requestData), headers={'Connection':'close'}, timeout=None, stream=True)
+      response = self.session.post(url, data=json.dumps(requestData), timeout=None, stream=True)
     elif method == "get":
-      response = self.session.get(f"{self.mprovURL}{mEndpoint}{idStr}{queryString}", timeout=None, stream=True) # TODO: Add query string and ID stuff.
+      response = self.session.get(url, timeout=None, stream=True)
     elif method == "patch":
-      response = self.session.patch(f"{self.mprovURL}{mEndpoint}{idStr}{queryString}", data=json.dumps(requestData),timeout=None, stream=True) # TODO:
+      response = self.session.patch(url, data=json.dumps(requestData),timeout=None, stream=True)
     elif method == "delete":
-      response = self.session.delete(f"{self.mprovURL}{mEndpoint}{idStr}{queryString}",timeout=None, stream=True) # TODO
+      response = self.session.delete(url,timeout=None, stream=True)
     else: 
       response = None
-      self.print(f"Error: Unsupported method {method}.")
-      return
-    
+      self.err(f"Error: Unsupported method {method}.")
+    if response is not None and method != "get" and self.responseCache is not None:
+      # the cached responses for this model may be stale now.
+      self.responseCache.invalidate(self._cacheGroup(url))
+    return response
+
+  def _runHttpJob(self, method, url, requestData):
+    'The body of a background CRUD job, returns the decoded response or raises.'
+    response = self._doHttpRequest(method, url, requestData)
     if response.status_code < 200 or response.status_code > 299 :
-      self.print(f"Error: Communications error with mPCC, code: {response.status_code}")
-      self.print(f"{response.text}")
+      raise Exception(f"Communications error with mPCC, code: {response.status_code} {response.text}")
+    if response.content == b"":
+      return None
+    return response.json()
+
+  def _jobManager(self):
+    'The background job manager for this session, created on first use.'
+    if MprovShell.jobManager is None:
+      from mash.jobs import JobManager
+      MprovShell.jobManager = JobManager(self._configValue('maxJobs', self._maxConcurrency()))
+    return MprovShell.jobManager
+
+  def _finishJobs(self):
+    'Wait for any background jobs still running, reporting the ones that failed.'
+    if self.jobManager is None or not self.jobManager.pending():
       return
+    self.print("Waiting for background jobs")
+    for job in self.jobManager.pending():
+      self.jobManager.wait(job)
+      self._reportJob(job)
 
-    # only assign MPROV_RESULT if we are not running in the background/parallel.  
-    if not background:
-      try:
-        self.variables['MPROV_RESULT'] = response.json()
-      except: 
-        print("Error setting MPROV_RESULT")
-        # self.print(f"{response.text}")
-        self.variables['MPROV_RESULT'] = None
-        self.print("ERROR")
-        return
-      if not self.quiet:
-        self.print("OK")
-    else:
-      # self.print(f"{response.text}")
-      # exit because we were backgrounded and forked.  Don't want to return to main.
-      sys.exit(0)
+  def _reportJob(self, job):
+    if job.state == "failed":
+      self.err(f"Error: Job {job.id} ({job.command}) failed. {job.error}")
+    elif not self.quiet:
+      self.print(f"[{job.id}] {job.state} {job.command}")
 
 
-  def _getMPCCModels(self):
-    response = self.session.get(f"{self.mprovURL}/datamodel/")
+  def _getMPCCModel(self, model, etag=None):
+    '''
+    Fetch a single model definition, if it doesn't match etag.  Returns a
+    (status code, definition, ETag) tuple, the definition is None for a 304.
+    '''
+    headers = {}
+    if etag is not None:
+      headers['If-None-Match'] = etag
+    try:
+      response = self.session.get(f"{self.mprovURL}/datamodel/?model={model}", headers=headers)
+    except Exception as e:
+      return (e, None, None)
+    if response.status_code == 304:
+      return (304, None, etag)
+    if response.status_code != 200:
+      return (response.status_code, None, None)
+    return (200, response.json(), response.headers.get('ETag'))
+
+  def _fetchMPCCModels(self, modellist, cached=None, etags=None):
+    '''
+    Fetch the model definitions into self.models, in parallel over the
+    session's pool.  Definitions we have cached with an ETag are asked for
+    conditionally and kept on a 304.  Returns the ETags of the definitions
+    and whether any of them failed.
+    '''
+    cached = cached or {}
+    etags = etags or {}
+    self.models.clear()
+    modelETags = {}
+    failed = False
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=self._maxConcurrency()) as executor:
+      # map() hands them back in modellist order.
+      results = executor.map(lambda model: self._getMPCCModel(model, etags.get(model) if model in cached else None), modellist)
+      for model, (code, modelDef, etag) in zip(modellist, results):
+        if code == 304:
+          modelDef = cached[model]
+        elif code != 200:
+          self.err(f"Error: Unable to retrieve data structure for model {model}, code: {code}")
+          failed = True
+          continue
+        self.models[model] = modelDef
+        if etag is not None:
+          modelETags[model] = etag
+    return modelETags, failed
+
+  def _revalidateMPCCModels(self, schemaCache):
+    '''
+    The model list hasn't changed since we cached it, but the models in it
+    may have.  Refetch their definitions (conditionally where we have their
+    ETags) and update the cache, or keep the cached ones if that fails.
+    '''
+    entry = schemaCache.entry
+    modelETags, failed = self._fetchMPCCModels(list(entry['models']), entry['models'], entry.get('modelETags'))
+    if failed:
+      self.models.clear()
+      self.models.update(entry['models'])
+      return
+    schemaCache.store(self.models, etag=entry.get('etag'), fingerprint=entry.get('fingerprint'), modelETags=modelETags)
+
+  def _getMPCCModels(self, refresh=False):
+    'Load the data models from the schema cache or the mPCC, recording how long it took in MPROV_SCHEMA_TIME.'
+    startTime = time.time()
+    self._loadMPCCModels(refresh)
+    elapsed = time.time() - startTime
+    self.metrics.observeSchemaLoad(elapsed)
+    self.variables['MPROV_SCHEMA_TIME'] = round(elapsed, 3)
+
+  def _loadMPCCModels(self, refresh=False):
+    from mash.cache import SchemaCache
+    # the schema cache lets us skip the /datamodel/ round trips on connect.
+    schemaCache = None
+    etag = None
+    if self._configValue('schemaCache', True):
+      schemaCache = SchemaCache(self.mprovURL, ttl=self._configValue('schemaCacheTTL'))
+      if refresh:
+        schemaCache.clear()
+      elif schemaCache.load() is not None:
+        if schemaCache.fresh():
+          self.models.clear()
+          self.models.update(schemaCache.entry['models'])
+          return
+        etag = schemaCache.etag()
+
+    headers = {}
+    if etag is not None:
+      headers['If-None-Match'] = etag
+    response = self.session.get(f"{self.mprovURL}/datamodel/", headers=headers)
+    if response.status_code == 304:
+      # the model list is the same as when we cached it.
+      self._revalidateMPCCModels(schemaCache)
+      return
     if response.status_code == 200:
+      fingerprint = SchemaCache.fingerprint(response.content)
+      etag = response.headers.get('ETag')
+      if schemaCache is not None and schemaCache.matches(fingerprint):
+        # the mPCC doesn't do ETags, but the model list is the same.
+        self._revalidateMPCCModels(schemaCache)
+        return
       modellist = response.json()['datamodels']
-      for model in modellist:
-        response = self.session.get(f"{self.mprovURL}/datamodel/?model={model}")
-        if response.status_code != 200:
-          self.print(f"Error: Unable to retrieve data structure for model {model}, code: {response.status_code}")
-          continue
-        self.models[model] = response.json()
+      modelETags, failed = self._fetchMPCCModels(modellist)
+      # don't cache a partial schema, we would never notice the missing models.
+      if schemaCache is not None and not failed:
+        schemaCache.store(self.models, etag=etag, fingerprint=fingerprint, modelETags=modelETags)
     else:
-      self.print(f"Error: Unable to retrieve the data models from the mPCC, code: {response.status_code}")
+      self.err(f"Error: Unable to retrieve the data models from the mPCC, code: {response.status_code}")
     
     
   # pre-process commandline if needed
@@ -625,6 +2540,11 @@ Examples: let foo=bar
   def cmdloop(self, intro=None):
     if self.file != None:
       self.quiet = True
+      if self._isRegularFile(self.file):
+        # a script file, compile the whole thing up front.
+        self.runScript(self.file.read())
+        self._finishJobs()
+        return
       # we are getting a file piped in.
       # it should be an FD, not a file name.
       for line in self.file:
@@ -636,9 +2556,17 @@ Examples: let foo=bar
             continue
         
         self.onecmd(self.precmd(line))
+      self._finishJobs()
     else:
       return super().cmdloop(intro=intro)
 
+  @staticmethod
+  def _isRegularFile(file):
+    try:
+      return stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+      return False
+
 
 
 
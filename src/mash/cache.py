@@ -0,0 +1,183 @@
+import os, json, time, hashlib, threading
+
+
+def cacheDir(*parts):
+  '''
+  Returns the mash cache directory, ~/.cache/mash by default, or
+  $XDG_CACHE_HOME/mash if that is set.
+  '''
+  base = os.environ.get("XDG_CACHE_HOME", "")
+  if base == "":
+    base = os.path.expanduser("~/.cache")
+  return os.path.join(base, "mash", *parts)
+
+
+class SchemaCache():
+  '''
+  On-disk cache of the data models an mPCC exposes, one file per mPCC URL.
+
+  Entries hold the models, the ETag (if the mPCC sent one), a fingerprint
+  of the /datamodel/ listing, the ETags of the model definitions and the
+  time they were fetched.  Inside the TTL the entry is used as is, after
+  that the listing and the definitions have to be revalidated against the
+  mPCC.
+  '''
+  ttl = 3600
+
+  def __init__(self, mprovURL, ttl=None, path=None):
+    self.mprovURL = mprovURL
+    if ttl is not None:
+      self.ttl = ttl
+    if path is None:
+      urlHash = hashlib.sha256(mprovURL.encode()).hexdigest()[:16]
+      path = cacheDir("schema", f"{urlHash}.json")
+    self.path = path
+    self.entry = None
+
+  @staticmethod
+  def fingerprint(content):
+    'Fingerprint a /datamodel/ listing body.'
+    if isinstance(content, str):
+      content = content.encode()
+    return hashlib.sha256(content).hexdigest()
+
+  def load(self):
+    'Load the entry from disk, returns None if there is no usable entry.'
+    self.entry = None
+    try:
+      with open(self.path, "r") as cacheFile:
+        entry = json.load(cacheFile)
+    except (OSError, ValueError):
+      return None
+    if not isinstance(entry, dict) or entry.get('url') != self.mprovURL or not entry.get('models'):
+      return None
+    self.entry = entry
+    return entry
+
+  def fresh(self):
+    'True if the loaded entry is still inside its TTL.'
+    if self.entry is None:
+      return False
+    return (time.time() - self.entry.get('fetched', 0)) < self.ttl
+
+  def etag(self):
+    if self.entry is None:
+      return None
+    return self.entry.get('etag')
+
+  def matches(self, fingerprint):
+    return self.entry is not None and self.entry.get('fingerprint') == fingerprint
+
+  def store(self, models, etag=None, fingerprint=None, modelETags=None):
+    self.entry = {
+      'url': self.mprovURL,
+      'etag': etag,
+      'fingerprint': fingerprint,
+      'modelETags': modelETags or {},
+      'fetched': time.time(),
+      'models': models,
+    }
+    self._write(self.entry)
+
+  def clear(self):
+    self.entry = None
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
+
+  def _write(self, entry):
+    # write to a temp file and rename so a concurrent mash never reads half a file.
+    try:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      tmpPath = f"{self.path}.{os.getpid()}.tmp"
+      with open(tmpPath, "w") as cacheFile:
+        json.dump(entry, cacheFile)
+      os.replace(tmpPath, self.path)
+    except OSError:
+      # a cache we can't write is not an error, we just fetch next time.
+      pass
+
+
+class ResponseCache():
+  '''
+  In-memory LRU cache of retrieve responses, keyed by the request URL (so
+  by mPCC, model, id and query string).  Entries expire after the TTL and
+  the least recently used are dropped past maxEntries.  Entries are grouped
+  by their model endpoint, a write to the endpoint drops the whole group.
+
+  The raw response bodies are kept, every hit decodes a fresh copy so a
+  script changing MPROV_RESULT can't change what's cached.
+  '''
+  ttl = 30
+  maxEntries = 256
+
+  def __init__(self, ttl=None, maxEntries=None):
+    from collections import OrderedDict
+    if ttl is not None:
+      self.ttl = ttl
+    if maxEntries is not None:
+      self.maxEntries = maxEntries
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()  # url -> (group, stored at, content)
+    self.generations = {}  # group -> count of invalidations
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  def get(self, url):
+    'Returns the cached content for url, or None.'
+    with self.lock:
+      entry = self.entries.get(url)
+      if entry is not None and time.time() - entry[1] >= self.ttl:
+        del self.entries[url]
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(url)
+      self.hits += 1
+      return entry[2]
+
+  def generation(self, group):
+    'Take this before sending a request, and pass it to put.'
+    with self.lock:
+      return self.generations.get(group, 0)
+
+  def put(self, url, content, group, generation=None):
+    with self.lock:
+      if generation is not None and generation != self.generations.get(group, 0):
+        # the endpoint was written to while we were reading it.
+        return
+      self.entries[url] = (group, time.time(), content)
+      self.entries.move_to_end(url)
+      while len(self.entries) > self.maxEntries:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def invalidate(self, group):
+    'Drop every entry of a model endpoint.'
+    with self.lock:
+      self.generations[group] = self.generations.get(group, 0) + 1
+      for url in [url for url, entry in self.entries.items() if entry[0] == group]:
+        del self.entries[url]
+        self.invalidations += 1
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        'entries': len(self.entries),
+        'maxEntries': self.maxEntries,
+        'ttl': self.ttl,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hitRate': self.hits / lookups if lookups else 0.0,
+        'evictions': self.evictions,
+        'invalidations': self.invalidations,
+      }
@@ -0,0 +1,191 @@
+import threading, time, gzip
+import requests
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+'''
+The HTTP adapter mash mounts on its session.  It is a plain requests
+HTTPAdapter that also counts how many requests it sent and how many TCP
+connections it had to open for them, so we can tell how often a request
+reused a kept-alive connection.  With a Metrics object it also records
+every request's latency, status code and sizes (the response size from its
+Content-Length, the body isn't read yet when the adapter sees it).
+
+With a Compression object the adapter also gzips request bodies and counts
+the bytes of every body before and after (de)compression.
+'''
+
+
+class ConnectionStats():
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.connects = 0
+
+  def count(self, name):
+    with self.lock:
+      setattr(self, name, getattr(self, name) + 1)
+
+  def reused(self):
+    return max(0, self.requests - self.connects)
+
+
+class Compression():
+  '''
+  When to gzip request bodies, and how many bytes bodies took before and
+  after compression.  mode is "on" (gzip every body of at least minSize
+  bytes), "off", or "auto": only once the mPCC has said it takes gzip, by
+  listing it in an Accept-Encoding header of a response (RFC 7694).
+  '''
+  modes = ("auto", "on", "off")
+
+  def __init__(self, mode="auto", minSize=1024, level=6):
+    if mode not in self.modes:
+      raise ValueError(f"Unknown compression mode {mode}")
+    self.lock = threading.Lock()
+    self.mode = mode
+    self.minSize = int(minSize)
+    self.level = int(level)
+    self.serverAccepts = None # None until the mPCC tells us either way
+    self.rawSent = 0
+    self.wireSent = 0
+    self.compressedRequests = 0
+    self.rawReceived = 0
+    self.wireReceived = 0
+
+  def shouldCompress(self, size):
+    if self.mode == "off" or size < self.minSize or self.serverAccepts is False:
+      return False
+    return self.mode == "on" or self.serverAccepts is True
+
+  def learn(self, response):
+    'Note whether the mPCC takes gzip bodies, from a response to us.'
+    accepts = response.headers.get('Accept-Encoding')
+    if accepts is not None:
+      self.serverAccepts = "gzip" in accepts.lower()
+
+  def sent(self, raw, wire):
+    with self.lock:
+      self.rawSent += raw
+      self.wireSent += wire
+      if wire != raw:
+        self.compressedRequests += 1
+
+  def received(self, raw, wire):
+    with self.lock:
+      self.rawReceived += raw
+      self.wireReceived += wire
+
+  def toDict(self):
+    with self.lock:
+      return {
+        'mode': self.mode,
+        'minSize': self.minSize,
+        'serverAccepts': self.serverAccepts,
+        'compressedRequests': self.compressedRequests,
+        'sent': {'raw': self.rawSent, 'wire': self.wireSent},
+        'received': {'raw': self.rawReceived, 'wire': self.wireReceived},
+      }
+
+
+def _countingPool(poolClass, connectionClass, stats):
+  'Subclass a urllib3 pool so its connections count every socket they open.'
+  class CountingConnection(connectionClass):
+    def connect(self):
+      stats.count('connects')
+      return super().connect()
+
+  class CountingPool(poolClass):
+    ConnectionCls = CountingConnection
+
+  return CountingPool
+
+
+class MashAdapter(requests.adapters.HTTPAdapter):
+  def __init__(self, stats=None, metrics=None, label=None, compression=None, **kwargs):
+    self.stats = stats if stats is not None else ConnectionStats()
+    self.metrics = metrics
+    self.compression = compression
+    # label(url) names the model a request is for, in the metrics.
+    self.label = label
+    super().__init__(**kwargs)
+
+  def init_poolmanager(self, *args, **kwargs):
+    super().init_poolmanager(*args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = {
+      'http': _countingPool(HTTPConnectionPool, HTTPConnection, self.stats),
+      'https': _countingPool(HTTPSConnectionPool, HTTPSConnection, self.stats),
+    }
+
+  def send(self, request, **kwargs):
+    self.stats.count('requests')
+    if self.metrics is None:
+      return self._send(request, **kwargs)
+    model = self.label(request.url) if self.label is not None else "other"
+    startTime = time.perf_counter()
+    try:
+      response = self._send(request, **kwargs)
+    except Exception:
+      sent = len(request.body) if isinstance(request.body, (bytes, str)) else 0
+      self.metrics.observeRequest(request.method, model, time.perf_counter() - startTime, None, sent)
+      raise
+    sent = len(request.body) if isinstance(request.body, (bytes, str)) else 0
+    try:
+      received = int(response.headers.get('Content-Length', 0))
+    except ValueError:
+      received = 0
+    self.metrics.observeRequest(request.method, model, time.perf_counter() - startTime, response.status_code, sent, received)
+    return response
+
+  def _send(self, request, **kwargs):
+    'Send request, gzipping its body if we should, and count the body sizes.'
+    compression = self.compression
+    if compression is None:
+      return super().send(request, **kwargs)
+    body = request.body
+    if isinstance(body, str):
+      body = body.encode('utf-8')
+    raw = len(body) if isinstance(body, bytes) else 0
+    compressed = False
+    if raw and 'Content-Encoding' not in request.headers and compression.shouldCompress(raw):
+      self._setBody(request, gzip.compress(body, compresslevel=compression.level), 'gzip')
+      compressed = True
+    response = super().send(request, **kwargs)
+    if compressed and response.status_code == 415:
+      # the mPCC doesn't take gzip after all, say so and send it plain.
+      compression.serverAccepts = False
+      response.close()
+      self._setBody(request, body, None)
+      compressed = False
+      response = super().send(request, **kwargs)
+    compression.learn(response)
+    compression.sent(raw, len(request.body) if compressed else raw)
+    self._countReceived(response)
+    return response
+
+  @staticmethod
+  def _setBody(request, body, encoding):
+    request.body = body
+    request.headers['Content-Length'] = str(len(body))
+    if encoding is None:
+      request.headers.pop('Content-Encoding', None)
+    else:
+      request.headers['Content-Encoding'] = encoding
+
+  def _countReceived(self, response):
+    '''
+    Count the response body as it is read, decoded and as it came over the
+    wire (urllib3 knows how many bytes it read for it).
+    '''
+    raw = response.raw
+    stream = getattr(raw, 'stream', None)
+    if stream is None:
+      return
+    compression = self.compression
+    def countingStream(*args, **kwargs):
+      size = 0
+      for chunk in stream(*args, **kwargs):
+        size += len(chunk)
+        yield chunk
+      compression.received(size, raw.tell())
+    raw.stream = countingStream
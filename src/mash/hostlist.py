@@ -0,0 +1,333 @@
+import re
+from bisect import bisect_right
+from itertools import product
+
+'''
+Slurm style host lists, ie. rack[1-4]-node[001-128],login[1,2]
+
+A HostList keeps the hosts as sorted, merged number intervals per
+(prefix, width, suffix) key instead of a list of names, so a list of 100k
+nodes is a handful of tuples.  Bracket groups before the last one in a
+name are expanded into their own keys, the last one stays an interval set.
+'''
+
+nameRE = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+
+def _splitTop(expr):
+  'Split an expression on the commas that are not inside brackets.'
+  terms = []
+  depth = 0
+  start = 0
+  for i, char in enumerate(expr):
+    if char == '[':
+      depth += 1
+      if depth > 1:
+        raise ValueError(f"Range Invalid, nested brackets in {expr}")
+    elif char == ']':
+      depth -= 1
+      if depth < 0:
+        raise ValueError(f"Range Invalid, unexpected closing bracket in {expr}")
+    elif char == ',' and depth == 0:
+      terms.append(expr[start:i])
+      start = i + 1
+  if depth != 0:
+    raise ValueError("Range Invalid, no closing bracket found")
+  terms.append(expr[start:])
+  return [term.strip() for term in terms if term.strip() != ""]
+
+
+def _parseGroup(group):
+  'Parse the inside of a bracket group into a list of (start, end, width) tuples.'
+  ranges = []
+  for element in group.split(','):
+    element = element.strip()
+    if element == "":
+      continue
+    if '-' in element:
+      low, high = element.split('-', 1)
+    else:
+      low = high = element
+    if not low.isdigit() or not high.isdigit():
+      raise ValueError(f"Range Invalid, {element} is not a number or a range")
+    width = len(low) if len(low) > 1 and low[0] == '0' else 0
+    start = int(low)
+    end = int(high)
+    if end < start:
+      raise ValueError(f"Range Invalid, {element} ends before it starts")
+    if width and len(str(end)) > width:
+      raise ValueError("Range Format Error, padded zeros do not match range.")
+    ranges.append((start, end, width))
+  if not ranges:
+    raise ValueError("Range Invalid, empty brackets")
+  return ranges
+
+
+def _mergeIntervals(intervals):
+  intervals = sorted(intervals)
+  merged = []
+  for low, high in intervals:
+    if merged and low <= merged[-1][1] + 1:
+      if high > merged[-1][1]:
+        merged[-1] = (merged[-1][0], high)
+    else:
+      merged.append((low, high))
+  return merged
+
+
+def _intersectIntervals(left, right):
+  result = []
+  i = j = 0
+  while i < len(left) and j < len(right):
+    low = max(left[i][0], right[j][0])
+    high = min(left[i][1], right[j][1])
+    if low <= high:
+      result.append((low, high))
+    if left[i][1] < right[j][1]:
+      i += 1
+    else:
+      j += 1
+  return result
+
+
+def _subtractIntervals(left, right):
+  result = []
+  j = 0
+  for low, high in left:
+    while j < len(right) and right[j][1] < low:
+      j += 1
+    k = j
+    while k < len(right) and right[k][0] <= high:
+      if right[k][0] > low:
+        result.append((low, right[k][0] - 1))
+      low = max(low, right[k][1] + 1)
+      k += 1
+    if low <= high:
+      result.append((low, high))
+  return result
+
+
+def _formatNumber(num, width):
+  return str(num).zfill(width)
+
+
+def _formatIntervals(intervals, width):
+  parts = []
+  for low, high in intervals:
+    if low == high:
+      parts.append(_formatNumber(low, width))
+    else:
+      parts.append(f"{_formatNumber(low, width)}-{_formatNumber(high, width)}")
+  return ",".join(parts)
+
+
+class HostList():
+  '''
+  A set of host names in slurm hostlist notation.  Iterating a HostList
+  expands it lazily, len() counts it without expanding it, and the set
+  operators |, & and - work on the intervals directly.  str() gives the
+  compressed form back.
+  '''
+  def __init__(self, expr=None):
+    # (prefix, width, suffix) -> merged list of (start, end); width None means no number.
+    self.groups = {}
+    if expr is not None and expr != "":
+      for term in _splitTop(expr):
+        self._addTerm(term)
+
+  @classmethod
+  def fromNames(cls, names):
+    'Build a HostList from host names, ie. to compress them.'
+    hostList = cls()
+    pending = {}
+    for name in names:
+      key, num = cls._splitName(name)
+      pending.setdefault(key, []).append((num, num))
+    for key, intervals in pending.items():
+      hostList._addIntervals(key, intervals)
+    return hostList
+
+  @staticmethod
+  def _splitName(name):
+    match = nameRE.match(name)
+    if match is None:
+      return ((name, None, ""), 0)
+    prefix, digits, suffix = match.groups()
+    width = len(digits) if len(digits) > 1 and digits[0] == '0' else 0
+    return ((prefix, width, suffix), int(digits))
+
+  def _addTerm(self, term):
+    # split the term into literal strings and bracket groups.
+    pieces = re.split(r'\[([^\]]*)\]', term)
+    literals = pieces[0::2]
+    groups = [_parseGroup(group) for group in pieces[1::2]]
+    if not groups:
+      # a plain name, keep it the way fromNames would so both meet.
+      key, num = self._splitName(term)
+      self._addIntervals(key, [(num, num)])
+      return
+    suffix = literals[-1]
+    if re.search(r'\d', suffix):
+      # names split on their last number, which is in the suffix here, ie.
+      # node[1-3]-eth0.  Expand the whole term so it is keyed like the names.
+      outer = [[_formatNumber(num, width) for start, end, width in group for num in range(start, end + 1)]
+        for group in groups]
+      pending = {}
+      for combo in product(*outer):
+        name = literals[0]
+        for num, literal in zip(combo, literals[1:]):
+          name += num + literal
+        key, num = self._splitName(name)
+        pending.setdefault(key, []).append((num, num))
+      for key, intervals in pending.items():
+        self._addIntervals(key, intervals)
+      return
+    # expand every group but the last one into the prefixes.
+    outer = []
+    for group in groups[:-1]:
+      outer.append([_formatNumber(num, width) for start, end, width in group for num in range(start, end + 1)])
+    for combo in product(*outer):
+      prefix = literals[0]
+      for num, literal in zip(combo, literals[1:-1]):
+        prefix += num + literal
+      for start, end, width in groups[-1]:
+        self._addIntervals((prefix, width, suffix), [(start, end)])
+
+  def _addIntervals(self, key, intervals):
+    prefix, width, suffix = key
+    if width:
+      # numbers as long as the padding look the same padded or not, keep
+      # them unpadded so node100 is the same host however it was written.
+      threshold = 10 ** (width - 1)
+      natural = [(max(low, threshold), high) for low, high in intervals if high >= threshold]
+      intervals = [(low, min(high, threshold - 1)) for low, high in intervals if low < threshold]
+      if natural:
+        self._addIntervals((prefix, 0, suffix), natural)
+      if not intervals:
+        return
+    if key in self.groups:
+      self.groups[key] = _mergeIntervals(self.groups[key] + intervals)
+    else:
+      self.groups[key] = _mergeIntervals(intervals)
+
+  def _displayGroups(self):
+    '''
+    The groups the way they are shown, with the unpadded numbers put back
+    into the padded group they are long enough to belong to.
+    '''
+    paddedWidths = {}
+    for prefix, width, suffix in self.groups:
+      if width:
+        paddedWidths.setdefault((prefix, suffix), []).append(width)
+    display = {}
+    for (prefix, width, suffix), intervals in self.groups.items():
+      if width != 0:
+        display.setdefault((prefix, width, suffix), []).extend(intervals)
+        continue
+      widths = sorted(paddedWidths.get((prefix, suffix), []), reverse=True)
+      for low, high in intervals:
+        target = 0
+        for padded in widths:
+          if low >= 10 ** (padded - 1):
+            target = padded
+            break
+        display.setdefault((prefix, target, suffix), []).append((low, high))
+    return {key: _mergeIntervals(intervals) for key, intervals in display.items()}
+
+  def __iter__(self):
+    for (prefix, width, suffix), intervals in self._displayGroups().items():
+      if width is None:
+        yield prefix
+        continue
+      for low, high in intervals:
+        for num in range(low, high + 1):
+          yield f"{prefix}{_formatNumber(num, width)}{suffix}"
+
+  def __len__(self):
+    count = 0
+    for (prefix, width, suffix), intervals in self.groups.items():
+      if width is None:
+        count += 1
+        continue
+      for low, high in intervals:
+        count += high - low + 1
+    return count
+
+  def __bool__(self):
+    return bool(self.groups)
+
+  def __contains__(self, name):
+    key, num = self._splitName(name)
+    if key not in self.groups:
+      return False
+    intervals = self.groups[key]
+    i = bisect_right(intervals, (num, float('inf'))) - 1
+    return i >= 0 and intervals[i][0] <= num <= intervals[i][1]
+
+  def __eq__(self, other):
+    if not isinstance(other, HostList):
+      return NotImplemented
+    return self.groups == other.groups
+
+  def union(self, other):
+    result = HostList()
+    result.groups = dict(self.groups)
+    for key, intervals in other.groups.items():
+      result._addIntervals(key, intervals)
+    return result
+
+  def intersection(self, other):
+    result = HostList()
+    for key, intervals in self.groups.items():
+      if key in other.groups:
+        common = _intersectIntervals(intervals, other.groups[key])
+        if common:
+          result.groups[key] = common
+    return result
+
+  def difference(self, other):
+    result = HostList()
+    for key, intervals in self.groups.items():
+      if key in other.groups:
+        intervals = _subtractIntervals(intervals, other.groups[key])
+      if intervals:
+        result.groups[key] = intervals
+    return result
+
+  __or__ = union
+  __and__ = intersection
+  __sub__ = difference
+
+  def __str__(self):
+    # fold keys that only differ by a number in the prefix back into a
+    # bracket group, so rack[1-4]-node[001-128] comes out the way it went in.
+    folded = {}
+    for (prefix, width, suffix), intervals in self._displayGroups().items():
+      if width is None:
+        folded.setdefault((prefix, None, None, None, None), [])
+        continue
+      body = f"[{_formatIntervals(intervals, width)}]{suffix}"
+      if len(intervals) == 1 and intervals[0][0] == intervals[0][1]:
+        body = f"{_formatNumber(intervals[0][0], width)}{suffix}"
+      match = nameRE.match(prefix)
+      if match is None:
+        folded.setdefault((prefix, None, None, None, body), [])
+        continue
+      head, digits, tail = match.groups()
+      outerWidth = len(digits) if len(digits) > 1 and digits[0] == '0' else 0
+      folded.setdefault((head, outerWidth, tail, True, body), []).append((int(digits), int(digits)))
+
+    terms = []
+    for (head, outerWidth, tail, numbered, body), intervals in folded.items():
+      if numbered is None:
+        terms.append(head if body is None else f"{head}{body}")
+        continue
+      intervals = _mergeIntervals(intervals)
+      if len(intervals) == 1 and intervals[0][0] == intervals[0][1]:
+        terms.append(f"{head}{_formatNumber(intervals[0][0], outerWidth)}{tail}{body}")
+      else:
+        terms.append(f"{head}[{_formatIntervals(intervals, outerWidth)}]{tail}{body}")
+    return ",".join(terms)
+
+  def __repr__(self):
+    return f"HostList('{self}')"
@@ -0,0 +1,165 @@
+import time, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait as waitFutures
+
+
+class Job():
+  '''
+  A command running in the background.  The job keeps whatever its
+  function returned (or the exception it raised) until it is cleared.
+  '''
+  def __init__(self, jobId, command):
+    self.id = jobId
+    self.command = command
+    self.future = None
+    self.state = "pending"
+    self.result = None
+    self.error = None
+    self.submitted = time.time()
+    self.started = None
+    self.finished = None
+
+  def done(self):
+    return self.state in ("done", "failed", "killed")
+
+  def elapsed(self):
+    if self.started is None:
+      return 0.0
+    end = self.finished if self.finished is not None else time.time()
+    return end - self.started
+
+
+class JobManager():
+  '''
+  Runs background jobs on a bounded pool of worker threads.  All the jobs
+  share the caller's objects (and so the HTTP connection pool), at most
+  maxWorkers of them run at once and the rest wait in the queue.
+  '''
+  def __init__(self, maxWorkers=8):
+    self.maxWorkers = maxWorkers
+    self.jobs = {}
+    self.nextId = 1
+    self.lock = threading.Lock()
+    self.executor = None
+
+  def submit(self, command, func, *args, **kwargs):
+    'Queue func(*args, **kwargs) as a new job and return the Job.'
+    with self.lock:
+      if self.executor is None:
+        self.executor = ThreadPoolExecutor(max_workers=self.maxWorkers, thread_name_prefix="mash-job")
+      job = Job(self.nextId, command)
+      self.nextId += 1
+      self.jobs[job.id] = job
+      job.future = self.executor.submit(self._run, job, func, args, kwargs)
+    return job
+
+  def _run(self, job, func, args, kwargs):
+    if job.state == "killed":
+      return
+    job.state = "running"
+    job.started = time.time()
+    try:
+      result = func(*args, **kwargs)
+    except Exception as e:
+      if job.state != "killed":
+        job.error = e
+        job.state = "failed"
+    else:
+      # a killed job keeps running until its request returns, but we drop what it got.
+      if job.state != "killed":
+        job.result = result
+        job.state = "done"
+    job.finished = time.time()
+
+  def get(self, jobId):
+    'Get a job by its id, returns None if there is no such job.'
+    try:
+      return self.jobs.get(int(jobId))
+    except (TypeError, ValueError):
+      return None
+
+  def list(self):
+    return [self.jobs[jobId] for jobId in sorted(self.jobs)]
+
+  def pending(self):
+    return [job for job in self.list() if not job.done()]
+
+  def wait(self, job=None, timeout=None):
+    'Wait for a job, or all the jobs if job is None.  Returns the jobs that are not done yet.'
+    if job is not None:
+      jobs = [job]
+    else:
+      jobs = self.pending()
+    futures = [j.future for j in jobs if j.future is not None]
+    try:
+      waitFutures(futures, timeout=timeout)
+    except CancelledError:
+      pass
+    return [j for j in jobs if not j.done()]
+
+  def kill(self, job):
+    '''
+    Kill a job.  Queued jobs never run, a running job can't be interrupted
+    mid-request so its result is thrown away instead.
+    '''
+    if job.done():
+      return False
+    if job.future is not None and job.future.cancel():
+      job.finished = time.time()
+    job.state = "killed"
+    return True
+
+  def clear(self):
+    'Forget about the finished jobs.'
+    with self.lock:
+      for jobId in [j.id for j in self.list() if j.done()]:
+        del self.jobs[jobId]
+
+  def setMaxWorkers(self, maxWorkers):
+    '''
+    Change the number of workers.  Jobs already queued finish on the old
+    pool, new ones go to a pool of the new size.
+    '''
+    with self.lock:
+      self.maxWorkers = maxWorkers
+      if self.executor is not None:
+        self.executor.shutdown(wait=False)
+        self.executor = None
+
+  def shutdown(self):
+    self.wait()
+    with self.lock:
+      if self.executor is not None:
+        self.executor.shutdown(wait=True)
+        self.executor = None
+
+
+def fanOut(func, items, parallel=8, stagger=0.0):
+  '''
+  Call func(item) for every item, up to parallel calls at once, and yield
+  (item, result, error) tuples in the order of items.  At most 2*parallel
+  calls are queued at a time so items can be a lazy iterator of any size.
+  stagger is the least time in seconds between two calls starting.
+  '''
+  parallel = max(1, int(parallel))
+  inFlight = deque()
+  lastStart = 0.0
+  with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="mash-fanout") as executor:
+    for item in items:
+      if stagger > 0:
+        delay = lastStart + stagger - time.time()
+        if delay > 0:
+          time.sleep(delay)
+        lastStart = time.time()
+      inFlight.append((item, executor.submit(func, item)))
+      while len(inFlight) >= parallel * 2:
+        yield _fanOutResult(*inFlight.popleft())
+    while inFlight:
+      yield _fanOutResult(*inFlight.popleft())
+
+
+def _fanOutResult(item, future):
+  try:
+    return (item, future.result(), None)
+  except Exception as e:
+    return (item, None, e)
@@ -13,27 +13,55 @@ signal.signal(signal.SIGINT, exitHandler)
 signal.signal(signal.SIGTERM, exitHandler)
 
 
+def parseArgs(argv):
+  import argparse
+  parser = argparse.ArgumentParser(prog="mash", description="The mProv shell.")
+  parser.add_argument("-c", dest="commands", metavar="COMMANDS",
+    help="run the commands, separated by ; or new lines, then exit")
+  parser.add_argument("--stats-file", metavar="FILE",
+    help="write the command and request stats to FILE at exit, in the Prometheus text format for .prom files, otherwise JSON")
+  parser.add_argument("--profile", metavar="FILE",
+    help="run under the python profiler, print the top functions to stderr and save the profile to FILE")
+  parser.add_argument("script", nargs="?", help="a script file to run")
+  return parser.parse_args(argv)
+
+
 def main():
   
+  args = parseArgs(sys.argv[1:])
   shell = MprovShell()
-  
-  # we are getting a script piped to us.
-  if S_ISFIFO(os.fstat(0).st_mode):
-    shell.setFile(sys.stdin)
+  if args.stats_file is not None:
+    shell.writeStatsAtExit(args.stats_file)
+
+  if args.commands is not None:
+    # one shot mode.
+    run = lambda: shell.runCommands(args.commands)
   else:
-    if len(sys.argv) >= 2:
-      if os.path.exists(sys.argv[1]):
-        # we are getting a file passed to us.
-        shell.setFile(open(sys.argv[1], 'r'))
+    # we are getting a script piped to us.
+    if S_ISFIFO(os.fstat(0).st_mode):
+      shell.setFile(sys.stdin)
+    else:
+      if args.script is not None:
+        if os.path.exists(args.script):
+          # we are getting a file passed to us.
+          shell.setFile(open(args.script, 'r'))
         if shell.file == None:
-          print(f"Error: Unable to open {sys.argv[1]}")
+          print(f"Error: Unable to open {args.script}")
           sys.exit(1)
-    else:
-      shell.setFile(None)
-  shell.cmdloop()
+      else:
+        shell.setFile(None)
+    run = shell.cmdloop
+
+  if args.profile is not None:
+    shell.profile(run, outFile=args.profile, stream=sys.stderr)
+  else:
+    run()
+  if args.commands is not None:
+    # exit non zero if any of the commands failed.
+    sys.exit(1 if shell.errorCount > 0 else 0)
 
 def __main__():
   main()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
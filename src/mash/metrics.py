@@ -0,0 +1,192 @@
+import os, json, time, threading
+from bisect import bisect_left
+
+'''
+Instrumentation for a mash run: how long every command took, every HTTP
+request by model and method (with the bytes sent and received and the
+status codes that came back) and the time spent rendering templates.
+Everything is kept in fixed bucket histograms so a long run costs no more
+memory than a short one.
+'''
+
+# histogram bucket upper bounds, in seconds.
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram():
+  def __init__(self):
+    self.counts = [0] * (len(buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.min = None
+    self.max = None
+
+  def observe(self, value):
+    self.counts[bisect_left(buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def mean(self):
+    return self.sum / self.count if self.count else 0.0
+
+  def quantile(self, q):
+    'Estimate a quantile, interpolating inside the bucket it falls in.'
+    if self.count == 0:
+      return 0.0
+    rank = q * self.count
+    seen = 0
+    for i, count in enumerate(self.counts):
+      if count and seen + count >= rank:
+        lower = buckets[i-1] if i > 0 else 0.0
+        upper = buckets[i] if i < len(buckets) else self.max
+        estimate = lower + (upper - lower) * (rank - seen) / count
+        return min(max(estimate, self.min), self.max)
+      seen += count
+    return self.max
+
+  def toDict(self):
+    return {
+      'count': self.count,
+      'sum': self.sum,
+      'min': self.min,
+      'max': self.max,
+      'mean': self.mean(),
+      'p50': self.quantile(0.5),
+      'p95': self.quantile(0.95),
+      'p99': self.quantile(0.99),
+      'buckets': {str(bound): count for bound, count in zip(list(buckets) + ["+Inf"], self.counts)},
+    }
+
+
+class Metrics():
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    with self.lock:
+      self.started = time.time()
+      self.commands = {}        # command -> Histogram
+      self.commandErrors = {}   # command -> commands that reported an error
+      self.requests = {}        # (method, model) -> Histogram
+      self.bytesSent = {}       # (method, model) -> bytes
+      self.bytesReceived = {}   # (method, model) -> bytes
+      self.statusCodes = {}     # (method, model, status) -> count
+      self.requestErrors = {}   # (method, model) -> requests that got no response
+      self.render = Histogram()
+      self.schemaLoads = Histogram()
+
+  def observeCommand(self, command, seconds, failed=False):
+    with self.lock:
+      histogram = self.commands.get(command)
+      if histogram is None:
+        histogram = self.commands[command] = Histogram()
+      histogram.observe(seconds)
+      if failed:
+        self.commandErrors[command] = self.commandErrors.get(command, 0) + 1
+
+  def observeRequest(self, method, model, seconds, status=None, sent=0, received=0):
+    'Record a request, status None means it failed without a response.'
+    key = (method.upper(), model)
+    with self.lock:
+      histogram = self.requests.get(key)
+      if histogram is None:
+        histogram = self.requests[key] = Histogram()
+      histogram.observe(seconds)
+      self.bytesSent[key] = self.bytesSent.get(key, 0) + sent
+      self.bytesReceived[key] = self.bytesReceived.get(key, 0) + received
+      if status is None:
+        self.requestErrors[key] = self.requestErrors.get(key, 0) + 1
+      else:
+        statusKey = key + (status,)
+        self.statusCodes[statusKey] = self.statusCodes.get(statusKey, 0) + 1
+
+  def observeRender(self, seconds):
+    with self.lock:
+      self.render.observe(seconds)
+
+  def observeSchemaLoad(self, seconds):
+    with self.lock:
+      self.schemaLoads.observe(seconds)
+
+  def toDict(self):
+    with self.lock:
+      return {
+        'started': self.started,
+        'elapsed': time.time() - self.started,
+        'commands': {command: dict(histogram.toDict(), errors=self.commandErrors.get(command, 0))
+          for command, histogram in sorted(self.commands.items())},
+        'requests': [dict(histogram.toDict(), method=method, model=model,
+            bytesSent=self.bytesSent.get((method, model), 0),
+            bytesReceived=self.bytesReceived.get((method, model), 0),
+            failed=self.requestErrors.get((method, model), 0),
+            statusCodes={str(status): count for (m, mo, status), count in sorted(self.statusCodes.items()) if (m, mo) == (method, model)})
+          for (method, model), histogram in sorted(self.requests.items())],
+        'render': self.render.toDict(),
+        'schemaLoads': self.schemaLoads.toDict(),
+      }
+
+  def toPrometheus(self):
+    'The metrics in the Prometheus text format, for the node exporter textfile collector.'
+    lines = []
+    with self.lock:
+      def histogram(name, help, labels, values):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} histogram")
+        for labelValues, hist in values:
+          label = ",".join(f'{key}="{_escape(value)}"' for key, value in zip(labels, labelValues))
+          sep = "," if label else ""
+          braces = f"{{{label}}}" if label else ""
+          cumulative = 0
+          for bound, count in zip(list(buckets) + ["+Inf"], hist.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label}{sep}le="{bound}"}} {cumulative}')
+          lines.append(f"{name}_sum{braces} {hist.sum}")
+          lines.append(f"{name}_count{braces} {hist.count}")
+
+      def counter(name, help, labels, values):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} counter")
+        for labelValues, value in values:
+          label = ",".join(f'{key}="{_escape(value)}"' for key, value in zip(labels, labelValues))
+          lines.append(f"{name}{{{label}}} {value}")
+
+      histogram("mash_command_seconds", "Time spent running mash commands.", ("command",),
+        [((command,), hist) for command, hist in sorted(self.commands.items())])
+      counter("mash_command_errors_total", "Commands that reported an error.", ("command",),
+        [((command,), count) for command, count in sorted(self.commandErrors.items())])
+      histogram("mash_http_request_seconds", "Time until the mPCC answered a request.", ("method", "model"),
+        sorted(self.requests.items()))
+      counter("mash_http_responses_total", "Responses from the mPCC by status code.", ("method", "model", "code"),
+        sorted(self.statusCodes.items()))
+      counter("mash_http_request_failures_total", "Requests that got no response.", ("method", "model"),
+        sorted(self.requestErrors.items()))
+      counter("mash_http_request_bytes_total", "Bytes of request bodies sent.", ("method", "model"),
+        sorted(self.bytesSent.items()))
+      counter("mash_http_response_bytes_total", "Bytes of response bodies received.", ("method", "model"),
+        sorted(self.bytesReceived.items()))
+      histogram("mash_template_render_seconds", "Time spent rendering templates.", (), [((), self.render)])
+      histogram("mash_schema_load_seconds", "Time spent loading the data models.", (), [((), self.schemaLoads)])
+    return "\n".join(lines) + "\n"
+
+  def write(self, path, fmt=None):
+    '''
+    Write the metrics to path, as JSON or the Prometheus text format (fmt
+    "prometheus", or a .prom file name).  Raises OSError if it can't.
+    '''
+    if fmt is None:
+      fmt = "prometheus" if path.endswith(".prom") else "json"
+    content = self.toPrometheus() if fmt == "prometheus" else json.dumps(self.toDict(), indent=2)
+    # write and rename, a collector must never read half a file.
+    tmpPath = f"{path}.{os.getpid()}.tmp"
+    with open(tmpPath, "w") as outFile:
+      outFile.write(content)
+    os.replace(tmpPath, path)
+
+
+def _escape(value):
+  return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
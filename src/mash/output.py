@@ -0,0 +1,116 @@
+import json
+from mash.records import RecordWriter
+
+'''
+Writing results for people (a table) or other programs (CSV, JSON lines or
+yaml).  The writers take a record at a time, so a result can be streamed
+to the output as it arrives without building it all up in memory first.
+A table works out its column widths from the first records it sees and
+keeps to them after that.
+'''
+
+formats = ("table", "csv", "jsonl", "yaml")
+
+
+class TableWriter():
+  '''
+  Write records as a table.  The columns and their widths come from the
+  first sampleSize records, which are held back until then (or close());
+  fields that only show up later are left out and cells wider than their
+  column are cut short.  No column is wider than maxWidth.
+  '''
+  def __init__(self, outFile, columns=None, sampleSize=100, maxWidth=40):
+    self.outFile = outFile
+    self.columns = columns
+    self.sampleSize = max(1, sampleSize)
+    self.maxWidth = maxWidth
+    self.widths = None
+    self.sample = []
+    self.count = 0
+
+  @staticmethod
+  def _cell(value):
+    if value is None:
+      return ""
+    if isinstance(value, (dict, list)):
+      value = json.dumps(value, separators=(",", ":"))
+    return str(value).replace("\n", " ")
+
+  @staticmethod
+  def _asRecord(record):
+    return record if isinstance(record, dict) else {"value": record}
+
+  def write(self, record):
+    record = self._asRecord(record)
+    self.count += 1
+    if self.widths is None:
+      self.sample.append(record)
+      if len(self.sample) >= self.sampleSize:
+        self._writeSample()
+      return
+    self._writeRow(record)
+
+  def close(self):
+    'Write what is still held back, the output is incomplete until this is called.'
+    if self.widths is None:
+      self._writeSample()
+
+  def _writeSample(self):
+    if self.columns is None:
+      self.columns = []
+      for record in self.sample:
+        for key in record:
+          if key not in self.columns:
+            self.columns.append(key)
+    self.widths = [len(str(column)) for column in self.columns]
+    for record in self.sample:
+      for i, column in enumerate(self.columns):
+        self.widths[i] = max(self.widths[i], len(self._cell(record.get(column))))
+    self.widths = [min(width, self.maxWidth) for width in self.widths]
+    if self.columns:
+      self._writeLine([str(column) for column in self.columns])
+      self._writeLine(["-" * width for width in self.widths])
+    for record in self.sample:
+      self._writeRow(record)
+    self.sample = []
+
+  def _writeRow(self, record):
+    self._writeLine([self._cell(record.get(column)) for column in self.columns])
+
+  def _writeLine(self, cells):
+    line = []
+    for cell, width in zip(cells, self.widths):
+      if len(cell) > width:
+        marker = "..." if width > 5 else "~"
+        cell = cell[:max(width - len(marker), 0)] + marker[:width]
+      line.append(cell.ljust(width))
+    self.outFile.write("  ".join(line).rstrip())
+    self.outFile.write("\n")
+
+
+def iterRecords(value):
+  '''
+  The records in a result: the items of a list (or a page of results, or
+  a lazy stream of records), or the value itself for one record.
+  '''
+  if isinstance(value, list):
+    return iter(value)
+  if isinstance(value, dict):
+    if isinstance(value.get('results'), list):
+      return iter(value['results'])
+    return iter([value])
+  if isinstance(value, (str, bytes, int, float, bool)) or value is None:
+    return iter([value])
+  return iter(value)
+
+
+def newWriter(outFile, fmt, sampleSize=100):
+  '''
+  A writer for fmt on an open file: write(record) each record, then close().
+  Raises ValueError for an unknown format.
+  '''
+  if fmt not in formats:
+    raise ValueError(f"Unknown output format {fmt}, use one of {', '.join(formats)}")
+  if fmt == "table":
+    return TableWriter(outFile, sampleSize=sampleSize)
+  return RecordWriter(outFile, fmt)
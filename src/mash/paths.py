@@ -0,0 +1,220 @@
+from functools import lru_cache
+
+'''
+Path expressions for picking values out of what the mPCC returns.  A path
+is compiled once into a list of steps and then run over a whole result:
+
+  hostname                   the hostname field.  A field of a list is that
+                             field of every item in it.
+  interfaces.0.mac           a number indexes a list.
+  results.*.hostname         * is every item of a list (or value of a dict).
+  results[state=up].id       [...] keeps the items that match: key=value,
+                             key!=value, key<value, key<=value, key>value,
+                             key>=value, or just [key] for a true value.
+
+A path that goes through a list gives back a list, otherwise a single value.
+Fields that aren't there are None.
+'''
+
+
+class PathError(ValueError):
+  pass
+
+
+operators = ("!=", "<=", ">=", "=", "<", ">")
+
+
+def _parsePredicate(text, path):
+  for op in operators:
+    key, found, value = text.partition(op)
+    if found:
+      key = key.strip()
+      if key == "":
+        raise PathError(f"Missing field in [{text}] in path {path}")
+      return ("filter", key.split("."), op, value.strip())
+  key = text.strip()
+  if key == "":
+    raise PathError(f"Empty [] in path {path}")
+  return ("filter", key.split("."), None, None)
+
+
+@lru_cache(maxsize=256)
+def compilePath(path):
+  'Compile a path expression into its steps, raises PathError if it is not valid.'
+  steps = []
+  i = 0
+  name = ""
+  while i <= len(path):
+    c = path[i] if i < len(path) else "."
+    if c in ".[":
+      if name != "":
+        if name == "*":
+          steps.append(("all",))
+        elif name.isdigit():
+          steps.append(("index", int(name), name))
+        else:
+          steps.append(("key", name))
+        name = ""
+      elif c == "." and (i == 0 or path[i-1] == "."):
+        raise PathError(f"Empty field in path {path}")
+      if c == "[":
+        end = path.find("]", i)
+        if end < 0:
+          raise PathError(f"Missing ] in path {path}")
+        steps.append(_parsePredicate(path[i+1:end], path))
+        i = end
+        if i + 1 < len(path) and path[i+1] not in ".[":
+          raise PathError(f"Expected . after ] in path {path}")
+    else:
+      name += c
+    i += 1
+  if not steps:
+    raise PathError("Empty path")
+  return tuple(steps)
+
+
+def splitPaths(text):
+  'Split a comma separated list of paths, leaving commas inside [] alone.'
+  paths = []
+  depth = 0
+  current = ""
+  for c in text:
+    if c == "[":
+      depth += 1
+    elif c == "]":
+      depth -= 1
+    elif c == "," and depth == 0:
+      paths.append(current.strip())
+      current = ""
+      continue
+    current += c
+  paths.append(current.strip())
+  return [path for path in paths if path != ""]
+
+
+def _field(obj, keys):
+  for key in keys:
+    if isinstance(obj, dict):
+      obj = obj.get(key)
+    else:
+      return None
+  return obj
+
+
+def _compare(actual, op, value):
+  if op is None:
+    return bool(actual)
+  if isinstance(actual, bool) or actual is None:
+    actual = str(actual).lower()
+    value = value.lower()
+    if value == "null":
+      value = "none"
+  if op in ("=", "!="):
+    equal = str(actual) == value
+    return equal if op == "=" else not equal
+  try:
+    actual, value = float(actual), float(value)
+  except (TypeError, ValueError):
+    actual = str(actual)
+  if op == "<":
+    return actual < value
+  if op == "<=":
+    return actual <= value
+  if op == ">":
+    return actual > value
+  return actual >= value
+
+
+def _matches(item, step):
+  return isinstance(item, dict) and _compare(_field(item, step[1]), step[2], step[3])
+
+
+def evaluate(steps, obj):
+  'Run compiled steps over obj.'
+  values = [obj]
+  many = False
+  for step in steps:
+    kind = step[0]
+    if kind == "key":
+      name = step[1]
+      result = []
+      for value in values:
+        if isinstance(value, dict):
+          result.append(value.get(name))
+        elif isinstance(value, list):
+          # a field of a list is that field of every item.
+          result.extend(item.get(name) if isinstance(item, dict) else None for item in value)
+          many = True
+        else:
+          result.append(None)
+    elif kind == "index":
+      result = []
+      for value in values:
+        if isinstance(value, list):
+          result.append(value[step[1]] if -len(value) <= step[1] < len(value) else None)
+        elif isinstance(value, dict):
+          result.append(value.get(step[2]))
+        else:
+          result.append(None)
+    elif kind == "all":
+      result = []
+      for value in values:
+        if isinstance(value, list):
+          result.extend(value)
+        elif isinstance(value, dict):
+          result.extend(value.values())
+      many = True
+    else:
+      result = []
+      for value in values:
+        if isinstance(value, list):
+          result.extend(item for item in value if _matches(item, step))
+          many = True
+        elif _matches(value, step):
+          result.append(value)
+    values = result
+  if many:
+    return values
+  return values[0] if values else None
+
+
+def select(obj, paths):
+  '''
+  Pick the paths out of obj.  One path gives its value, several give a
+  dict of path -> value, or for a list a dict like that for every item.
+  '''
+  compiled = [compilePath(path) for path in paths]
+  if len(compiled) == 1:
+    return evaluate(compiled[0], obj)
+  if isinstance(obj, list):
+    return [{path: evaluate(steps, item) for path, steps in zip(paths, compiled)} for item in obj]
+  return {path: evaluate(steps, obj) for path, steps in zip(paths, compiled)}
+
+
+def project(records, paths):
+  'Keep only the paths of every record, records are a list, a page of results or one record.'
+  compiled = [compilePath(path) for path in paths]
+  def one(record):
+    return {path: evaluate(steps, record) for path, steps in zip(paths, compiled)}
+  if isinstance(records, list):
+    return [one(record) for record in records]
+  if isinstance(records, dict) and isinstance(records.get('results'), list):
+    page = dict(records)
+    page['results'] = [one(record) for record in records['results']]
+    return page
+  return one(records)
+
+
+class Projection():
+  'A re-iterable projection of a (streamed) iterable of records.'
+  def __init__(self, records, paths):
+    self.records = records
+    self.paths = paths
+    self.compiled = [compilePath(path) for path in paths]
+
+  def __iter__(self):
+    for record in self.records:
+      yield {path: evaluate(steps, record) for path, steps in zip(self.paths, self.compiled)}
+
+  def __repr__(self):
+    return f"<Projection {','.join(self.paths)} of {self.records!r}>"
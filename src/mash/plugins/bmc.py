@@ -1,5 +1,7 @@
-import cmd, sys
-from mash.utils import rangeToList
+import cmd, sys, time
+from mash.utils import popOptions
+from mash.hostlist import HostList
+from mash.jobs import fanOut
 '''
 This plugin is used to perform power functions on nodes through the mPCC.
 '''
@@ -27,27 +29,196 @@ class PluginCMD(cmd.Cmd):
     '''
 Manage the power of a node or set of nodes via the BMC, if configured.
 
-bmc power <action> <node_spec>
+bmc power [options] <action> <node_spec>
+bmc power [options] status <node_spec>
+bmc power [options] wait <state> <node_spec>
 
   action:  One of 'on', 'off', 'cycle', or 'reset'
-  node_spec: Either the name of a node, or a node rang in slurm type notation. (ie. compute00[01-30,31,35,36-40,45-99])
+  node_spec: Either the name of a node, or a node rang in slurm type notation. (ie. compute00[01-30,31,35,36-40,45-99],rack[1-4]-node[001-128])
+
+  status asks every node for its power state and prints the nodes in each
+  state.  wait polls the nodes until they are all in state, asking only
+  the ones still pending, more often while nodes are changing and less
+  often while they aren't.
+
+  options:
+    --parallel <n>  Send up to n requests at once (default: maxConcurrency)
+    --stagger <s>   Wait at least s seconds between starting two requests
+    --timeout <s>   Give up on a node after s seconds (default: 60), for wait
+                    give up on the nodes still pending after s seconds (default: 600)
+    --interval <s>  wait: seconds between the first polls (default: 2)
+    --max-interval <s>  wait: longest time between two polls (default: 30)
+
+Return:
+  Sets MPROV_RESULT to a list of {'hostname', 'status', 'latency'} dicts, one per node,
+  and BMC_FAILED to the failed nodes in range notation, or "" if none failed.
+  For status and wait MPROV_RESULT is a dict of state -> nodes in range notation,
+  and BMC_FAILED the nodes that didn't answer (status) or didn't reach the state (wait).
 
 Examples: bmc power on compute00[01-20,21,23]
           bmc power off compute0050
+          bmc power --parallel 32 --stagger 0.05 cycle compute[0001-2000]
+          bmc power status rack[1-4]-node[001-128]
+          bmc power wait on rack1-node[001-128] --timeout 900
     '''
     if(self.mashCmd.mprovURL is None) or self.mashCmd.mprovURL == "" :
-      print("ERROR: You probably aren't connected.")
+      self.mashCmd.err("Error: You probably aren't connected.")
+      return
+    try:
+      arg, options = popOptions(arg, {'--parallel': int, '--stagger': float, '--timeout': float,
+        '--interval': float, '--max-interval': float})
+    except ValueError as e:
+      self.mashCmd.err(f"Error: {e}")
       return
     try:
       action, noderange = arg.split(" ", 1)
     except Exception as e:
       self.do_help("power")
       return
-    nodelist = rangeToList(noderange)
-    for node in nodelist:
-      # print(f"'{self.mashCmd.mprovURL}'")      
-      response = self.mashCmd.session.get(f"{self.mashCmd.mprovURL}power/{action}/?hostname={node}", timeout=None, stream=True)
-    
+    state = None
+    if action == "wait":
+      try:
+        state, noderange = noderange.split(" ", 1)
+      except ValueError:
+        self.do_help("power")
+        return
+    try:
+      nodelist = HostList(noderange)
+    except Exception as e:
+      self.mashCmd.err(f"Error: {e}")
+      return
+    parallel = options.get('--parallel', self.mashCmd._maxConcurrency())
+    self.mashCmd._ensurePoolSize(parallel)
+    if action == "status":
+      self._powerStatus(nodelist, parallel, options)
+      return
+    if action == "wait":
+      self._powerWait(state, nodelist, parallel, options)
+      return
+    timeout = options.get('--timeout', 60)
+
+    startTime = time.time()
+    results = []
+    failed = []
+    for node, result, error in fanOut(lambda node: self._powerRequest(action, node, timeout), nodelist, parallel, options.get('--stagger', 0.0)):
+      if error is not None:
+        results.append({'hostname': node, 'status': None, 'latency': None})
+        failed.append(node)
+        continue
+      status, latency, _ = result
+      results.append({'hostname': node, 'status': status, 'latency': round(latency, 3)})
+      if status < 200 or status > 299:
+        failed.append(node)
+
+    self.mashCmd.variables['MPROV_RESULT'] = results
+    self.mashCmd.variables['BMC_FAILED'] = str(HostList.fromNames(failed))
+    if not self.mashCmd.quiet:
+      self.mashCmd.print(f"power {action}: {len(results)} nodes, {len(results) - len(failed)} ok, {len(failed)} failed in {time.time() - startTime:.3f}s")
+    if failed:
+      self.mashCmd.err(f"Error: power {action} failed on {self.mashCmd.variables['BMC_FAILED']}")
+
+  def _powerRequest(self, action, node, timeout):
+    'Returns the status code, latency and the body of a power request for node.'
+    startTime = time.time()
+    response = self.mashCmd.session.get(f"{self.mashCmd.mprovURL}power/{action}/?hostname={node}", timeout=timeout, stream=True)
+    # read the body so the connection goes back to the pool.
+    content = response.content
+    return (response.status_code, time.time() - startTime, content)
+
+  def _queryStates(self, nodes, parallel, stagger, timeout):
+    '''
+    Ask every node for its power state, concurrently.  Returns a dict of
+    node -> state, with None for the nodes that didn't answer.
+    '''
+    import json
+    states = {}
+    for node, result, error in fanOut(lambda node: self._powerRequest("status", node, timeout), nodes, parallel, stagger):
+      states[node] = None
+      if error is not None:
+        continue
+      status, _, content = result
+      if status < 200 or status > 299:
+        continue
+      try:
+        states[node] = str(json.loads(content).get('state', "unknown")).lower()
+      except (ValueError, AttributeError):
+        states[node] = "unknown"
+    return states
+
+  def _groupStates(self, states):
+    'A dict of state -> nodes in range notation, for a dict of node -> state.'
+    groups = {}
+    for node, state in states.items():
+      groups.setdefault(state, []).append(node)
+    return {state: str(HostList.fromNames(nodes)) for state, nodes in sorted(groups.items(), key=lambda group: str(group[0]))}
+
+  def _printStates(self, groups):
+    for state, nodes in groups.items():
+      count = len(HostList(nodes))
+      self.mashCmd.print(f"  {state if state is not None else 'no answer':<10} {count:>6}  {nodes}")
+
+  def _powerStatus(self, nodelist, parallel, options):
+    startTime = time.time()
+    states = self._queryStates(nodelist, parallel, options.get('--stagger', 0.0), options.get('--timeout', 60))
+    groups = self._groupStates(states)
+    failed = groups.pop(None, "")
+    self.mashCmd.variables['MPROV_RESULT'] = groups
+    self.mashCmd.variables['BMC_FAILED'] = failed
+    if not self.mashCmd.quiet:
+      self.mashCmd.print(f"power status: {len(states)} nodes in {time.time() - startTime:.3f}s")
+      self._printStates(groups)
+    if failed:
+      self.mashCmd.err(f"Error: power status failed on {failed}")
+
+  def _powerWait(self, state, nodelist, parallel, options):
+    '''
+    Poll the nodes until they are all in state, or the timeout runs out.
+    Only the nodes still pending are asked again.  The interval between
+    polls starts at --interval and grows by half while no node changes,
+    up to --max-interval, and drops back as soon as one does.
+    '''
+    state = state.lower()
+    timeout = options.get('--timeout', 600)
+    interval = options.get('--interval', 2.0)
+    maxInterval = max(interval, options.get('--max-interval', 30.0))
+    stagger = options.get('--stagger', 0.0)
+    startTime = time.time()
+    deadline = startTime + timeout
+    pending = list(nodelist)
+    states = {}
+    delay = interval
+    polls = 0
+    while pending:
+      # no request may outlive the wait.
+      requestTimeout = max(1.0, min(60.0, deadline - time.time()))
+      polled = self._queryStates(pending, parallel, stagger, requestTimeout)
+      polls += 1
+      states.update(polled)
+      stillPending = [node for node in pending if polled[node] != state]
+      if len(stillPending) < len(pending):
+        delay = interval
+      else:
+        delay = min(delay * 1.5, maxInterval)
+      pending = stillPending
+      if not pending:
+        break
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      if not self.mashCmd.quiet:
+        self.mashCmd.print(f"power wait {state}: {len(states) - len(pending)}/{len(states)} nodes {state}, {len(pending)} pending, next poll in {min(delay, remaining):.1f}s")
+      time.sleep(min(delay, remaining))
+
+    groups = self._groupStates(states)
+    failed = str(HostList.fromNames(pending))
+    self.mashCmd.variables['MPROV_RESULT'] = groups
+    self.mashCmd.variables['BMC_FAILED'] = failed
+    if not self.mashCmd.quiet:
+      self.mashCmd.print(f"power wait {state}: {len(states) - len(pending)}/{len(states)} nodes {state} after {time.time() - startTime:.1f}s and {polls} polls")
+      if pending:
+        self._printStates(groups)
+    if pending:
+      self.mashCmd.err(f"Error: power wait {state} timed out, still waiting on {failed}")
 
   def precmd(self, line: str) -> str:
     if line[-1] == "&":
@@ -0,0 +1,61 @@
+import time, threading
+
+'''
+Profiling for mash commands.  profileCall runs a function under cProfile,
+and while a profile is running the shell's hot paths (template rendering,
+requests to the mPCC, JSON decoding and plugin dispatch) add their wall
+time to a PhaseTimer, so the report says which of them the time went to.
+'''
+
+phaseNames = ("template", "network", "decode", "plugin")
+
+
+class PhaseTimer():
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.totals = {}
+    self.counts = {}
+
+  def add(self, phase, seconds):
+    with self.lock:
+      self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+      self.counts[phase] = self.counts.get(phase, 0) + 1
+
+  def report(self, elapsed):
+    'Lines describing where elapsed seconds of wall time went.'
+    lines = [f"wall time: {elapsed * 1000:.1f}ms"]
+    for phase in phaseNames:
+      if phase not in self.totals:
+        continue
+      total = self.totals[phase]
+      share = total / elapsed if elapsed else 0.0
+      lines.append(f"  {phase:<9} {total * 1000:9.1f}ms {share:6.1%}  ({self.counts[phase]} calls)")
+    if "plugin" in self.totals:
+      lines.append("  (plugin time includes the plugin's own requests and templates)")
+    return lines
+
+
+def profileCall(func, stream, top=25, sort="cumulative", outFile=None, phases=None):
+  '''
+  Run func under cProfile and print the top entries, sorted by sort, to
+  stream.  The raw profile is saved to outFile if given (for snakeviz,
+  pstats and friends).  Only the calling thread is profiled.
+  '''
+  import cProfile, pstats
+  if sort not in pstats.Stats.sort_arg_dict_default:
+    raise ValueError(f"Unknown sort key {sort}")
+  profiler = cProfile.Profile()
+  startTime = time.perf_counter()
+  profiler.enable()
+  try:
+    return func()
+  finally:
+    profiler.disable()
+    elapsed = time.perf_counter() - startTime
+    if outFile is not None:
+      profiler.dump_stats(outFile)
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats(sort).print_stats(top)
+    if phases is not None:
+      for line in phases.report(elapsed):
+        print(line, file=stream)
@@ -0,0 +1,128 @@
+import os, csv, json
+from itertools import chain
+
+'''
+Reading and writing files of records for import and export.  Records are
+read and written one at a time so the files can be any size.
+'''
+
+formats = ("csv", "jsonl", "yaml")
+extensions = {
+  ".csv": "csv",
+  ".jsonl": "jsonl",
+  ".ndjson": "jsonl",
+  ".json": "jsonl",
+  ".yaml": "yaml",
+  ".yml": "yaml",
+}
+
+
+def guessFormat(fileName):
+  'Guess the record format from a file name, returns None if we can not tell.'
+  name = fileName[:-3] if fileName.endswith(".gz") else fileName
+  _, ext = os.path.splitext(name)
+  return extensions.get(ext.lower())
+
+
+def parseCSVValue(value):
+  '''
+  CSV cells are strings.  Lists and dicts RecordWriter wrote as JSON are
+  decoded again, and [a,b] becomes a list like the command line does.
+  '''
+  if len(value) > 1 and (value[0], value[-1]) in (("[", "]"), ("{", "}")):
+    try:
+      return json.loads(value)
+    except ValueError:
+      pass
+    if value[0] == "[":
+      return value[1:-1].split(",")
+  return value
+
+
+def readRecords(inFile, fmt):
+  'Yield the records in an open file, one dict at a time.'
+  if fmt == "csv":
+    for row in csv.DictReader(inFile):
+      # an empty cell means the field isn't set.
+      yield {key: parseCSVValue(value) for key, value in row.items() if key is not None and value != ""}
+  elif fmt == "jsonl":
+    first = True
+    for line in inFile:
+      line = line.strip()
+      if line == "":
+        continue
+      if first and line.startswith("["):
+        # a plain JSON list rather than JSON lines, decode it an item at a time.
+        from mash.stream import iterJsonArray
+        yield from iterJsonArray(chain([line], iter(lambda: inFile.read(65536), "")))
+        return
+      first = False
+      yield json.loads(line)
+  elif fmt == "yaml":
+    # RecordWriter writes a document per record, which safe_load_all loads
+    # one at a time.  A file that is one big list is loaded whole.
+    import yaml
+    for document in yaml.safe_load_all(inFile):
+      if document is None:
+        continue
+      if isinstance(document, list):
+        for record in document:
+          yield record
+      else:
+        yield document
+  else:
+    raise ValueError(f"Unknown format {fmt}")
+
+
+class RecordWriter():
+  '''
+  Write records to an open file one at a time.  For CSV the columns come
+  from the first record (or are given) and a record with a field that isn't
+  one of them raises ValueError, nested values are written as JSON.  YAML is
+  written as a document per record so it can be read back a record at a time.
+  '''
+  def __init__(self, outFile, fmt, columns=None, header=True):
+    if fmt not in formats:
+      raise ValueError(f"Unknown format {fmt}")
+    self.outFile = outFile
+    self.fmt = fmt
+    self.columns = columns
+    self.header = header
+    self.csvWriter = None
+    self.count = 0
+    if fmt == "yaml":
+      import yaml
+      self.yaml = yaml
+
+  def write(self, record):
+    if self.fmt == "jsonl":
+      self.outFile.write(json.dumps(record))
+      self.outFile.write("\n")
+    elif self.fmt == "csv":
+      if self.csvWriter is None:
+        if self.columns is None:
+          self.columns = list(record.keys()) if isinstance(record, dict) else ["value"]
+        self.csvWriter = csv.DictWriter(self.outFile, fieldnames=self.columns)
+        if self.header:
+          self.csvWriter.writeheader()
+      if not isinstance(record, dict):
+        record = {"value": record}
+      extra = [key for key in record if key not in self.columns]
+      if extra:
+        raise ValueError(f"Record has fields that are not columns of the file: {', '.join(map(str, extra))}")
+      self.csvWriter.writerow({key: self._csvValue(value) for key, value in record.items()})
+    else:
+      self.outFile.write(self.yaml.safe_dump(record, default_flow_style=False, sort_keys=False, explicit_start=True))
+    self.count += 1
+
+  def close(self):
+    'Nothing is held back, the file is complete after every write.'
+    pass
+
+  @staticmethod
+  def _csvValue(value):
+    if isinstance(value, (dict, list)):
+      return json.dumps(value)
+    if value is None:
+      return ""
+    return value
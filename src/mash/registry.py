@@ -0,0 +1,98 @@
+import sys, pkgutil, importlib, threading
+
+'''
+The plugin registry.  Plugins are discovered once per process, from the
+mash.plugins package and from the 'mash.plugins' entry point group so
+other packages can ship their own.  A plugin's module is only imported
+the first time it is used, and every shell keeps one instance of each
+plugin it has used.
+'''
+
+entryPointGroup = "mash.plugins"
+
+
+class PluginInfo():
+  def __init__(self, name, module=None, entryPoint=None):
+    self.name = name
+    self.module = module
+    self.entryPoint = entryPoint
+    self.pluginClass = None
+
+  def load(self):
+    'Import the plugin (the first time) and return its PluginCMD class.'
+    if self.pluginClass is None:
+      if self.entryPoint is not None:
+        loaded = self.entryPoint.load()
+      else:
+        loaded = importlib.import_module(self.module)
+      # an entry point may name the module or the class itself.
+      pluginClass = getattr(loaded, "PluginCMD", None) if not isinstance(loaded, type) else loaded
+      if pluginClass is None:
+        raise LookupError(f"'PluginCMD' class not found on plugin {self.name}")
+      self.pluginClass = pluginClass
+    return self.pluginClass
+
+
+_plugins = None
+_lock = threading.Lock()
+
+
+def _entryPoints():
+  try:
+    from importlib.metadata import entry_points
+  except ImportError:
+    return []
+  eps = entry_points()
+  if hasattr(eps, "select"):
+    return eps.select(group=entryPointGroup)
+  # python < 3.10 hands back a dict of groups.
+  return eps.get(entryPointGroup, [])
+
+
+def discover(refresh=False):
+  'Find the available plugins, returns a dict of name -> PluginInfo.'
+  global _plugins
+  with _lock:
+    if _plugins is not None and not refresh:
+      return _plugins
+    plugins = {}
+    import mash.plugins
+    for moduleInfo in pkgutil.iter_modules(mash.plugins.__path__):
+      if moduleInfo.name.startswith("_"):
+        continue
+      plugins[moduleInfo.name] = PluginInfo(moduleInfo.name, module=f"mash.plugins.{moduleInfo.name}")
+    try:
+      for entryPoint in _entryPoints():
+        # the plugins shipped with mash win over third party ones with the same name.
+        if entryPoint.name not in plugins:
+          plugins[entryPoint.name] = PluginInfo(entryPoint.name, entryPoint=entryPoint)
+    except Exception as e:
+      print(f"Error: Unable to load plugin entry points. {e}", file=sys.stderr)
+    _plugins = plugins
+    return _plugins
+
+
+class PluginRegistry():
+  'The plugins of one shell, each instantiated the first time it is used.'
+  def __init__(self, mashCmd):
+    self.mashCmd = mashCmd
+    self.instances = {}
+
+  def names(self):
+    return sorted(discover())
+
+  def has(self, name):
+    return name in discover()
+
+  def get(self, name):
+    'Get the instance of a plugin, returns None if there is no such plugin.'
+    instance = self.instances.get(name)
+    if instance is not None:
+      return instance
+    info = discover().get(name)
+    if info is None:
+      return None
+    pluginClass = info.load()
+    instance = pluginClass(self.mashCmd)
+    self.instances[name] = instance
+    return instance
@@ -0,0 +1,124 @@
+import os, json, hashlib
+from mash.app import hasTemplateMarkers
+
+'''
+Compiled mash scripts.  A script is parsed once into a tree of nodes, the
+foreach/pforeach blocks resolved to their bodies and the lines without any
+template markers flagged so they are run without going through jinja2.
+Compiled scripts are cached on disk by a hash of their content.
+
+Nodes are plain lists so they can be cached as JSON:
+  ["cmd", line, static]
+  ["loop", header, static, body]
+'''
+
+# bump this when the node format changes so old cache entries are ignored.
+version = 1
+loopCommands = ("foreach", "pforeach")
+
+
+class ScriptError(ValueError):
+  pass
+
+
+def _command(line):
+  return line.split(" ", 1)[0]
+
+
+def compileLines(lines):
+  'Compile an iterable of script lines into a list of nodes.'
+  root = []
+  stack = []  # (node, line number) of the open loops
+  current = root
+  for lineNo, line in enumerate(lines, 1):
+    line = line.strip()
+    # skip blank lines and comments.
+    if line == "" or line[0] == "#":
+      continue
+    command = _command(line)
+    if command in loopCommands:
+      node = ["loop", line, not hasTemplateMarkers(line), []]
+      current.append(node)
+      stack.append((node, lineNo))
+      current = node[3]
+    elif line == "endforeach":
+      if not stack:
+        raise ScriptError(f"line {lineNo}: endforeach without foreach")
+      stack.pop()
+      current = stack[-1][0][3] if stack else root
+    else:
+      current.append(["cmd", line, not hasTemplateMarkers(line)])
+  if stack:
+    raise ScriptError(f"line {stack[-1][1]}: {_command(stack[-1][0][1])} without endforeach")
+  return root
+
+
+def splitCommands(text):
+  '''
+  Split a -c command string into lines, on ; and new lines that are not
+  inside quotes, backticks or a jinja2 {{ }} / {% %} block.
+  '''
+  lines = []
+  current = []
+  quote = None
+  depth = 0
+  i = 0
+  while i < len(text):
+    c = text[i]
+    pair = text[i:i+2]
+    if quote is not None:
+      if c == "\\" and i + 1 < len(text):
+        current.append(pair)
+        i += 2
+        continue
+      if c == quote:
+        quote = None
+    elif pair in ("{{", "{%", "{#"):
+      depth += 1
+      current.append(pair)
+      i += 2
+      continue
+    elif depth > 0 and pair in ("}}", "%}", "#}"):
+      depth -= 1
+      current.append(pair)
+      i += 2
+      continue
+    elif c in "'\"`":
+      quote = c
+    elif depth == 0 and c in ";\n":
+      lines.append("".join(current))
+      current = []
+      i += 1
+      continue
+    current.append(c)
+    i += 1
+  lines.append("".join(current))
+  return [line for line in (line.strip() for line in lines) if line != ""]
+
+
+def compileScript(text, useCache=True):
+  '''
+  Compile the text of a script, using the on-disk cache of compiled
+  scripts if we can.  Raises ScriptError if the script doesn't parse.
+  '''
+  if not useCache:
+    return compileLines(text.splitlines())
+  from mash.cache import cacheDir
+  digest = hashlib.sha256(f"{version}\n{text}".encode()).hexdigest()
+  path = cacheDir("scripts", f"{digest}.json")
+  try:
+    with open(path, "r") as cacheFile:
+      return json.load(cacheFile)
+  except (OSError, ValueError):
+    pass
+  nodes = compileLines(text.splitlines())
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpPath = f"{path}.{os.getpid()}.tmp"
+    with open(tmpPath, "w") as cacheFile:
+      json.dump(nodes, cacheFile)
+    os.replace(tmpPath, path)
+  except OSError:
+    # the cache is only an optimization.
+    pass
+  return nodes
@@ -0,0 +1,167 @@
+import json, codecs
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+'''
+Streaming retrieves.  A RecordStream pages through a model endpoint and
+decodes the records as they arrive, so nothing but the current page (or
+the current record of an unpaginated list) is held in memory.
+'''
+
+chunkSize = 65536
+
+
+def iterJsonArray(chunks):
+  '''
+  Decode a JSON array from an iterator of text chunks, yielding the items
+  one at a time as they are complete.
+  '''
+  decoder = json.JSONDecoder()
+  chunks = iter(chunks)
+  buf = ""
+  pos = 0
+  eof = False
+  state = "start"  # start -> item -> sep -> item ... -> end
+
+  while True:
+    # skip whitespace, reading more when we run out.
+    while pos < len(buf) and buf[pos] in " \t\r\n":
+      pos += 1
+    if pos >= len(buf):
+      if eof:
+        if state != "end":
+          raise ValueError("Unexpected end of JSON array")
+        return
+      try:
+        chunk = next(chunks)
+      except StopIteration:
+        eof = True
+        chunk = ""
+      # drop what we have already decoded so the buffer stays small.
+      buf = buf[pos:] + chunk
+      pos = 0
+      continue
+
+    if state == "start":
+      if buf[pos] != "[":
+        raise ValueError("Expected a JSON array")
+      pos += 1
+      state = "first"
+      continue
+    if state in ("first", "sep"):
+      if buf[pos] == "]":
+        state = "end"
+        pos += 1
+        continue
+      if state == "sep":
+        if buf[pos] != ",":
+          raise ValueError(f"Expected , or ] in JSON array, got {buf[pos]}")
+        pos += 1
+      state = "item"
+      continue
+    if state == "item":
+      try:
+        item, end = decoder.raw_decode(buf, pos)
+      except json.JSONDecodeError:
+        if eof:
+          raise
+        item = end = None
+      # a number can decode early if it was cut in half, wait for more.
+      if end is None or (end >= len(buf) and not eof):
+        try:
+          chunk = next(chunks)
+        except StopIteration:
+          eof = True
+          chunk = ""
+        buf = buf[pos:] + chunk
+        pos = 0
+        continue
+      pos = end
+      state = "sep"
+      yield item
+      continue
+    if state == "end":
+      raise ValueError("Extra data after JSON array")
+
+
+def iterText(response):
+  'Iterate the body of a streamed response as text.'
+  decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+  for chunk in response.iter_content(chunk_size=chunkSize):
+    text = decoder.decode(chunk)
+    if text:
+      yield text
+  text = decoder.decode(b"", final=True)
+  if text:
+    yield text
+
+
+def setQuery(url, **params):
+  'Return url with the given query string parameters set.'
+  parts = urlsplit(url)
+  query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key not in params]
+  query += [(key, str(value)) for key, value in params.items()]
+  return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query, safe=",[]"), parts.fragment))
+
+
+class RecordStream():
+  '''
+  A lazy, re-iterable view of the records a retrieve returns.  Every
+  iteration sends the requests again, following the mPCC's pagination:
+  'next' links if the pages have them, otherwise limit/offset up to the
+  page's count.  Unpaginated JSON lists are decoded a record at a time.
+  '''
+  def __init__(self, session, url, pageSize=None, timeout=None):
+    self.session = session
+    self.url = url
+    self.pageSize = pageSize
+    self.timeout = timeout
+    self.pages = 0
+
+  def __iter__(self):
+    self.pages = 0
+    url = self.url
+    offset = 0
+    if self.pageSize:
+      url = setQuery(url, limit=self.pageSize, offset=offset)
+    while url is not None:
+      nextUrl = None
+      with self.session.get(url, timeout=self.timeout, stream=True) as response:
+        if response.status_code < 200 or response.status_code > 299:
+          raise Exception(f"Communications error with mPCC, code: {response.status_code}")
+        self.pages += 1
+        text = iterText(response)
+        first = ""
+        for first in text:
+          if first.strip() != "":
+            break
+        if first.strip() == "":
+          # an empty body, no records.
+          pass
+        elif first.lstrip().startswith("["):
+          # an unpaginated list, stream it a record at a time.
+          for record in iterJsonArray(self._chain(first, text)):
+            yield record
+        else:
+          page = json.loads(first + "".join(text))
+          if isinstance(page, dict) and 'results' in page:
+            # a paginated response, the page is bounded so decode it whole.
+            for record in page['results']:
+              yield record
+            if 'next' in page:
+              nextUrl = page['next']
+            elif self.pageSize and page['results'] and offset + len(page['results']) < page.get('count', 0):
+              # no next links, but we know how many there are.
+              offset += len(page['results'])
+              nextUrl = setQuery(self.url, limit=self.pageSize, offset=offset)
+          else:
+            yield page
+      url = nextUrl
+
+  @staticmethod
+  def _chain(first, rest):
+    yield first
+    for text in rest:
+      yield text
+
+  def __repr__(self):
+    return f"<RecordStream {self.url}>"
@@ -1,3 +1,5 @@
+from mash.hostlist import HostList
+
 
 def getDottedStrValue(dstring, obj):
   """
@@ -13,53 +15,46 @@ def getDottedStrValue(dstring, obj):
 
 
 def rangeToList(teststr):
-  # find the opening of the range
-  rangeStart = teststr.find('[')
-
-  if rangeStart < 0:
-    # only one node.
-    return [teststr]
-
-  prefix = teststr[0:rangeStart]
-  tmpList = []
-
-  teststr = teststr[rangeStart:]
-  # find the next comma
-  nextRangeEnd = teststr.find(',')
-  if nextRangeEnd < 0:
-    # try to see if the end of the range is reached.
-    nextRangeEnd = teststr.find(']')
-    if nextRangeEnd < 0:
-      # someone dun goofed.  The rang is invalid.
-      raise Exception("Range Invalid, no closing bracket found")
-
-  while(nextRangeEnd > -1):
-    # do we have a range or a single number
-    nodeRange = teststr[1:nextRangeEnd]
-    rangeSpecifier = nodeRange.find('-')
-    if rangeSpecifier < 0:
-      # no range, just append this node.
-      tmpList.append(f"{prefix}{nodeRange}")
+  '''
+  Expand a node range in slurm type notation into a list of node names.
+  See mash.hostlist.HostList to work on a range without expanding it.
+  '''
+  return list(HostList(teststr))
+
+
+def listToRange(names):
+  '''
+  Compress a list of node names back into slurm type range notation,
+  ie. ['compute01', 'compute02', 'compute04'] becomes 'compute[01-02,04]'
+  '''
+  return str(HostList.fromNames(names))
+
+
+def popOptions(arg, options):
+  '''
+  Pull --options out of a command line.  options maps each option name to
+  the type of its value, or to bool for a flag without one.  Returns the
+  rest of the line and a dict of the options that were given.
+  Raises ValueError if an option is missing its value or it doesn't convert.
+  '''
+  rest = []
+  found = {}
+  tokens = arg.split()
+  i = 0
+  while i < len(tokens):
+    token = tokens[i]
+    if token in options:
+      if options[token] is bool:
+        found[token] = True
+      else:
+        if i + 1 >= len(tokens):
+          raise ValueError(f"Option {token} needs a value")
+        try:
+          found[token] = options[token](tokens[i+1])
+        except ValueError:
+          raise ValueError(f"Invalid value for {token}: {tokens[i+1]}")
+        i += 1
     else:
-      # found a range specifier
-      intLen = len(nodeRange[:rangeSpecifier])
-      start = int(nodeRange[:rangeSpecifier])
-      end = int(nodeRange[rangeSpecifier+1:nextRangeEnd]) +1
-      # check if we accidentally overflow intLen
-      if len(str(end-1).zfill(intLen)) > intLen:
-        raise Exception("Range Format Error, padded zeros do not match range.")
-      for nodeNum in range(start,end):
-        nodeNumStr = str(nodeNum).zfill(intLen)
-        tmpList.append(f"{prefix}{nodeNumStr}")
-    teststr = teststr[nextRangeEnd+1:]
-    if teststr == "":
-      break
-    nextRangeEnd = teststr.find(',')
-    if nextRangeEnd < 0:
-      # try to see if the end of the range is reached.
-      nextRangeEnd = teststr.find(']')
-      if nextRangeEnd < 0:
-        # someone dun goofed.  The rang is invalid.
-        raise Exception("Range Invalid, no closing bracket found")
-
-  return tmpList
+      rest.append(token)
+    i += 1
+  return " ".join(rest), found
@@ -0,0 +1,44 @@
+from mash.hostlist import HostList
+
+
+def test_interface_suffix_matches_names():
+  hosts = HostList("node[1-3]-eth0")
+  assert "node1-eth0" in hosts
+  assert "node4-eth0" not in hosts
+  assert hosts == HostList("node1-eth0,node2-eth0,node3-eth0")
+  assert hosts == HostList.fromNames(["node1-eth0", "node2-eth0", "node3-eth0"])
+  assert str(hosts) == "node[1-3]-eth0"
+  assert list(hosts) == ["node1-eth0", "node2-eth0", "node3-eth0"]
+
+
+def test_interface_suffix_set_operations():
+  hosts = HostList("node[1-3]-eth0")
+  assert str(hosts - HostList("node1-eth0")) == "node[2-3]-eth0"
+  union = hosts | HostList("node4-eth0")
+  assert str(union) == "node[1-4]-eth0"
+  assert len(union) == 4
+  assert str(hosts & HostList("node[2-9]-eth0")) == "node[2-3]-eth0"
+
+
+def test_digit_after_last_group():
+  hosts = HostList("n[1-2]x5")
+  assert "n2x5" in hosts
+  assert hosts == HostList.fromNames(["n1x5", "n2x5"])
+  assert str(hosts) == "n[1-2]x5"
+  assert len(hosts) == 2
+
+
+def test_plain_names_meet_ranges():
+  assert "node5" in HostList("node5")
+  union = HostList("node5") | HostList("node[4-6]")
+  assert str(union) == "node[4-6]"
+  assert len(union) == 3
+  assert str(HostList("node[1-10]") - HostList("node5")) == "node[1-4,6-10]"
+  assert str(HostList("node5,node6")) == "node[5-6]"
+
+
+def test_multiple_groups():
+  hosts = HostList("rack[1-4]-node[001-128],login[1-2]")
+  assert len(hosts) == 4 * 128 + 2
+  assert str(hosts) == "rack[1-4]-node[001-128],login[1-2]"
+  assert "rack3-node007" in hosts
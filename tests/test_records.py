@@ -0,0 +1,46 @@
+import io, json
+import pytest
+from mash.records import RecordWriter, readRecords, parseCSVValue
+
+
+def roundTrip(records, fmt, columns=None):
+  out = io.StringIO()
+  writer = RecordWriter(out, fmt, columns=columns)
+  for record in records:
+    writer.write(record)
+  return list(readRecords(io.StringIO(out.getvalue()), fmt))
+
+
+def test_csv_lists_round_trip():
+  records = [{'hostname': 'n1', 'interfaces': ["a", "b"], 'extra': {'k': 1}}]
+  assert roundTrip(records, "csv") == records
+
+
+def test_csv_command_line_lists():
+  assert parseCSVValue("[a,b]") == ["a", "b"]
+  assert parseCSVValue("plain") == "plain"
+
+
+def test_csv_extra_fields_are_not_dropped():
+  with pytest.raises(ValueError):
+    roundTrip([{'hostname': 'n1'}, {'hostname': 'n2', 'mac': 'x'}], "csv")
+  records = [{'hostname': 'n1'}, {'hostname': 'n2', 'mac': 'x'}]
+  assert roundTrip(records, "csv", columns=["hostname", "mac"]) == records
+
+
+def test_yaml_is_read_a_record_at_a_time():
+  records = [{'hostname': f'n{i}', 'id': i} for i in range(3)]
+  out = io.StringIO()
+  writer = RecordWriter(out, "yaml")
+  for record in records:
+    writer.write(record)
+  assert out.getvalue().count("---") == 3
+  assert roundTrip(records, "yaml") == records
+
+
+def test_jsonl_and_json_array():
+  records = [{'hostname': f'n{i}', 'id': i} for i in range(3)]
+  assert roundTrip(records, "jsonl") == records
+  stream = readRecords(io.StringIO(json.dumps(records, indent=1)), "jsonl")
+  assert next(stream) == records[0]
+  assert list(stream) == records[1:]